@@ -1,50 +1,218 @@
 from header import *
 from utils import *
 from models import *
-import sys
 
 '''
 API for SMP-MCC 2020 and wechat
+python api.py <model_name> <cuda_id> [--batch_wait 5 --max_batch 16]
+several agents can be hosted by one service, the first one is the default agent:
+python api.py bertretrieval,gpt2,multiview <cuda_id> [--workers 4]
+the agent is selected by the path (/get_res/<model_name>) or the `model` field of the request
 '''
 
+def parser_args():
+    parser = argparse.ArgumentParser(description='api parameters')
+    parser.add_argument('model', type=str, help='name of the agents, separated by the comma')
+    parser.add_argument('multi_gpu', type=str)
+    parser.add_argument('--port', type=int, default=8080)
+    # latency spans of each stage, exported by /metrics
+    parser.add_argument('--metrics', action='store_true', help='collect the latency metrics of each stage')
+    # worker processes share the weights loaded by the main process (CPU only)
+    parser.add_argument('--workers', type=int, default=0, help='0 means that the agents run in the main process')
+    parser.add_argument('--worker_threads', type=int, default=1, help='torch threads of each worker process')
+    # micro-batching of the requests from different conversations
+    parser.add_argument('--batch_wait', type=float, default=5, help='max waiting time (ms) of one batch')
+    parser.add_argument('--max_batch', type=int, default=16)
+    # admission control, the requests are rejected (503 or a cheap reply) if the queue of the agent is full
+    parser.add_argument('--max_queue', type=int, default=64, help='max waiting requests of each agent, 0 means unbounded')
+    parser.add_argument('--concurrency', type=int, default=0, help='batches processed at the same time, 0 means the number of the workers')
+    parser.add_argument('--shed_mode', type=str, default='503', help='reply of the rejected requests: 503/es/trigger')
+    # time budget of each request, the agent degrades as the budget runs low (0 means no budget)
+    parser.add_argument('--budget', type=float, default=0, help='time budget (ms) of each request')
+    # conversation history of each session (group_id/user)
+    parser.add_argument('--history_window', type=int, default=50)
+    parser.add_argument('--max_sessions', type=int, default=10000)
+    parser.add_argument('--session_memory', type=int, default=64, help='memory limitation (MB) of the session store')
+    parser.add_argument('--session_timeout', type=int, default=3600, help='idle sessions (seconds) are removed')
+    # write-behind conversation logging of the wechat api
+    parser.add_argument('--db_backend', type=str, default='mongodb', help='mongodb/sqlite/memory')
+    parser.add_argument('--db_path', type=str, default='cache/conversation.db', help='path of the sqlite database')
+    parser.add_argument('--db_queue_size', type=int, default=10000)
+    # response cache, 0 means that the cache is not used
+    parser.add_argument('--cache_size', type=int, default=10000)
+    parser.add_argument('--cache_ttl', type=int, default=600, help='seconds')
+    parser.add_argument('--cache_window', type=int, default=3, help='number of the recent utterances in the key')
+    return parser.parse_args()
+
+def init_agent(name, multi_gpu):
+    if name == 'bertretrieval':
+        agent = BERTRetrievalAgent(multi_gpu, kb=False)
+        agent.load_model(f'ckpt/zh50w/bertretrieval/best.pt')
+    elif name == 'gpt2':
+        # available run_mode: test, rerank, rerank_ir
+        agent = GPT2Agent(1000, multi_gpu, run_mode='rerank')
+        agent.load_model(f'ckpt/train_generative/gpt2/best.pt.bak')
+    elif name == 'when2talk':
+        agent = When2TalkAgent(1000, multi_gpu, run_mode='test')
+        agent.load_model(f'ckpt/when2talk/when2talk/best.pt')
+    elif name == 'test':
+        agent = TestAgent()
+    elif name == 'multiview':
+        agent = MultiViewTestAgent()
+    else:
+        print(f'[!] obtain the unknown model name {name}')
+        exit()
+    agent.sessions = SessionStore(
+            window=args['history_window'],
+            max_sessions=args['max_sessions'],
+            max_memory=args['session_memory']*1024*1024,
+            timeout=args['session_timeout'])
+    return agent
+
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
     
-# init the agent
-args = {}
-args['model'] = sys.argv[1]
-args['multi_gpu'] = sys.argv[2]
-logger.info(f'[!] begin to init the {args["model"]} agent on {args["multi_gpu"]} GPU')
-if args['model'] == 'bertretrieval':
-    agent = BERTRetrievalAgent(args['multi_gpu'], kb=False)
-    agent.load_model(f'ckpt/zh50w/bertretrieval/best.pt')
-elif args['model'] == 'gpt2':
-    # available run_mode: test, rerank, rerank_ir
-    agent = GPT2Agent(1000, args['multi_gpu'], run_mode='rerank')
-    agent.load_model(f'ckpt/train_generative/gpt2/best.pt.bak')
-elif args['model'] == 'when2talk':
-    agent = When2TalkAgent(1000, args['multi_gpu'], run_mode='test')
-    agent.load_model(f'ckpt/when2talk/when2talk/best.pt')
-elif args['model'] == 'test':
-    agent = TestAgent()
-elif args['model'] == 'multiview':
-    agent = MultiViewTestAgent()
-else:
-    print(f'[!] obtain the unknown model name {args["model"]}')
+# init the agents
+args = vars(parser_args())
+# enable the monitor before the worker processes are forked
+monitor.enable(args['metrics'])
+agents = OrderedDict()
+for name in args['model'].split(','):
+    logger.info(f'[!] begin to init the {name} agent on {args["multi_gpu"]} GPU')
+    agents[name] = init_agent(name, args['multi_gpu'])
+    print(f'[!] init the {name} agent on GPU {args["multi_gpu"]} over')
+# the worker processes are forked before the other threads start
+router = AgentRouter(agents, workers=args['workers'], threads=args['worker_threads'])
+# all the requests are fed into the agent by the scheduler of the agent
+schedulers = {
+    name: BatchScheduler(
+        lambda data, name=name: router.get_res_batch(name, data),
+        max_wait=args['batch_wait']/1000, 
+        max_batch=args['max_batch'],
+        concurrency=args['concurrency'] if args['concurrency'] > 0 else max(1, len(router.workers)),
+        max_queue=args['max_queue'],
+        name=name) for name in agents
+}
+# the cheap reply of the rejected requests (load shedding)
+if args['shed_mode'] == 'es':
+    shed_searcher = ESChat('retrieval_database', kb=False)
+elif args['shed_mode'] == 'trigger':
+    trigger_utterances = load_topic_utterances('data/topic/train.txt')
+elif args['shed_mode'] != '503':
+    print(f'[!] shed mode must be 503/es/trigger, but got {args["shed_mode"]}')
     exit()
-print(f'[!] init the {args["model"]} agent on GPU {args["multi_gpu"]} over')
+# identical contexts reuse the response, concurrent identical requests are coalesced
+if args['cache_size'] > 0:
+    cache = ResponseCache(
+            capacity=args['cache_size'], 
+            ttl=args['cache_ttl'], 
+            window=args['cache_window'])
+else:
+    cache = None
+# conversations of the wechat api are saved by the background writer, which is created by the
+# first /wx/ request (the other apis do not need the database)
+writer, writer_lock = None, threading.Lock()
+
+def obtain_writer():
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = ConversationWriter(
+                    init_conversation_backend(args['db_backend'], path=args['db_path']),
+                    capacity=args['db_queue_size'])
+    return writer
 
 @app.route("/hello", methods=["GET"])
 def hello():
     return 'hello'
 
+# queue depth and batch size histograms of the schedulers, memory of the worker processes
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        'scheduler': {name: s.stats() for name, s in schedulers.items()},
+        'router': router.stats(),
+        'conversation_writer': writer.stats() if writer else None,
+        'cache': cache.stats() if cache else None,
+        # the prefix caches of the main process (the worker processes report them in /metrics)
+        'prefix_cache': {name: a.prefix_cache.stats() for name, a in agents.items() if getattr(a, 'prefix_cache', None)},
+    })
+
+# Prometheus text format: latency histograms of the stages, candidate counts, errors and the scheduler gauges
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    lines = [monitor.export()]
+    lines.append('# TYPE opendialog_scheduler_queue_depth gauge')
+    for name, s in schedulers.items():
+        lines.append(f'opendialog_scheduler_queue_depth{{agent="{name}"}} {s.queue.qsize()}')
+    lines.append('# TYPE opendialog_scheduler_requests_total counter')
+    for name, s in schedulers.items():
+        lines.append(f'opendialog_scheduler_requests_total{{agent="{name}"}} {s.stats()["requests"]}')
+    lines.append('# TYPE opendialog_scheduler_rejected_total counter')
+    for name, s in schedulers.items():
+        lines.append(f'opendialog_scheduler_rejected_total{{agent="{name}"}} {s.rejected}')
+    if cache:
+        stats_ = cache.stats()
+        lines.append('# TYPE opendialog_cache_total counter')
+        for key in ['hits', 'coalesced', 'misses']:
+            lines.append(f'opendialog_cache_total{{result="{key}"}} {stats_[key]}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def shed_response(data, history=None):
+    '''
+    the cheap reply of the rejected request (plain ES answer or the topic trigger utterance),
+    None means that the request is rejected with 503
+    '''
+    try:
+        if args['shed_mode'] == 'es':
+            msgs = '[SEP]'.join([i['msg'] for i in data['msgs']])
+            return shed_searcher.fallback(data['topic'], msgs, history=history)
+        elif args['shed_mode'] == 'trigger':
+            utterances = trigger_utterances.get(data['topic'])
+            if not utterances:
+                utterances = [j for i in trigger_utterances.values() for j in i]
+            return random.choice(utterances)
+    except Exception as error:
+        print(f'[!] obtain the shed reply failed: {error}')
+    return None
+
+def obtain_response(data, name=None):
+    '''
+    check the response cache before feeding the request into the scheduler of the agent,
+    the response obtained from the cache should be saved into the session history;
+    if the queue of the agent is full, return the shed reply or raise Overloaded (503)
+    '''
+    name = router.select(name)
+    scheduler, agent = schedulers[name], router[name]
+    session_id = data.get('group_id')
+    try:
+        if cache is None:
+            return scheduler(data)
+        key = (name, cache.make_key(data['topic'], [i['msg'] for i in data['msgs']]))
+        response, hit = cache.obtain(
+                key, 
+                lambda: scheduler(data), 
+                history=agent.sessions.history(session_id))
+    except Overloaded:
+        response = shed_response(data, history=agent.sessions.history(session_id))
+        if response is None:
+            raise
+        with monitor.label(name):
+            monitor.count('shed')
+        hit = True
+    if hit:
+        agent.sessions.append(session_id, response)
+    return response
+
 # SMP-MCC test API
 @app.route('/get_res', methods=["POST", "GET"])
-def get_res():
+@app.route('/get_res/<model>', methods=["POST", "GET"])
+def get_res(model=None):
     '''
     data = {
+        'model': model_name (optional),
         'group_id': group_id,
         'topic': topic,
         'robot_id': your_robot_id,
@@ -58,7 +226,15 @@ def get_res():
     }
     '''
     data = request.json
-    msg = agent.get_res(data)
+    name = model if model else data.get('model')
+    if name and name not in router:
+        return jsonify({'error': f'unknown model {name}'}), 404
+    # the budget begins when the request arrives (the waiting time in the scheduler is included)
+    data['deadline'] = Deadline(args['budget']/1000)
+    try:
+        msg = obtain_response(data, name=name)
+    except Overloaded:
+        return jsonify({'error': 'the service is overloaded, please retry later'}), 503
 
     res = {
         'msg': msg,
@@ -71,12 +247,40 @@ def get_res():
     logger.info(log_str)
     return jsonify(res)
 
+# streaming API (server-sent events), the format of the request is the same as /get_res
+@app.route('/stream', methods=["POST"])
+@app.route('/stream/<model>', methods=["POST"])
+def get_res_stream(model=None):
+    '''
+    each event contains the new piece of the response: data: {"msg": piece}
+    the last event is: data: [DONE]
+    the generation stops once the client disconnects (the response generator is closed)
+    '''
+    data = request.json
+    name = model if model else data.get('model')
+    if name and name not in router:
+        return jsonify({'error': f'unknown model {name}'}), 404
+    # the streaming generation runs in the main process
+    agent = router[router.select(name)]
+
+    def generate():
+        stream = agent.get_res_stream(data)
+        try:
+            for piece in stream:
+                if piece:
+                    yield f'data: {json.dumps({"msg": piece}, ensure_ascii=False)}\n\n'
+            yield 'data: [DONE]\n\n'
+        finally:
+            stream.close()
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 # wechat api
 @app.route('/wx/', methods=['GET', 'POST'])
 def wechat_api():
     '''
     During talking, use the pymongo to save the conversation context
     Mongodb: dbname[dialog], table_name[test]
+    The utterances are saved by the write-behind ConversationWriter (mongodb/sqlite/memory)
     '''
     if request.method == 'GET':
         # verify for wechat
@@ -99,19 +303,21 @@ def wechat_api():
             return make_response('')
     else:
         # POST method, talk to the chatbot
-        table = init_mongodb('dialog', 'test')
         data = request.data.decode()
         xml = ET.fromstring(data)
         toUser = xml.find('ToUserName').text
         fromUser = xml.find('FromUserName').text
         msgType = xml.find('MsgType').text
         content = xml.find('Content').text
+        writer = obtain_writer()
         # save the query into the database
         # special command of the user
         if content.startswith('#'):
             if content == '#清空':
                 # clear all the conversation context in the database
-                table.delete_many({})
+                writer.clear()
+                for agent in agents.values():
+                    agent.sessions.clear(fromUser)
                 logger.info(f'[!] delete all the conversation in the database')
                 return reply_text(fromUser, toUser, '#清空会话成功')
             else:
@@ -123,26 +329,28 @@ def wechat_api():
                     return reply_text(fromUser, toUser, f'#设定会话主题为: {topic}')
         # load the topic
         topic = load_topic() 
-        data = {'response': content, 'id': db_table_counter(table)}
-        x = table.insert_one(data)
-        logger.info(f'[!] insert the utterance {data["id"]} into the databse')
+        idx = writer.write(content)
+        logger.info(f'[!] insert the utterance {idx} into the databse')
         # get response from the agent
         # obtain the recent conversation utterances
         # msgs = [(i['response'], i['id']) for i in table.find({})]
         # sort and only use 10 current utterances
         # msgs = sorted(msgs, key=lambda i:i[1])[-10:]
         data = {
-            'group_id': 0,
+            'group_id': fromUser,
             'topic': topic,
             'robot_id': 0,
-            'msgs': [{'msg': content}]
+            'msgs': [{'msg': content}],
+            'deadline': Deadline(args['budget']/1000),
         }
-        reply = agent.get_res(data)
+        try:
+            reply = obtain_response(data)
+        except Overloaded:
+            return make_response('', 503)
         # reply = '兰天真帅'
         # insert the response into the mongodb
-        data_ = {'response': reply, "id": db_table_counter(table)}
-        x = table.insert_one(data_)
-        logger.info(f'[!] insert the utterance {data_["id"]} into the databse')
+        idx = writer.write(reply)
+        logger.info(f'[!] insert the utterance {idx} into the databse')
         # show the log
         msgs_str = ' [SEP] '.join([i['msg'] for i in data['msgs']])
         log_str = f'\n========== LOG ==========\n[Context] {msgs_str}\n[Response] {reply}\n========== LOG ==========\n'
@@ -151,4 +359,4 @@ def wechat_api():
         return reply_text(fromUser, toUser, f'{reply}')
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    app.run(host="0.0.0.0", port=args['port'], threaded=True)
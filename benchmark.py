@@ -0,0 +1,741 @@
+from header import *
+from models import *
+from utils.collate_fn import gpt2_test_collate_fn_batch
+from utils.scheduler import BatchScheduler
+
+'''
+Micro benchmarks of the generation paths (random weights, CPU by default)
+
+1. kv_cache: tokens/sec of the single-sample GPT2.predict, full re-feed of the growing inpt_ids
+   at each step (the old implementation) vs. the incremental key/value cache (past)
+2. shrink: FLOPs and latency of the talk rerank workload (GPT2.predict_batch, `samples` candidates),
+   the finished samples are dropped from the active batch vs. the full batch until all of them finish;
+   the random weights rarely generate the [SEP] token, so the [SEP] is forced with `stop_prob` at each step
+3. prefill: latency and FLOPs of the prefill of the rerank candidates (GPT2.predict_batch with max_len 1),
+   the context copied for each sample vs. encoded once and shared by the samples
+4. prefix_cache: prefill of the multi-turn conversations (`sessions` interleaved sessions, `turns` turns,
+   each turn appends `utterance_len` tokens), without vs. with the PrefixKVCache of the previous turns
+5. sampling: per-step cost of the sampling of the lm head logits ([UNK] ban, repetition penalty, top-k/top-p),
+   the old helpers (python loop of the penalty, top-p over the full vocabulary) vs. the LogitsPipeline
+6. test_batch: wall-clock time of the test set generation (`contexts` contexts, their lengths are sampled
+   from [context_len/2, context_len]), one context at a time (GPT2.predict) vs. the left padded batches
+   (gpt2_test_collate_fn_batch and GPT2.predict_batch), the [SEP] is forced with `stop_prob` as in the shrink mode
+7. engine: throughput and latency of the serving at several arrival rates (`rates` requests/sec, Poisson arrivals,
+   the contexts have [context_len/2, context_len] tokens), the request-level batching (BatchScheduler +
+   GPT2.predict_batch) vs. the continuous batching (GenerationEngine); greedy decoding, and the [SEP] is forced
+   by a fixed threshold (about `stop_prob` per step), so both modes generate the same tokens
+8. speculative: acceptance rate and speedup of the speculative sampling for each k (GPT2.predict and predict_batch
+   with `samples`); the trained draft (model_lm_small) is not available with the random weights, and a random draft
+   is unrelated to the model (nothing is accepted), so the draft is the first `draft_layers` blocks of the model
+   (shared embeddings, ln_f and lm head); `--draft_config` uses a random model of the config instead
+9. beam: the candidate set of one context (the rerank workload), `samples` samples (GPT2.predict_batch) vs. the
+   beam search and the diverse beam search (GPT2.predict_beam, `beams` widths, `beam_groups` groups); latency,
+   distinct candidates, and the length normalized log probs of the candidates under the model (mean/best)
+10. shortlist: latency of GPT2.predict_batch (`samples` samples) with the full lm head vs. the VocabShortlist of
+   each size (`shortlist_sizes`), and the miss rate: how often the argmax of the full vocabulary (along the
+   generated samples) is out of the shortlist extended with the context; there is no corpus with the random
+   weights, so the frequency list is the top-k tokens of the model on `contexts` random calibration contexts
+11. mmi: the MMI scores of the rerank candidates (`samples` responses of one context, random weights), one
+   GPT2 forward for each pair (the old MMI.scores) vs. the right padded chunks; the max difference of the scores
+12. fluency: the fluency scores (SAFETY_FLUENCY) of the rerank candidates of one context, one GPT2 forward of
+   `context + response` for each pair (the old scores) vs. the context encoded once and the responses fed in
+   right padded chunks on top of its past; the max difference of the scores
+13. tokenize: the tokenization cost of one MultiView.forward call (`samples` candidates of one context, all the
+   sub-models that tokenize), each sub-model tokenizes its own inputs (the old calls) vs. the TextFeatures bundle
+   shared by the sub-models; the number of the tokenizer calls, the seconds, and whether the BERT ids are the same
+14. nidf: NIDF_TF with a synthetic vocabulary (`vocab_words` words with random document frequencies, there is no
+   corpus here), the scores of `samples` candidates (thulac tokens are cut once before the timing), the list
+   lookups (the old scores) vs. the sorted word array and the padded idf arrays; the load time of the old data.pkl vs. the
+   memory mapped arrays (words.npy, nidf.npy, ntf.npy); the max difference of the scores
+
+python benchmark.py --mode kv_cache --context_len 250 --max_len 50
+python benchmark.py --mode shrink --context_len 100 --max_len 50 --samples 16
+python benchmark.py --mode prefill --context_len 250
+python benchmark.py --mode prefix_cache --sessions 8 --turns 8
+python benchmark.py --mode sampling
+python benchmark.py --mode test_batch --context_len 250 --max_len 50 --contexts 256 --batch_size 32
+python benchmark.py --mode engine --context_len 100 --max_len 30 --requests 48 --rates 1,2,4,8
+python benchmark.py --mode speculative --config data/config/model_config_dialogue.json --context_len 100 --max_len 30
+python benchmark.py --mode beam --context_len 100 --max_len 30 --samples 16 --beams 4,8
+python benchmark.py --mode shortlist --context_len 100 --max_len 30 --samples 16 --contexts 64 --shortlist_sizes 1000,2000,4000
+python benchmark.py --mode mmi --samples 128 --runs 1
+python benchmark.py --mode fluency --context_len 200 --samples 128 --runs 1
+python benchmark.py --mode tokenize --context_len 100 --max_len 30 --samples 64
+python benchmark.py --mode nidf --max_len 30 --samples 64 --vocab_words 50000
+'''
+
+def parser_args():
+    parser = argparse.ArgumentParser(description='benchmark parameters')
+    parser.add_argument('--mode', type=str, default='kv_cache')
+    parser.add_argument('--config', type=str, default='data/config/model_config_dialogue_small.json')
+    parser.add_argument('--vocab_size', type=int, default=13317)
+    parser.add_argument('--context_len', type=int, default=250)
+    parser.add_argument('--max_len', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--samples', type=int, default=16)
+    parser.add_argument('--stop_prob', type=float, default=0.08)
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--turns', type=int, default=8)
+    parser.add_argument('--utterance_len', type=int, default=20)
+    parser.add_argument('--prefix_cache_tokens', type=int, default=8192)
+    parser.add_argument('--contexts', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=48)
+    parser.add_argument('--rates', type=str, default='1,2,4,8')
+    parser.add_argument('--ks', type=str, default='1,2,4,6')
+    parser.add_argument('--draft_layers', type=int, default=2)
+    parser.add_argument('--draft_config', type=str, default='')
+    parser.add_argument('--beams', type=str, default='4,8')
+    parser.add_argument('--beam_groups', type=int, default=4)
+    parser.add_argument('--diversity_penalty', type=float, default=0.5)
+    parser.add_argument('--shortlist_sizes', type=str, default='1000,2000,4000')
+    parser.add_argument('--vocab_words', type=int, default=50000)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=30)
+    return parser.parse_args()
+
+def build_gpt2(args, sep_id=-1):
+    '''
+    sep_id is -1 by default, so that max_len tokens are generated in each run
+    '''
+    model = GPT2(
+            args['vocab_size'], 100, sep_id, 20, 1.0, 1.2,
+            config_path=args['config'])
+    model.eval()
+    return model
+
+def random_context(args):
+    return torch.randint(106, args['vocab_size'], (args['context_len'],))
+
+@torch.no_grad()
+def refeed_predict(model, inpt_ids, max_len):
+    '''
+    the old GPT2.predict: the whole inpt_ids is fed at each step (no past)
+    '''
+    pipeline, state, generated = model.logits_pipeline(), None, []
+    for _ in range(max_len):
+        outputs = model.model(input_ids=inpt_ids)
+        next_token_logits = outputs[0][-1, :]    # [vocab]
+        if state is None:
+            state = pipeline.init_state(next_token_logits)
+        next_token = pipeline.sample(next_token_logits, state)
+        if next_token == model.sep_id:
+            break
+        generated.append(next_token.item())
+        inpt_ids = torch.cat((inpt_ids, next_token), dim=0)
+        inpt_ids = inpt_ids[-model.n_ctx:]
+    return generated
+
+def timeit(fn, runs, seed):
+    '''
+    return the outputs of the runs (same seed for each run) and the seconds of each run
+    '''
+    outputs, times = [], []
+    for i in range(runs):
+        torch.manual_seed(seed + i)
+        begin = time.perf_counter()
+        outputs.append(fn())
+        times.append(time.perf_counter() - begin)
+    return outputs, times
+
+def legacy_top_k_top_p_filtering(logits, top_k=0, top_p=1.0, min_token_to_keep=1):
+    '''
+    the old top_k_top_p_filtering_batch (reference of the sampling benchmark):
+    the top-k mask, then the full vocabulary is sorted again for the top-p
+    '''
+    if top_k > 0:
+        top_k = min(max(top_k, min_token_to_keep), logits.size(-1))
+        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+        logits[indices_to_remove] = -np.inf
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        sorted_indices_to_remove = cumulative_probs > top_p
+        if min_token_to_keep > 1:
+            sorted_indices_to_remove[..., :min_token_to_keep] = 0
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices_to_remove.scatter(
+                1, sorted_indices, sorted_indices_to_remove)
+        logits[indices_to_remove] = -np.inf
+    return logits
+
+def legacy_sample(logits, generated, unk_id, penalty, top_k, top_p):
+    '''
+    the old sampling step of predict_batch: python loop of the repetition penalty over the rows
+    generated: batch*[the generated tokens of the row]
+    '''
+    logits[:, unk_id] = -np.inf
+    for x in range(len(logits)):
+        if generated[x]:
+            logits[x, list(set(generated[x]))] /= penalty
+    filtered_logits = legacy_top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+    return torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
+
+def benchmark_sampling(args, steps=50, unk_id=100):
+    '''
+    per-step cost of the sampling (the logits of the lm head are given), no model forward
+    '''
+    top_k, top_p, penalty = 20, 0.9, 1.2
+    pipeline = LogitsPipeline.build(
+            banned=[unk_id], repetition_penalty=penalty, top_k=top_k, top_p=top_p)
+    print(f'[!] vocab: {args["vocab_size"]}, top_k: {top_k}, top_p: {top_p}, repetition penalty: {penalty}, {steps} steps')
+    for batch in [1, 16, 64]:
+        torch.manual_seed(args['seed'])
+        logits = [torch.randn(batch, args['vocab_size']) * 3 for _ in range(steps)]
+        def legacy():
+            generated = [[] for _ in range(batch)]
+            for step_logits in logits:
+                next_token = legacy_sample(step_logits.clone(), generated, unk_id, penalty, top_k, top_p)
+                for x, token in enumerate(next_token.squeeze(1).tolist()):
+                    generated[x].append(token)
+        def unified():
+            state = pipeline.init_state(logits[0])
+            for step_logits in logits:
+                pipeline.sample(step_logits.clone(), state)
+        rest = {}
+        for name, fn in [('legacy', legacy), ('pipeline', unified)]:
+            fn()    # warm up
+            _, times = timeit(fn, args['runs'], args['seed'])
+            rest[name] = 1e6 * np.mean(times) / steps
+        print(f'[batch {batch:>2}] legacy: {round(rest["legacy"], 1)}us/step, pipeline: {round(rest["pipeline"], 1)}us/step, speedup: {round(rest["legacy"] / rest["pipeline"], 2)}x')
+    # the filtered distributions should be the same (random logits have no ties)
+    logits = torch.randn(64, args['vocab_size']) * 3
+    a = F.softmax(legacy_top_k_top_p_filtering(logits.clone(), top_k=top_k, top_p=top_p), dim=-1)
+    b = F.softmax(TopKTopP(top_k, top_p)(logits.clone(), None), dim=-1)
+    print(f'[!] max difference of the filtered distributions: {(a - b).abs().max().item()}')
+
+def benchmark_kv_cache(args):
+    model = build_gpt2(args)
+    torch.manual_seed(args['seed'])
+    inpt_ids = random_context(args)
+    # warm up
+    model.predict(inpt_ids, 2)
+    print(f'[!] context: {args["context_len"]} tokens, generate: {args["max_len"]} tokens, n_ctx: {model.n_ctx}')
+    if args['context_len'] + args['max_len'] > model.n_ctx:
+        print(f'[!] the window is full after {model.n_ctx - args["context_len"]} tokens, the truncated window is fed again at each step after that')
+    rest = {}
+    for name, fn in [
+            ('refeed', lambda: refeed_predict(model, inpt_ids, args['max_len'])),
+            ('kv_cache', lambda: model.predict(inpt_ids, args['max_len']))]:
+        outputs, times = timeit(fn, args['runs'], args['seed'])
+        tokens = sum(len(i) for i in outputs)
+        rest[name] = (outputs, tokens / sum(times))
+        print(f'[{name:>8}] {round(tokens / sum(times), 2)} tokens/sec, {round(np.mean(times), 4)}s per run')
+    print(f'[!] speedup: {round(rest["kv_cache"][1] / rest["refeed"][1], 2)}x')
+    # same seed, the sampled tokens should be the same (float error may change the rare ties)
+    same = sum(a == b for a, b in zip(rest['refeed'][0], rest['kv_cache'][0]))
+    print(f'[!] identical samples: {same}/{args["runs"]}')
+
+def generation_flops(config, rows, tokens, length):
+    '''
+    approximate FLOPs of one forward of the GPT2LMHeadModel (2 FLOPs per multiply-add)
+    rows: batch size; tokens: the new tokens of each row; length: past length + tokens
+    '''
+    d, n_layer = config.n_embd, config.n_layer
+    # qkv, output projection and the mlp of each layer, the lm head
+    dense = n_layer * 12 * d * d + d * config.vocab_size
+    # q*k and attention*v
+    attention = n_layer * 2 * length * d
+    return 2 * rows * tokens * (dense + attention)
+
+class FLOPsCounter:
+
+    '''
+    count the FLOPs of the forwards of the GPT2LMHeadModel with the hook on its first block,
+    whose output contains the hidden states [rows, tokens, hidden] and the present [2, rows, head, length, head_dim]
+    '''
+
+    def __init__(self, model):
+        self.config = model.config
+        self.reset()
+        model.transformer.h[0].register_forward_hook(self.hook)
+
+    def reset(self):
+        # the prefill (context) and the decoding steps are counted separately
+        self.prefill, self.decode, self.rows = 0, 0, 0
+
+    def hook(self, module, inputs, outputs):
+        hidden, present = outputs[:2]
+        rows, tokens = hidden.shape[:2]
+        flops = generation_flops(self.config, rows, tokens, present.shape[-2])
+        if tokens > 1:
+            self.prefill += flops
+        else:
+            self.decode += flops
+            self.rows += rows
+
+def force_stop(prob, sep_id):
+    '''
+    forward hook of the lm head, the [SEP] token of each row is forced with the probability `prob`
+    '''
+    def hook(module, inputs, outputs):
+        stop = torch.rand(outputs.shape[:-1], device=outputs.device) < prob
+        outputs[..., sep_id] = torch.where(stop, torch.full_like(stop, 1e4, dtype=outputs.dtype), outputs[..., sep_id])
+        return outputs
+    return hook
+
+def threshold_stop(model, prob, sep_id, probe_id=1):
+    '''
+    forward hook of the lm head, the [SEP] token is forced if the logit of the `probe_id` token exceeds the threshold,
+    which is calibrated so that the [SEP] is forced with the probability `prob` at each step;
+    unlike force_stop, the stop only depends on the tokens of the row (not on the random state or the other rows)
+    '''
+    with torch.no_grad():
+        outputs = model.model(input_ids=torch.randint(106, model.model.config.vocab_size, (8, min(64, model.n_ctx))))[0]
+    threshold = torch.quantile(outputs[..., probe_id].flatten(), 1 - prob).item()
+    def hook(module, inputs, outputs):
+        stop = outputs[..., probe_id] > threshold
+        outputs[..., sep_id] = torch.where(stop, torch.full_like(stop, 1e4, dtype=outputs.dtype), outputs[..., sep_id])
+        return outputs
+    return hook
+
+def benchmark_shrink(args):
+    sep_id = 102
+    model = build_gpt2(args, sep_id=sep_id)
+    if args['stop_prob'] > 0:
+        model.model.lm_head.register_forward_hook(force_stop(args['stop_prob'], sep_id))
+    counter = FLOPsCounter(model.model)
+    torch.manual_seed(args['seed'])
+    inpt_ids = random_context(args).unsqueeze(0).expand(args['samples'], -1)    # [samples, seq]
+    print(f'[!] context: {args["context_len"]} tokens, {args["samples"]} samples, max_len: {args["max_len"]}, stop prob: {args["stop_prob"]}')
+    rest, runs = {}, args['runs']
+    for name, shrink in [('full', False), ('shrink', True)]:
+        counter.reset()
+        outputs, times = timeit(
+                lambda: model.predict_batch(inpt_ids, args['max_len'], shrink=shrink),
+                runs, args['seed'])
+        lengths = [i.index(sep_id) + 1 if sep_id in i else len(i) for o in outputs for i in o]
+        rest[name] = (counter.decode, counter.prefill + counter.decode, np.mean(times))
+        print(f'[{name:>8}] decoding: {round(counter.decode / runs / 1e9, 2)} GFLOPs ({round(counter.rows / runs, 1)} rows fed), prefill: {round(counter.prefill / runs / 1e9, 2)} GFLOPs, {round(np.mean(times), 4)}s per run, avg length: {round(np.mean(lengths), 2)}')
+    print(f'[!] saved FLOPs: {round(100 * (1 - rest["shrink"][0] / rest["full"][0]), 2)}% of the decoding, {round(100 * (1 - rest["shrink"][1] / rest["full"][1]), 2)}% in total')
+    print(f'[!] speedup: {round(rest["full"][2] / rest["shrink"][2], 2)}x')
+
+def benchmark_prefill(args):
+    model = build_gpt2(args)
+    counter = FLOPsCounter(model.model)
+    torch.manual_seed(args['seed'])
+    inpt_ids = random_context(args).unsqueeze(0)    # [1, seq]
+    print(f'[!] context: {args["context_len"]} tokens')
+    for samples in [1, 4, 16, 32]:
+        rest = {}
+        for name, fn in [
+                ('copied', lambda: model.predict_batch(inpt_ids.expand(samples, -1), 1)),
+                ('shared', lambda: model.predict_batch(inpt_ids, 1, samples=samples))]:
+            counter.reset()
+            _, times = timeit(fn, args['runs'], args['seed'])
+            rest[name] = (counter.prefill / args['runs'], np.mean(times))
+        print(f'[samples {samples:>2}] copied: {round(rest["copied"][0] / 1e9, 2)} GFLOPs {round(rest["copied"][1], 4)}s, shared: {round(rest["shared"][0] / 1e9, 2)} GFLOPs {round(rest["shared"][1], 4)}s, speedup: {round(rest["copied"][1] / rest["shared"][1], 2)}x')
+
+def benchmark_prefix_cache(args):
+    model = build_gpt2(args)
+    torch.manual_seed(args['seed'])
+    # the turns of the sessions are interleaved (the requests of the service)
+    contexts = [[] for _ in range(args['sessions'])]
+    requests = []
+    for _ in range(args['turns']):
+        for context in contexts:
+            context.extend(torch.randint(106, args['vocab_size'], (args['utterance_len'],)).tolist())
+            # the context is truncated as the agent does (room for the generation)
+            requests.append(torch.LongTensor(context[-(model.n_ctx - args['max_len']):]))
+    print(f'[!] {args["sessions"]} sessions, {args["turns"]} turns, {args["utterance_len"]} tokens per utterance, {len(requests)} requests')
+    cache = PrefixKVCache(model.n_ctx, capacity=args['prefix_cache_tokens'])
+    rest = {}
+    for name, cache_ in [('no cache', None), ('cache', cache)]:
+        begin = time.perf_counter()
+        for inpt_ids in requests:
+            shared_prefill(model.model, inpt_ids.unsqueeze(0), samples=16, cache=cache_)
+        rest[name] = time.perf_counter() - begin
+        print(f'[{name:>8}] {round(rest[name], 4)}s, {round(1000 * rest[name] / len(requests), 2)}ms per request')
+    stats = cache.stats()
+    print(f'[!] hit ratio: {stats["hit_ratio"]}, saved prefill tokens: {stats["saved_tokens"]} ({round(100 * stats["saved_ratio"], 2)}%), cached: {stats["entries"]} contexts/{stats["tokens"]} tokens')
+    print(f'[!] speedup: {round(rest["no cache"] / rest["cache"], 2)}x')
+
+def benchmark_test_batch(args):
+    sep_id = 102
+    model = build_gpt2(args, sep_id=sep_id)
+    if args['stop_prob'] > 0:
+        model.model.lm_head.register_forward_hook(force_stop(args['stop_prob'], sep_id))
+    torch.manual_seed(args['seed'])
+    data = []
+    for _ in range(args['contexts']):
+        length = random.randint(args['context_len'] // 2, args['context_len'])
+        data.append({
+            'context_id': torch.randint(106, args['vocab_size'], (length,)),
+            'reply_id': torch.randint(106, args['vocab_size'], (20,))})
+    print(f'[!] {args["contexts"]} contexts ({args["context_len"] // 2}-{args["context_len"]} tokens), max_len: {args["max_len"]}, batch size: {args["batch_size"]}, stop prob: {args["stop_prob"]}')
+    def one_by_one():
+        return [model.predict(i['context_id'], args['max_len']) for i in data]
+    def batched():
+        rest = []
+        for idx in range(0, len(data), args['batch_size']):
+            c, attn_mask, _ = gpt2_test_collate_fn_batch(data[idx:idx+args['batch_size']])
+            for t in model.predict_batch(c, args['max_len'], attn_mask=attn_mask):
+                rest.append(t[:t.index(sep_id)] if sep_id in t else t)
+        return rest
+    rest = {}
+    for name, fn in [('one', one_by_one), ('batch', batched)]:
+        outputs, times = timeit(fn, 1, args['seed'])
+        rest[name] = times[0]
+        lengths = [len(i) for i in outputs[0]]
+        print(f'[{name:>8}] {round(times[0], 2)}s, {round(1000 * times[0] / len(data), 2)}ms per context, avg length: {round(np.mean(lengths), 2)}')
+    print(f'[!] speedup: {round(rest["one"] / rest["batch"], 2)}x')
+
+def replay(submit, requests, rate, seed):
+    '''
+    submit the requests with the Poisson arrivals (`rate` requests/sec), wait for all of them;
+    return the latency of each request and the wall-clock time
+    '''
+    rng = random.Random(seed)
+    latencies, futures = [None] * len(requests), []
+    def done(idx, begin):
+        def callback(future):
+            latencies[idx] = time.perf_counter() - begin
+        return callback
+    start = time.perf_counter()
+    for idx, request in enumerate(requests):
+        begin = time.perf_counter()
+        future = submit(request)
+        future.add_done_callback(done(idx, begin))
+        futures.append(future)
+        time.sleep(rng.expovariate(rate))
+    outputs = [f.result() for f in futures]
+    return outputs, latencies, time.perf_counter() - start
+
+def benchmark_engine(args):
+    sep_id = 102
+    model = build_gpt2(args, sep_id=sep_id)
+    torch.manual_seed(args['seed'])
+    # greedy decoding and the deterministic stop, both modes generate the same tokens for each request
+    model.topk = 1
+    if args['stop_prob'] > 0:
+        model.model.lm_head.register_forward_hook(threshold_stop(model, args['stop_prob'], sep_id))
+    requests = [
+        torch.randint(106, args['vocab_size'], (random.randint(args['context_len'] // 2, args['context_len']),))
+        for _ in range(args['requests'])]
+    def request_level(items):
+        c, attn_mask, _ = gpt2_test_collate_fn_batch([{'context_id': i, 'reply_id': i} for i in items])
+        rest = model.predict_batch(c, args['max_len'], attn_mask=attn_mask)
+        return [t[:t.index(sep_id)] if sep_id in t else t for t in rest]
+    scheduler = BatchScheduler(request_level, max_wait=0.005, max_batch=args['batch_size'])
+    engine = GenerationEngine(model, sep_id, max_batch=args['batch_size']).start()
+    print(f'[!] {args["requests"]} requests ({args["context_len"] // 2}-{args["context_len"]} tokens), max_len: {args["max_len"]}, max batch: {args["batch_size"]}, stop prob: {args["stop_prob"]}')
+    for rate in [float(i) for i in args['rates'].split(',')]:
+        line, rest = [], {}
+        for name, submit in [
+                ('request', scheduler.submit),
+                ('engine', lambda ids: engine.submit(ids, args['max_len']))]:
+            outputs, latencies, total = replay(submit, requests, rate, args['seed'])
+            tokens = sum(len(i) for i in outputs)
+            rest[name] = outputs
+            line.append(f'{name}: {round(tokens / total, 2)} tokens/sec, latency avg/p50/p95: {round(np.mean(latencies), 3)}/{round(np.percentile(latencies, 50), 3)}/{round(np.percentile(latencies, 95), 3)}s')
+        same = sum(a == b for a, b in zip(rest['request'], rest['engine']))
+        print(f'[rate {rate:>4}] ' + '; '.join(line) + f'; identical outputs: {same}/{len(requests)}')
+    print(f'[!] engine: {engine.stats()}')
+
+def early_exit_draft(model, layers):
+    '''
+    the first `layers` blocks of the GPT2LMHeadModel, with its embeddings, ln_f and lm head
+    '''
+    config = deepcopy(model.config)
+    config.n_layer = layers
+    draft = GPT2LMHeadModel(config)
+    draft.load_state_dict(model.state_dict(), strict=False)
+    return draft.eval()
+
+def benchmark_speculative(args):
+    model = build_gpt2(args)
+    torch.manual_seed(args['seed'])
+    if args['draft_config']:
+        draft = GPT2(args['vocab_size'], 100, -1, 20, 1.0, 1.0, config_path=args['draft_config']).model.eval()
+        name = args['draft_config']
+    else:
+        draft = early_exit_draft(model.model, args['draft_layers'])
+        name = f'the first {args["draft_layers"]}/{model.model.config.n_layer} blocks'
+    inpt_ids = random_context(args)
+    print(f'[!] draft: {name}, context: {args["context_len"]} tokens, generate: {args["max_len"]} tokens, samples: {args["samples"]}')
+    monitor.enable()
+    for samples in [1, args['samples']]:
+        fn = lambda **kwargs: model.predict(inpt_ids, args['max_len'], **kwargs)
+        if samples > 1:
+            fn = lambda **kwargs: model.predict_batch(inpt_ids.unsqueeze(0), args['max_len'], samples=samples, **kwargs)
+        fn()    # warm up
+        _, times = timeit(fn, args['runs'], args['seed'])
+        base = np.mean(times)
+        print(f'[samples {samples:>2}] baseline: {round(base, 4)}s per run')
+        for k in [int(i) for i in args['ks'].split(',')]:
+            monitor.reset()
+            _, times = timeit(lambda: fn(draft=draft, k=k), args['runs'], args['seed'])
+            counter = lambda key: monitor.counters[(key, '', '')]
+            print(f'[samples {samples:>2}][k {k}] acceptance: {round(counter("speculative_accepted") / max(1, counter("speculative_proposed")), 4)}, tokens per step: {round(counter("speculative_emitted") / max(1, counter("speculative_steps")) / samples, 2)}, {round(np.mean(times), 4)}s per run, speedup: {round(base / np.mean(times), 2)}x')
+    monitor.enable(False)
+
+@torch.no_grad()
+def candidate_scores(model, inpt_ids, candidates):
+    '''
+    the length normalized log probs (length penalty 1) of the candidates under the model, with the
+    [UNK] ban and the repetition penalty of the beam search
+    '''
+    pipeline = LogitsPipeline.build(banned=[model.unk_id], repetition_penalty=model.repetition_penalty)
+    scores = []
+    for candidate in candidates:
+        ids = torch.cat((inpt_ids, torch.LongTensor(candidate)))
+        logits = model.model(input_ids=ids)[0][len(inpt_ids)-1:-1]    # [len, vocab]
+        state, score = pipeline.init_state(logits[:1]), 0
+        for token, logits_ in zip(candidate, logits):
+            score += F.log_softmax(pipeline(logits_.unsqueeze(0), state), dim=-1)[0, token].item()
+            state.update(torch.LongTensor([[token]]))
+        scores.append(score / len(candidate))
+    return scores
+
+def benchmark_beam(args):
+    model = build_gpt2(args)
+    inpt_ids = random_context(args)
+    modes = [('sampling', args['samples'], 1)]
+    for beam in [int(i) for i in args['beams'].split(',')]:
+        modes.append(('beam', beam, 1))
+        if beam % args['beam_groups'] == 0 and beam > args['beam_groups']:
+            modes.append(('diverse_beam', beam, args['beam_groups']))
+    print(f'[!] context: {args["context_len"]} tokens, generate: {args["max_len"]} tokens')
+    for name, width, groups in modes:
+        if name == 'sampling':
+            fn = lambda: model.predict_batch(inpt_ids.unsqueeze(0), args['max_len'], samples=width)
+        else:
+            fn = lambda: model.predict_beam(
+                    inpt_ids.unsqueeze(0), args['max_len'], 
+                    beam_size=width, groups=groups, diversity=args['diversity_penalty'])[0]
+        fn()    # warm up
+        outputs, times = timeit(fn, args['runs'], args['seed'])
+        candidates = outputs[-1]
+        scores = candidate_scores(model, inpt_ids, candidates)
+        distinct = len(set(tuple(i) for i in candidates))
+        print(f'[{name:<12}][width {width:>2}, groups {groups}] {round(np.mean(times), 4)}s per run; candidates: {len(candidates)}, distinct: {distinct}; log prob mean: {round(np.mean(scores), 4)}, best: {round(max(scores), 4)}')
+
+@torch.no_grad()
+def benchmark_shortlist(args):
+    model = build_gpt2(args)
+    torch.manual_seed(args['seed'])
+    # the frequency list of the top-k tokens on the calibration contexts
+    counter = Counter()
+    for _ in range(0, args['contexts'], 16):
+        inpt_ids = torch.randint(106, args['vocab_size'], (16, args['context_len']))
+        counter.update(model.model(input_ids=inpt_ids)[0].topk(model.topk, dim=-1)[1].view(-1).tolist())
+    frequent = [i for i, _ in counter.most_common()]
+    print(f'[!] calibration: {len(counter)} distinct top-{model.topk} tokens on {args["contexts"]} contexts')
+    contexts = [random_context(args).unsqueeze(0) for _ in range(args['runs'])]
+    shortlists = [(0, None)] + [
+            (size, VocabShortlist(frequent[:size], unk_id=model.unk_id)) 
+            for size in [int(i) for i in args['shortlist_sizes'].split(',')]]
+    base = None
+    for size, shortlist in shortlists:
+        fn = lambda x: model.predict_batch(x, args['max_len'], samples=args['samples'], shortlist=shortlist)
+        fn(contexts[0])    # warm up
+        times, missed, total = [], 0, 0
+        for idx, inpt_ids in enumerate(contexts):
+            torch.manual_seed(args['seed'] + idx)
+            begin = time.perf_counter()
+            generated = fn(inpt_ids)
+            times.append(time.perf_counter() - begin)
+            # the argmax of the full vocabulary at the generated positions
+            ids = torch.cat((inpt_ids.expand(len(generated), -1), torch.LongTensor(generated)), dim=1)
+            argmax = model.model(input_ids=ids)[0][:, inpt_ids.shape[1]-1:-1].argmax(dim=-1)    # [samples, max_len]
+            if shortlist is not None:
+                allowed = torch.zeros(args['vocab_size'], dtype=torch.bool)
+                allowed[shortlist.extend(inpt_ids)] = True
+                missed += (~allowed[argmax]).sum().item()
+            total += argmax.numel()
+        base = base or np.mean(times)
+        name = f'shortlist {len(shortlist)}' if shortlist is not None else 'full vocab'
+        print(f'[{name:<15}] {round(np.mean(times), 4)}s per run, speedup: {round(base / np.mean(times), 2)}x, argmax miss rate: {round(missed / total, 4)}')
+
+def random_text(length):
+    chars = '我你他喜欢看电影音乐好的吗呢今天天气真不错吃饭了没有哈'
+    return ''.join(random.choice(chars) for _ in range(length))
+
+def legacy_mmi_scores(model, sources, targets):
+    '''
+    the old MMI.scores: one GPT2 forward for each (context, candidate) pair
+    '''
+    return [np.mean(model.score(s, t)) for s, t in zip(sources, targets)]
+
+@torch.no_grad()
+def benchmark_mmi(args):
+    from multiview import MMI
+    model = MMI()
+    model.model.eval()
+    random.seed(args['seed'])
+    # the candidates of one context, and one context that is too long (>= 300 tokens)
+    sources = [random_text(args['context_len'] // 2)] * (args['samples'] - 1) + [random_text(320)]
+    targets = [random_text(random.randint(1, args['max_len'])) for _ in range(args['samples'])]
+    old, old_times = timeit(lambda: legacy_mmi_scores(model, sources, targets), args['runs'], args['seed'])
+    new, new_times = timeit(lambda: model.scores(sources, targets), args['runs'], args['seed'])
+    diff = max(abs(a - b) for a, b in zip(old[-1], new[-1]))
+    print(f'[!] {args["samples"]} pairs; one forward for each pair: {round(np.mean(old_times), 4)}s, right padded chunks: {round(np.mean(new_times), 4)}s, speedup: {round(np.mean(old_times) / np.mean(new_times), 2)}x; max difference of the scores: {diff}')
+
+def legacy_fluency_scores(model, msgs, resps):
+    '''
+    the old SAFETY_FLUENCY.scores: one GPT2 forward of `context + response` for each pair
+    '''
+    return [np.mean(model.score(m, r)) for m, r in zip(msgs, resps)]
+
+@torch.no_grad()
+def benchmark_fluency(args):
+    from multiview import SAFETY_FLUENCY
+    model = SAFETY_FLUENCY()
+    model.model.eval()
+    random.seed(args['seed'])
+    msgs = [random_text(args['context_len'] // 2)] * args['samples']
+    resps = [random_text(random.randint(1, args['max_len'])) for _ in range(args['samples'])]
+    old, old_times = timeit(lambda: legacy_fluency_scores(model, msgs, resps), args['runs'], args['seed'])
+    new, new_times = timeit(lambda: model.scores(msgs, resps), args['runs'], args['seed'])
+    diff = max(abs(a - b) for a, b in zip(old[-1], new[-1]))
+    print(f'[!] {args["samples"]} candidates of one context; one forward for each pair: {round(np.mean(old_times), 4)}s, shared context: {round(np.mean(new_times), 4)}s, speedup: {round(np.mean(old_times) / np.mean(new_times), 2)}x; max difference of the scores: {diff}')
+
+def legacy_tokenize(tokenizers, context, responses, history):
+    '''
+    the old tokenization of MultiView.forward, each sub-model tokenizes its own inputs;
+    return the number of the tokenizer calls
+    '''
+    bert, cut, thu = tokenizers['bert'], tokenizers['jieba'], tokenizers['thulac']
+    calls = 0
+    for r in responses:
+        cut(r)    # topic
+        bert(f'{context} [SEP] {r}')    # coherence
+        bert(context), bert(r)    # mmi
+        bert(r)    # fluency
+        cut(r.replace('[SEP]', ''))    # distinct
+        cut(context), cut(r), cut(r)    # repetition penalty (context and inner)
+        thu(r)    # nidf_tf
+        calls += 10
+    bert(context)    # fluency, the context is encoded once for its candidates
+    for h in history:
+        cut(h)    # distinct, once for the shared history
+    return calls + 1 + len(history)
+
+def shared_tokenize(tokenizers, context, responses, history):
+    '''
+    the tokenization of MultiView.forward with the TextFeatures bundle (the same calls of the sub-models)
+    '''
+    from multiview.utils import TextFeatures
+    features = TextFeatures(tokenizers)
+    for r in responses:
+        features.jieba(r)
+        features.bert(context) + features.bert(r)[1:]
+        features.bert(context), features.bert(r)
+        features.jieba(r.replace('[SEP]', ''))
+        features.jieba(context), features.jieba(r)
+        features.thulac(r)
+    for h in history:
+        features.jieba(h)
+    return features
+
+def benchmark_tokenize(args):
+    import jieba, thulac
+    vocab = BertTokenizer(vocab_file='data/vocab/vocab_small')
+    cutter = thulac.thulac(seg_only=True)
+    tokenizers = {
+            'bert': vocab.encode,
+            'jieba': lambda s: list(jieba.cut(s)),
+            'thulac': lambda s: [i[0] for i in cutter.cut(s)]}
+    random.seed(args['seed'])
+    utterances = [random_text(args['context_len'] // 4) for _ in range(4)]
+    context = ' [SEP] '.join(utterances)
+    responses = [random_text(random.randint(1, args['max_len'])) for _ in range(args['samples'])]
+    history = utterances[1::2]
+    # warm up the dictionaries of jieba and thulac
+    for fn in tokenizers.values():
+        fn(context)
+    calls, old_times = timeit(lambda: legacy_tokenize(tokenizers, context, responses, history), args['runs'], args['seed'])
+    features, new_times = timeit(lambda: shared_tokenize(tokenizers, context, responses, history), args['runs'], args['seed'])
+    features = features[-1]
+    same = all(
+            features.bert(context) + features.bert(r)[1:] == vocab.encode(f'{context} [SEP] {r}') for r in responses)
+    print(f'[!] {args["samples"]} candidates of one context; each sub-model tokenizes: {calls[-1]} calls, {round(np.mean(old_times), 4)}s; shared features: {sum(features.calls.values())} calls ({dict(features.calls)}), {round(np.mean(new_times), 4)}s, speedup: {round(np.mean(old_times) / np.mean(new_times), 2)}x; same coherence ids: {same}')
+
+def legacy_nidf_scores(words, idf_count, tf_count, responses, topk=3, factor_tf=0.5, factor_idf=0.5):
+    '''
+    the old NIDF_TF.scores on the tokenized responses (the data.pkl statistic): list lookups of the words for each token
+    '''
+    idf_max, idf_min = max(idf_count), min(idf_count)
+    scores = []
+    for response in responses:
+        response = [j for j in response if j in words]
+        p_tf = [tf_count[words.index(w)] for w in response]
+        p_tf = np.mean(p_tf) if p_tf else 0
+        p_idf = [(idf_count[words.index(w)] - idf_min) / (idf_max - idf_min) for w in set(response)]
+        p_idf = np.mean(sorted(p_idf, reverse=True)[:topk]) if p_idf else 0
+        scores.append(factor_tf * p_tf + factor_idf * p_idf)
+    return scores
+
+def benchmark_nidf(args):
+    import tempfile
+    from multiview import NIDF_TF
+    from multiview.utils import TextFeatures
+    random.seed(args['seed'])
+    np.random.seed(args['seed'])
+    responses = [random_text(random.randint(1, args['max_len'])) for _ in range(args['samples'])]
+    model = NIDF_TF.__new__(NIDF_TF)
+    model._cutter = None
+    features = TextFeatures({'thulac': lambda s: [i[0] for i in model.cutter.cut(s)]})
+    tokens = [features.thulac(i) for i in responses]
+    # the words of the responses and the filler words (shuffled, the order is not relied on)
+    words = sorted({w for i in tokens for w in i})
+    words = sorted(set(words + [f'w{i}' for i in range(args['vocab_words'] - len(words))]))
+    random.shuffle(words)
+    doc_freq = np.random.randint(4, 50000, size=len(words)) + 1
+    whole_doc = 500000
+    idf_count, tf_count = np.log(whole_doc / doc_freq), doc_freq / doc_freq.sum()
+    with tempfile.TemporaryDirectory() as path:
+        model.args = {'rest_path': path, 'factor_tf': 0.5, 'factor_idf': 0.5}
+        with open(f'{path}/data.pkl', 'wb') as f:
+            pickle.dump((words, whole_doc, idf_count, tf_count), f)
+        begin = time.perf_counter()
+        with open(f'{path}/data.pkl', 'rb') as f:
+            pickle.load(f)
+        old_load = time.perf_counter() - begin
+        model._convert()
+        begin = time.perf_counter()
+        model._load()
+        new_load = time.perf_counter() - begin
+        model.scores(responses[:1], features=features)    # warm up (the lazy imports of numpy)
+        old, old_times = timeit(lambda: legacy_nidf_scores(words, idf_count, tf_count, tokens), args['runs'], args['seed'])
+        new, new_times = timeit(lambda: model.scores(responses, features=features), args['runs'], args['seed'])
+        sizes = [os.path.getsize(f'{path}/{i}') for i in ['data.pkl', 'words.npy', 'nidf.npy', 'ntf.npy']]
+    diff = max(abs(a - b) for a, b in zip(old[-1], new[-1]))
+    print(f'[!] {len(words)} words, {args["samples"]} candidates; list lookups: {round(np.mean(old_times), 4)}s, array index: {round(np.mean(new_times), 4)}s, speedup: {round(np.mean(old_times) / np.mean(new_times), 2)}x; max difference of the scores: {diff}')
+    print(f'[!] load time, data.pkl: {round(old_load, 4)}s ({sizes[0]} bytes), memory mapped arrays: {round(new_load, 4)}s ({sum(sizes[1:])} bytes)')
+
+if __name__ == "__main__":
+    args = vars(parser_args())
+    if args['threads'] > 0:
+        torch.set_num_threads(args['threads'])
+    if args['mode'] == 'kv_cache':
+        benchmark_kv_cache(args)
+    elif args['mode'] == 'shrink':
+        benchmark_shrink(args)
+    elif args['mode'] == 'prefill':
+        benchmark_prefill(args)
+    elif args['mode'] == 'prefix_cache':
+        benchmark_prefix_cache(args)
+    elif args['mode'] == 'sampling':
+        benchmark_sampling(args)
+    elif args['mode'] == 'test_batch':
+        benchmark_test_batch(args)
+    elif args['mode'] == 'engine':
+        benchmark_engine(args)
+    elif args['mode'] == 'speculative':
+        benchmark_speculative(args)
+    elif args['mode'] == 'beam':
+        benchmark_beam(args)
+    elif args['mode'] == 'shortlist':
+        benchmark_shortlist(args)
+    elif args['mode'] == 'mmi':
+        benchmark_mmi(args)
+    elif args['mode'] == 'fluency':
+        benchmark_fluency(args)
+    elif args['mode'] == 'tokenize':
+        benchmark_tokenize(args)
+    elif args['mode'] == 'nidf':
+        benchmark_nidf(args)
+    else:
+        raise Exception(f'[!] unknown benchmark mode {args["mode"]}')
@@ -8,7 +8,6 @@ import random
 import jieba
 import json
 import os
-import ipdb
 from utils import *
 
 '''
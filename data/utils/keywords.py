@@ -1,9 +1,6 @@
 import jieba
 import pickle
 from tqdm import tqdm
-import ipdb
-import jieba.analyse
-import networkx as nx
 
 class KeywordsCollector:
 
@@ -12,12 +9,16 @@ class KeywordsCollector:
     '''
 
     def __init__(self):
+        # networkx is only needed by the keywords collector
+        import networkx as nx
         self.allowpos = [
                 'n', 'nr', 'nt', 'nw']
         self.topk = 5
         self.g = nx.Graph()
 
     def process_dataset(self, corpus):
+        # jieba.analyse loads the IDF and POS dictionaries
+        import jieba.analyse
         pbar = tqdm(corpus)
         counter = 0
         for context, response in pbar:
@@ -40,6 +41,7 @@ class KeywordsCollector:
                 self.g.remove_edge(i, i)
 
     def obtain_neighboors(self, node):
+        import ipdb
         ipdb.set_trace()
         data = self.g[node]
 
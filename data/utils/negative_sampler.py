@@ -1,10 +1,7 @@
 import random
 from tqdm import tqdm
-import ipdb
 import json
 import numpy as np
-from gensim.summarization import bm25
-from bert_serving.client import BertClient
 import jieba
 
 def generate_negative_samples(r, responses, samples=10):
@@ -14,6 +11,9 @@ def generate_negative_samples(r, responses, samples=10):
     return negative
 
 def generate_negative_samples_bm25(responses, samples=10, lang='zh', bert=False):
+    # gensim and bert_serving are slow to import, only load them for the bm25 negative sampling
+    from gensim.summarization import bm25
+    from bert_serving.client import BertClient
     if bert:
         print(f'[!] Make sure the bert-as-service is running; language is {lang}')
         bc = BertClient()
@@ -1,40 +1,47 @@
+# the heavy dependencies are imported when they are used for the first time (lazy.py)
+from lazy import lazy_import, lazy_from, import_report
 import torch
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
 from torch.nn.utils import clip_grad_norm_
 from torch.nn import DataParallel
 from torch.optim import lr_scheduler
-from torch.utils.tensorboard import SummaryWriter
+SummaryWriter = lazy_from('torch.utils.tensorboard', 'SummaryWriter')
 import torch.optim as optim
 import torch.nn as nn
 import torch.nn.functional as F
-from torchtext import vocab
-from collections import Counter
+vocab = lazy_import('torchtext.vocab')
+from collections import Counter, OrderedDict
 from tqdm import tqdm
 import os
 import csv
-import jieba
-from jieba import analyse
+jieba = lazy_import('jieba', submodules=['analyse'])
+analyse = lazy_import('jieba.analyse')
 import random
 import json
 import time
 import hashlib
-import pymongo
+pymongo = lazy_import('pymongo')
 import logging
-import gensim
+gensim = lazy_import('gensim')
 import xml.etree.ElementTree as ET
 from copy import deepcopy
-from flask import Flask, jsonify, request, make_response
-from bert_serving.client import BertClient
-import ipdb
-from transformers.modeling_gpt2 import GPT2Config, GPT2LMHeadModel
-from transformers import BertTokenizer
+Flask = lazy_from('flask', 'Flask')
+Response = lazy_from('flask', 'Response')
+jsonify = lazy_from('flask', 'jsonify')
+request = lazy_from('flask', 'request')
+make_response = lazy_from('flask', 'make_response')
+BertClient = lazy_from('bert_serving.client', 'BertClient')
+ipdb = lazy_import('ipdb')
+GPT2Config = lazy_from('transformers.modeling_gpt2', 'GPT2Config')
+GPT2LMHeadModel = lazy_from('transformers.modeling_gpt2', 'GPT2LMHeadModel')
+BertTokenizer = lazy_from('transformers', 'BertTokenizer')
 import pickle
 import argparse
 from torch.nn.utils.rnn import pad_sequence
-from data import generate_negative_samples
-from models.model_utils import ESChat
-from elasticsearch import Elasticsearch
+generate_negative_samples = lazy_from('data', 'generate_negative_samples')
+ESChat = lazy_from('models.model_utils', 'ESChat')
+Elasticsearch = lazy_from('elasticsearch', 'Elasticsearch')
 
 logging.getLogger("elasticsearch").setLevel(logging.WARNING)
 logging.getLogger("transformers").setLevel(logging.WARNING)
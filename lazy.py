@@ -0,0 +1,144 @@
+import re
+import sys
+import time
+import argparse
+import importlib
+import subprocess
+from collections import defaultdict
+
+'''
+Lazy import layer for the heavy dependencies (fast startup)
+
+1. jieba = lazy_import('jieba', submodules=['analyse']): the proxy of the module,
+   the module is imported when one of its attributes is used for the first time
+2. Flask = lazy_from('flask', 'Flask'): the proxy of the object (class/function) in the module,
+   the module is imported when the object is called or one of its attributes is used
+   NOTE: the proxy can not be used as the base class or in isinstance, import these names eagerly
+3. import_report(): the time of the lazy imports that are triggered by the code paths
+4. python lazy.py "import eval": the import time (-X importtime) of each top-level package
+'''
+
+# module name -> the time (seconds) of the import
+import_times = {}
+
+def _import(name, submodules=()):
+    begin = time.perf_counter()
+    module = importlib.import_module(name)
+    for submodule in submodules:
+        importlib.import_module(f'{name}.{submodule}')
+    import_times.setdefault(name, time.perf_counter() - begin)
+    return module
+
+class LazyModule:
+
+    def __init__(self, name, submodules=()):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_submodules', submodules)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        module = object.__getattribute__(self, '_module')
+        if module is None:
+            module = _import(self._name, self._submodules)
+            object.__setattr__(self, '_module', module)
+        return module
+
+    def __getattr__(self, key):
+        return getattr(self._load(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self._load(), key, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if object.__getattribute__(self, '_module') else 'not loaded'
+        return f'<lazy module {self._name} ({state})>'
+
+class LazyObject:
+
+    def __init__(self, module, name):
+        object.__setattr__(self, '_module', module)
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_object', None)
+
+    def _load(self):
+        obj = object.__getattribute__(self, '_object')
+        if obj is None:
+            obj = getattr(_import(self._module), self._name)
+            object.__setattr__(self, '_object', obj)
+        return obj
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, key):
+        return getattr(self._load(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self._load(), key, value)
+
+    def __repr__(self):
+        state = 'loaded' if object.__getattribute__(self, '_object') is not None else 'not loaded'
+        return f'<lazy object {self._module}.{self._name} ({state})>'
+
+def lazy_import(name, submodules=()):
+    '''
+    if the module is already imported, return it directly
+    '''
+    if name in sys.modules and all(f'{name}.{i}' in sys.modules for i in submodules):
+        return sys.modules[name]
+    return LazyModule(name, submodules=tuple(submodules))
+
+def lazy_from(module, name):
+    if module in sys.modules and hasattr(sys.modules[module], name):
+        return getattr(sys.modules[module], name)
+    return LazyObject(module, name)
+
+def import_report():
+    '''
+    the lazy imports triggered during the running, sorted by the import time
+    '''
+    lines = ['========== Lazy Imports ==========']
+    for name, t in sorted(import_times.items(), key=lambda i: -i[1]):
+        lines.append(f'{name}: {round(t, 4)}s')
+    lines.append('========== Lazy Imports ==========')
+    return '\n'.join(lines)
+
+def importtime_report(statement, topk=20):
+    '''
+    run the statement with `python -X importtime` in a new process,
+    and sum the self time of the modules for each top-level package
+    '''
+    begin = time.time()
+    rest = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', statement],
+            capture_output=True, text=True)
+    total = time.time() - begin
+    self_time, cumulative = defaultdict(int), {}
+    pattern = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+    for line in rest.stderr.split('\n'):
+        m = pattern.match(line)
+        if not m:
+            continue
+        s, c, indent, name = int(m.group(1)), int(m.group(2)), len(m.group(3)), m.group(4)
+        package = name.split('.')[0]
+        self_time[package] += s
+        # the outermost import of the package
+        if package not in cumulative or indent <= cumulative[package][1]:
+            cumulative[package] = (max(c, cumulative.get(package, (0, 0))[0]), indent)
+    if rest.returncode != 0:
+        print(f'[!] the statement failed:\n{rest.stderr.strip().split(chr(10))[-1]}')
+    print(f'========== Import Time: {statement} ==========')
+    print(f'{"package":<30}{"self (s)":>12}{"cumulative (s)":>18}')
+    for package, s in sorted(self_time.items(), key=lambda i: -i[1])[:topk]:
+        print(f'{package:<30}{s/1e6:>12.3f}{cumulative[package][0]/1e6:>18.3f}')
+    print(f'[!] total wall time of the process: {round(total, 2)}s')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='import time report')
+    parser.add_argument('statement', type=str, nargs='?', default='from header import *')
+    parser.add_argument('--topk', type=int, default=20)
+    args = parser.parse_args()
+    importtime_report(args.statement, topk=args.topk)
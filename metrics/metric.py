@@ -1,20 +1,19 @@
-from nltk.translate.bleu_score import sentence_bleu, corpus_bleu
-from nltk.translate.bleu_score import SmoothingFunction
-from nltk.collocations import BigramCollocationFinder
-from nltk.probability import FreqDist
+from lazy import lazy_import, lazy_from
+sentence_bleu = lazy_from('nltk.translate.bleu_score', 'sentence_bleu')
+corpus_bleu = lazy_from('nltk.translate.bleu_score', 'corpus_bleu')
+SmoothingFunction = lazy_from('nltk.translate.bleu_score', 'SmoothingFunction')
+BigramCollocationFinder = lazy_from('nltk.collocations', 'BigramCollocationFinder')
+FreqDist = lazy_from('nltk.probability', 'FreqDist')
 from .bleu import Bleu
 import argparse
 import codecs
 import numpy as np
 import math
-try:
-    from bert_score import score
-except:
-    print(f'[!] Loading bert_score module error')
-    pass
-from rouge import Rouge
+# bert_score is imported when the BERTScore is calculated
+score = lazy_from('bert_score', 'score')
+Rouge = lazy_from('rouge', 'Rouge')
 import os, re
-import ipdb
+ipdb = lazy_import('ipdb')
 import numpy as np
 
 def cal_length(sentences):
@@ -5,6 +5,7 @@ from .gpt2retrieval import *
 from .pf_gpt2 import *
 from .kwgpt2 import *
 from .when2talk import *
+from .engine import *
 from .gpt2gan import *
 from .gpt2gan_v2 import *
 from .bert_retrieval import *
@@ -7,7 +7,8 @@ Base Agent
 class BaseAgent:
 
     def __init__(self):
-        self.history = []
+        # conversation history of each session (group_id)
+        self.sessions = SessionStore()
         # trigger utterances
         self.trigger_utterances = load_topic_utterances('data/topic/train.txt')
 
@@ -64,10 +65,11 @@ class BaseAgent:
     def test_model(self, test_iter, path):
         raise NotImplementedError
 
-    def talk(self, topic, msgs):
+    def talk(self, topic, msgs, history=None):
         '''
         topic: topic of the conversation
         msgs: a string of the conversation context
+        history: the history of the session (the utterances that are talked by the agent)
         '''
         raise NotImplementedError
 
@@ -88,20 +90,65 @@ class BaseAgent:
             ]
         }
         '''
-        topic = data['topic']
-        msgs = [i['msg'] for i in data['msgs']]
-        msgs = '[SEP]'.join(msgs)
-        # feed the model and obtain the result
-        res = self.talk(topic, msgs)
-        self.history.append(res)
+        return self.get_res_batch([data])[0]
+
+    def talk_batch(self, topics, msgs, histories=None, deadline=None):
+        '''
+        topics: a batch of the topics
+        msgs: a batch of the conversation contexts (from different conversations)
+        histories: a batch of the history of the sessions
+        deadline: the Deadline of the batch (the degradation ladder), None means no time budget
+        the agents that support the batched inference should overwrite this function
+        '''
+        histories = histories if histories else [None] * len(msgs)
+        return [self.talk(topic, msg, history=history) for topic, msg, history in zip(topics, msgs, histories)]
+
+    def get_res_batch(self, data):
+        '''
+        data: a batch of the SMP-MCC requests (the format is the same as get_res),
+        which is collected by the BatchScheduler
+        '''
+        topics = [i['topic'] for i in data]
+        msgs = ['[SEP]'.join([j['msg'] for j in i['msgs']]) for i in data]
+        histories = [self.sessions.history(i.get('group_id')) for i in data]
+        deadline = Deadline.tightest([i.get('deadline') for i in data])
+        # feed the model and obtain the results
+        res = self.talk_batch(topics, msgs, histories=histories, deadline=deadline)
+        for i, r in zip(data, res):
+            self.sessions.append(i.get('group_id'), r)
         return res
 
+    def talk_stream(self, topic, msgs, history=None):
+        '''
+        yield the pieces of the response once they are generated,
+        the agents that support the streaming generation should overwrite this function
+        '''
+        yield self.talk(topic, msgs, history=history)
+
+    def get_res_stream(self, data):
+        '''
+        same as get_res, but yield the pieces of the response (server-sent events API),
+        the generation stops if the stream is closed (client disconnects), and the response
+        is saved into the session history only if it is completed
+        '''
+        msgs = '[SEP]'.join([i['msg'] for i in data['msgs']])
+        history = self.sessions.history(data.get('group_id'))
+        stream, pieces = self.talk_stream(data['topic'], msgs, history=history), []
+        try:
+            for piece in stream:
+                pieces.append(piece)
+                yield piece
+        finally:
+            stream.close()
+        self.sessions.append(data.get('group_id'), ''.join(pieces))
+
 class RetrievalBaseAgent:
 
     def __init__(self, searcher=True, kb=True):
         if searcher:
             self.searcher = ESChat('retrieval_database', kb=kb)
-        self.history = []    # save the history during the SMP-MCC test
+        # save the history of each session (group_id) during the SMP-MCC test
+        self.sessions = SessionStore()
 
     def show_parameters(self, args):
         print('========== Model ==========')
@@ -148,26 +195,34 @@ class RetrievalBaseAgent:
     def test_model(self, test_iter, path):
         raise NotImplementedError
 
-    def process_utterances(self, topic, msgs):
+    def process_utterances(self, topic, msgs, pad=True, history=None, samples=None):
         '''
         Process the utterances searched by Elasticsearch
+        pad: if False, return the list of the LongTensor without padding (for talk_batch)
+        history: the history of the session
+        samples: the number of the candidates, default is talk_samples
         '''
-        utterances_ = self.searcher.search(topic, msgs, samples=self.args['talk_samples'])
+        samples = samples if samples else self.args['talk_samples']
+        utterances_ = self.searcher.search(topic, msgs, samples=samples)
         utterances_ = [i['response'] for i in utterances_]
-        # remove the utterances that in the self.history
-        utterances_ = list(set(utterances_) - set(self.history))
+        # remove the utterances that in the history of the session
+        utterances_ = list(set(utterances_) - set(history or []))
         utterances = [f'{msgs} [SEP] {i}' for i in utterances_]
         # 512 length limitations for BERT Module
-        ids = [torch.LongTensor(self.vocab.encode(i)[-512:]) for i in utterances_]
+        with monitor.span('tokenize'):
+            ids = [torch.LongTensor(self.vocab.encode(i)[-512:]) for i in utterances_]
+        if not pad:
+            return utterances_, ids
         ids = pad_sequence(ids, batch_first=True, padding_value=self.args['pad'])
         if torch.cuda.is_available():
             ids = ids.cuda()
         return utterances_, ids
 
-    def talk(self, topic, msgs):
+    def talk(self, topic, msgs, history=None):
         '''
         topic: topic of the conversation
         msgs: a string of the conversation context
+        history: the history of the session (the utterances that are talked by the agent)
         '''
         raise NotImplementedError
 
@@ -188,10 +243,54 @@ class RetrievalBaseAgent:
             ]
         }
         '''
-        topic = data['topic']
-        msgs = [i['msg'] for i in data['msgs']]
-        msgs = '[SEP]'.join(msgs)
-        # feed the model and obtain the result
-        res = self.talk(topic, msgs)
-        self.history.append(res)
+        return self.get_res_batch([data])[0]
+
+    def talk_batch(self, topics, msgs, histories=None, deadline=None):
+        '''
+        topics: a batch of the topics
+        msgs: a batch of the conversation contexts (from different conversations)
+        histories: a batch of the history of the sessions
+        deadline: the Deadline of the batch (the degradation ladder), None means no time budget
+        the agents that support the batched inference should overwrite this function
+        '''
+        histories = histories if histories else [None] * len(msgs)
+        return [self.talk(topic, msg, history=history) for topic, msg, history in zip(topics, msgs, histories)]
+
+    def get_res_batch(self, data):
+        '''
+        data: a batch of the SMP-MCC requests (the format is the same as get_res),
+        which is collected by the BatchScheduler
+        '''
+        topics = [i['topic'] for i in data]
+        msgs = ['[SEP]'.join([j['msg'] for j in i['msgs']]) for i in data]
+        histories = [self.sessions.history(i.get('group_id')) for i in data]
+        deadline = Deadline.tightest([i.get('deadline') for i in data])
+        # feed the model and obtain the results
+        res = self.talk_batch(topics, msgs, histories=histories, deadline=deadline)
+        for i, r in zip(data, res):
+            self.sessions.append(i.get('group_id'), r)
         return res
+
+    def talk_stream(self, topic, msgs, history=None):
+        '''
+        yield the pieces of the response once they are generated,
+        the agents that support the streaming generation should overwrite this function
+        '''
+        yield self.talk(topic, msgs, history=history)
+
+    def get_res_stream(self, data):
+        '''
+        same as get_res, but yield the pieces of the response (server-sent events API),
+        the generation stops if the stream is closed (client disconnects), and the response
+        is saved into the session history only if it is completed
+        '''
+        msgs = '[SEP]'.join([i['msg'] for i in data['msgs']])
+        history = self.sessions.history(data.get('group_id'))
+        stream, pieces = self.talk_stream(data['topic'], msgs, history=history), []
+        try:
+            for piece in stream:
+                pieces.append(piece)
+                yield piece
+        finally:
+            stream.close()
+        self.sessions.append(data.get('group_id'), ''.join(pieces))
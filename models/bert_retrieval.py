@@ -45,6 +45,8 @@ class BERTRetrievalAgent(RetrievalBaseAgent):
                 'samples': 10,
                 'multi_gpu': self.gpu_ids,
                 'talk_samples': 256,
+                'talk_samples_reduced': 64,
+                'talk_batch_size': 512,
                 'vocab_file': 'data/vocab/vocab_small',
                 'pad': 0,
                 'model': 'bert-base-chinese',
@@ -120,17 +122,63 @@ class BERTRetrievalAgent(RetrievalBaseAgent):
         print(f'[TEST] P@1: {p_1}; R2@1: {r2_1}; R10@1: {r10_1}; R10@2: {r10_2}; R10@5: {r10_5}; MAP: {MAP}; MRR: {MRR}')
         return round(total_loss/batch_num, 4)
 
-    def talk(self, topic, msgs):
+    def talk(self, topic, msgs, history=None):
         with torch.no_grad():
             # retrieval and process
-            utterances_, ids = self.process_utterances(topic, msgs)
+            utterances_, ids = self.process_utterances(topic, msgs, history=history)
+            monitor.record('candidates', len(utterances_))
             # rerank, ids: [batch, seq]
-            output = self.model(ids)    # [batch, 2]
-            output = F.softmax(output, dim=-1)[:, 1]    # [batch]
+            with monitor.span('bert_scoring'):
+                output = self.model(ids)    # [batch, 2]
+                output = F.softmax(output, dim=-1)[:, 1]    # [batch]
             item = torch.argmax(output).item()
             msg = utterances_[item]
             return msg
 
+    @torch.no_grad()
+    def talk_batch(self, topics, msgs, histories=None, deadline=None):
+        '''
+        rerank the candidates of all the conversations in the batch together,
+        the BERT model is fed with the chunks of `talk_batch_size` candidates
+        deadline: fewer candidates are scored (reduced), or the plain ES answer is used (fallback)
+        '''
+        histories = histories if histories else [None] * len(msgs)
+        rung = obtain_rung(deadline)
+        if rung == 3:
+            record_rung(rung, len(msgs))
+            return [self.searcher.fallback(topic, msg, history=history) for topic, msg, history in zip(topics, msgs, histories)]
+        samples = self.args['talk_samples'] if rung == 0 else self.args['talk_samples_reduced']
+        utterances, ids = [], []
+        for topic, msg, history in zip(topics, msgs, histories):
+            utterances_, ids_ = self.process_utterances(topic, msg, pad=False, history=history, samples=samples)
+            utterances.append(utterances_)
+            ids.extend(ids_)
+            monitor.record('candidates', len(utterances_))
+        scores = []
+        for idx in range(0, len(ids), self.args['talk_batch_size']):
+            ids_ = pad_sequence(
+                    ids[idx:idx+self.args['talk_batch_size']],
+                    batch_first=True,
+                    padding_value=self.args['pad'])
+            if torch.cuda.is_available():
+                ids_ = ids_.cuda()
+            with monitor.span('bert_scoring'):
+                output = self.model(ids_)    # [batch, 2]
+                output = F.softmax(output, dim=-1)[:, 1]    # [batch]
+                scores.extend(output.tolist())
+        # split the scores for each conversation
+        rest, begin = [], 0
+        for topic, msg, history, utterances_ in zip(topics, msgs, histories, utterances):
+            if not utterances_:
+                # all the hits are used by the session
+                rest.append(self.searcher.fallback(topic, msg, history=history))
+                continue
+            scores_ = scores[begin:begin+len(utterances_)]
+            rest.append(utterances_[int(np.argmax(scores_))])
+            begin += len(utterances_)
+        record_rung(rung, len(msgs))
+        return rest
+
     def reverse_search(self, ctx, ctx_, res):
         '''
         ctx/res: a list of string
@@ -151,10 +151,10 @@ class BERTRetrievalMultiAgent(RetrievalBaseAgent):
             print(f'[TEST] P@1: {p_1}; R2@1: {r2_1}; R10@1: {r10_1}; R10@2: {r10_2}; R10@5: {r10_5}; MAP: {MAP}; MRR: {MRR}')
         return round(total_loss/batch_num, 4)
 
-    def talk(self, topic, msgs):
+    def talk(self, topic, msgs, history=None):
         with torch.no_grad():
             # retrieval and process
-            utterances_, ids = self.process_utterances(topic, msgs)
+            utterances_, ids = self.process_utterances(topic, msgs, history=history)
             # rerank, ids: [batch, seq]
             output = self.model(ids)    # [batch, 2]
             output = F.softmax(output, dim=-1)[:, 1]    # [batch]
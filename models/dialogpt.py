@@ -31,7 +31,7 @@ class DialoGPTAgent(BaseAgent):
         data = ''.join(data[:-1])
         return data
 
-    def talk(self, topic, msgs):
+    def talk(self, topic, msgs, history=None):
         msgs = self.translate(msgs, tgt_lang='en')
         msgs = f'>> User: {msgs}'
         msgs = self.tokenizer.encode(msgs + self.tokenizer.eos_token, return_tensors='pt')
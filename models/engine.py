@@ -0,0 +1,246 @@
+from .header import *
+from concurrent.futures import Future
+
+'''
+Continuous (iteration-level) batching engine of the generation serving
+
+The request-level batching (BatchScheduler + predict_batch) feeds one batch until its longest
+sequence finishes, the requests that arrive in the meantime wait for the whole batch. The engine
+keeps one running batch of the active sequences of the different requests instead:
+
+1. at each step boundary, the waiting requests are prefilled together (left padded) and join the
+   running batch with their first sampled token
+2. one decoding step is fed for all the running sequences (only the last token, `past` is reused)
+3. the finished sequences ([SEP]/[STP] or max_len) leave the running batch immediately, their
+   futures are resolved and their rows of the past are dropped
+
+The per-sequence past is stored in the rows of the running past, which is left padded to the
+longest sequence (attention mask), the position ids of each row start from its first real token.
+The leading columns that are padded in all the rows are trimmed after the sequences leave.
+
+Models: GPT2 (end token [SEP], not returned) and When2Talk (end token [STP], returned)
+
+engine = GenerationEngine(model, model.sep_id).start()
+future = engine.submit(inpt_ids, max_len)
+ids = future.result()
+'''
+
+class Sequence:
+
+    '''
+    one request in the engine
+    '''
+
+    def __init__(self, inpt_ids, max_len, future):
+        self.inpt_ids, self.max_len, self.future = inpt_ids, max_len, future
+        self.generated = []
+
+class GenerationEngine:
+
+    '''
+    model: GPT2 or When2Talk (GPT2LMHeadModel in model.model, logits_pipeline, n_ctx)
+    end_id: the generation of the sequence stops on this token
+    keep_end: the end token is returned with the generated ids (When2Talk)
+    max_batch: max number of the running sequences
+    max_prefill: max number of the requests that join the running batch at one step boundary,
+                 the prefill of the long contexts delays the decoding step of the running sequences
+    '''
+
+    def __init__(self, model, end_id, keep_end=False, max_batch=32, max_prefill=8):
+        self.model = model
+        self.end_id, self.keep_end = end_id, keep_end
+        self.max_batch, self.max_prefill = max_batch, max_prefill
+        self.pipeline = model.logits_pipeline()
+        self.device = next(model.parameters()).device
+        self.queue = Queue()
+        self.closed = False
+        self.thread = None
+        # the running batch
+        self.sequences = []    # the Sequence of each row
+        self.past = None    # n_layer*[2, running, head, seq, head_dim], left padded
+        self.attn_mask = None    # [running, seq]
+        self.lengths = None    # [running], the real tokens in the past, also the position id of the next token
+        self.prev = None    # [running, 1], the sampled tokens that are not fed yet
+        self.state = None    # SamplingState of the running rows
+        # statistic information
+        self.lock = threading.Lock()
+        self.requests, self.tokens, self.steps, self.batch_sum = 0, 0, 0, 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f'[!] init the generation engine, max batch: {self.max_batch}, max prefill: {self.max_prefill}')
+        return self
+
+    def close(self):
+        '''
+        the running and waiting sequences are finished, then the engine thread exits
+        '''
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, inpt_ids, max_len):
+        '''
+        inpt_ids: a list of ids or [seq], truncated to the last n_ctx - max_len tokens (room for the generation)
+        return the Future of the generated ids
+        '''
+        if len(inpt_ids) == 0:
+            raise Exception(f'[!] the inpt_ids of the request is empty')
+        if not 0 < max_len < self.model.n_ctx:
+            raise Exception(f'[!] max_len must be in (0, {self.model.n_ctx}), but got {max_len}')
+        future = Future()
+        inpt_ids = torch.as_tensor(inpt_ids, dtype=torch.long)[-(self.model.n_ctx - max_len):]
+        self.queue.put(Sequence(inpt_ids, max_len, future))
+        return future
+
+    def _run(self):
+        while not (self.closed and not self.sequences):
+            try:
+                self.step()
+            except Exception as error:
+                # the running sequences fail, the engine keeps serving the new requests
+                for seq in self.sequences:
+                    seq.future.set_exception(error)
+                self.sequences, self.past = [], None
+
+    @torch.no_grad()
+    def step(self):
+        '''
+        admit the waiting requests, then feed one decoding step of the running batch;
+        block until a request arrives if the running batch is empty
+        '''
+        new = self._collect(block=not self.sequences)
+        if new:
+            self._admit(new)
+        if not self.sequences:
+            return
+        position_ids = self.lengths.unsqueeze(1)    # [running, 1]
+        self.attn_mask = torch.cat((self.attn_mask, torch.ones_like(self.prev)), dim=1)
+        outputs = self.model.model(
+                input_ids=self.prev,
+                past=self.past,
+                attention_mask=self.attn_mask,
+                position_ids=position_ids)
+        output, self.past = outputs[:2]
+        self.lengths = self.lengths + 1
+        next_token = self.pipeline.sample(output[:, -1, :], self.state)    # [running, 1]
+        with self.lock:
+            self.steps += 1
+            self.batch_sum += len(self.sequences)
+        monitor.record('running_batch', len(self.sequences))
+        keep = self._finish(self.sequences, next_token)
+        self.prev = next_token
+        if len(keep) < len(self.sequences):
+            self._select(keep)
+
+    def _collect(self, block=False):
+        new = []
+        while len(self.sequences) + len(new) < self.max_batch and len(new) < self.max_prefill:
+            try:
+                seq = self.queue.get(block=block and not new and not self.closed)
+            except Empty:
+                break
+            if seq is None:
+                self.closed = True
+                continue
+            new.append(seq)
+        return new
+
+    def _admit(self, new):
+        '''
+        the new requests fail if their prefill fails, the running sequences are not touched
+        '''
+        try:
+            self._prefill(new)
+        except Exception as error:
+            for seq in new:
+                if not seq.future.done():
+                    seq.future.set_exception(error)
+
+    def _prefill(self, new):
+        '''
+        prefill the new requests together (left padded), sample their first tokens and join the running batch
+        '''
+        ids = [seq.inpt_ids for seq in new]
+        width = max(len(i) for i in ids)
+        inpt_ids = torch.stack([F.pad(i, (width - len(i), 0)) for i in ids]).to(self.device)    # [new, seq]
+        attn_mask = torch.LongTensor([[0] * (width - len(i)) + [1] * len(i) for i in ids]).to(self.device)
+        position_ids = (attn_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        logits, past = shared_prefill(
+                self.model.model, inpt_ids,
+                attn_mask=attn_mask,
+                position_ids=position_ids)    # [new, vocab]
+        state = self.pipeline.init_state(logits)
+        next_token = self.pipeline.sample(logits, state)    # [new, 1]
+        with self.lock:
+            self.requests += len(new)
+        keep = self._finish(new, next_token)
+        if not keep:
+            return
+        keep_ = torch.LongTensor(keep).to(self.device)
+        new = [new[i] for i in keep]
+        past = tuple(p.index_select(1, keep_) for p in past)
+        attn_mask, next_token = attn_mask[keep_], next_token[keep_]
+        state.select(keep_)
+        lengths = attn_mask.sum(dim=-1)
+        if not self.sequences:
+            self.sequences, self.past, self.attn_mask = new, past, attn_mask
+            self.lengths, self.prev, self.state = lengths, next_token, state
+            return
+        # left pad the running past and the new past to the same length
+        old_width, new_width = self.attn_mask.shape[1], attn_mask.shape[1]
+        width = max(old_width, new_width)
+        self.past = tuple(
+                torch.cat((F.pad(a, (0, 0, width - old_width, 0)), F.pad(b, (0, 0, width - new_width, 0))), dim=1)
+                for a, b in zip(self.past, past))
+        self.attn_mask = torch.cat((F.pad(self.attn_mask, (width - old_width, 0)), F.pad(attn_mask, (width - new_width, 0))))
+        self.lengths = torch.cat((self.lengths, lengths))
+        self.prev = torch.cat((self.prev, next_token))
+        self.state.presence = torch.cat((self.state.presence, state.presence))
+        self.sequences = self.sequences + new
+
+    def _finish(self, sequences, next_token):
+        '''
+        append the sampled tokens, resolve the futures of the finished sequences;
+        return the rows of the unfinished ones
+        '''
+        keep = []
+        for idx, (seq, token) in enumerate(zip(sequences, next_token.squeeze(1).tolist())):
+            if token != self.end_id or self.keep_end:
+                seq.generated.append(token)
+            if token == self.end_id or len(seq.generated) >= seq.max_len:
+                with self.lock:
+                    self.tokens += len(seq.generated)
+                seq.future.set_result(seq.generated)
+            else:
+                keep.append(idx)
+        return keep
+
+    def _select(self, keep):
+        '''
+        drop the finished rows, and trim the leading columns that are padded in all the rows
+        '''
+        self.sequences = [self.sequences[i] for i in keep]
+        if not self.sequences:
+            self.past, self.attn_mask, self.lengths, self.prev, self.state = None, None, None, None, None
+            return
+        keep = torch.LongTensor(keep).to(self.device)
+        self.past = tuple(p.index_select(1, keep) for p in self.past)
+        self.attn_mask, self.lengths, self.prev = self.attn_mask[keep], self.lengths[keep], self.prev[keep]
+        self.state.select(keep)
+        pad = self.attn_mask.shape[1] - self.lengths.max().item()
+        if pad > 0:
+            self.past = tuple(p[..., pad:, :] for p in self.past)
+            self.attn_mask = self.attn_mask[:, pad:]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'running': len(self.sequences),
+                'requests': self.requests,
+                'tokens': self.tokens,
+                'steps': self.steps,
+                'avg_batch': round(self.batch_sum / self.steps, 2) if self.steps else 0,
+            }
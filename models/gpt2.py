@@ -25,78 +25,385 @@ class GPT2(nn.Module):
         output = outputs[0]    # [batch, seq, vocab]
         return output
 
-    def predict(self, inpt_ids, max_len):
+    def logits_pipeline(self, ban_unk=True):
+        '''
+        ignore the [UNK] token, repetition penalty, top-k/top-p
+        ban_unk: False for the logits of the VocabShortlist (the [UNK] token is not in the shortlist)
+        '''
+        return LogitsPipeline.build(
+                banned=[self.unk_id] if ban_unk else [], 
+                repetition_penalty=self.repetition_penalty, 
+                top_k=self.topk, 
+                top_p=self.topp)
+
+    def predict(self, inpt_ids, max_len, cache=None, draft=None, k=4):
         '''
         batch_size is 1
         inpt_ids: [seq]
         return a list of ids (generated)
         no pad, do not need attention_mask
+        cache: the PrefixKVCache of the contexts in the previous turns (only the new tokens are prefilled)
+        draft: the draft model of the speculative sampling (predict_speculative), k tokens are proposed at each step;
+               only used if the window holds the context and all the generated tokens
         '''
-        with torch.no_grad():
-            generated = []
-            for _ in range(max_len):
-                outputs = self.model(input_ids=inpt_ids)
-                next_token_logits = outputs[0][-1, :]    # [vocab]
-                # ignore the [UNK] token
-                next_token_logits[self.unk_id] = -np.inf
-                # repetition penalty
-                if generated:
-                    next_token_logits[list(set(generated))] /= self.repetition_penalty
-                filtered_logits = top_k_top_p_filtering(
-                        next_token_logits, 
-                        top_k=self.topk, 
-                        top_p=self.topp)
-                next_token = torch.multinomial(
-                        F.softmax(filtered_logits, dim=-1),
-                        num_samples=1)
-                if next_token == self.sep_id:
-                    break
-                generated.append(next_token.item())
-                inpt_ids = torch.cat((inpt_ids, next_token), dim=0)
-                # remember to cut off 
-                inpt_ids = inpt_ids[-self.n_ctx:]
-            return generated
+        if draft is not None and len(inpt_ids) + max_len <= self.n_ctx:
+            rest = self.predict_speculative(inpt_ids.unsqueeze(0), max_len, draft, k=k)[0]
+            return rest[:rest.index(self.sep_id)] if self.sep_id in rest else rest
+        return list(self.predict_stream(inpt_ids, max_len, cache=cache))
+
+    def predict_stream(self, inpt_ids, max_len, cache=None):
+        '''
+        same as predict, but yield the id once it is sampled (streaming API),
+        stop on the [SEP] token or when the generator is closed by the consumer;
+        no_grad is set for each step, because the grad mode should not leak to the consumer between the yields
+        '''
+        pipeline = self.logits_pipeline()
+        state, past = None, None
+        for _ in range(max_len):
+            with torch.no_grad():
+                # only the new token is fed, the tokens before it are cached in the past
+                next_token_logits, past = kv_cache_forward(self.model, inpt_ids, past=past, cache=cache)    # [vocab]
+                if state is None:
+                    state = pipeline.init_state(next_token_logits)
+                # ignore the [UNK] token, repetition penalty, top-k/top-p
+                next_token = pipeline.sample(next_token_logits, state)    # [1]
+            if next_token == self.sep_id:
+                break
+            yield next_token.item()
+            inpt_ids = torch.cat((inpt_ids, next_token), dim=0)
+            # remember to cut off 
+            inpt_ids = inpt_ids[-self.n_ctx:]
 
     @torch.no_grad()
-    def predict_batch(self, inpt_ids, max_len):
+    def predict_speculative(self, inpt_ids, max_len, draft, k=4, attn_mask=None, samples=1):
+        '''
+        speculative sampling: the draft model (GPT2LMHeadModel with the same vocabulary, e.g. model_lm_small)
+        proposes k tokens x_1..x_k from its distributions q, and the model computes its distributions p of the
+        k+1 positions in one forward pass; x_j is accepted with the probability min(1, p(x_j)/q(x_j)), the first
+        rejected one is replaced by a sample of norm(max(0, p - q)), and if all the k tokens are accepted, one more
+        token is sampled from p. p and q are the distributions after the logits pipeline, so the tokens follow
+        exactly the sampling distribution of predict_batch.
+
+        all the rows advance by the same number of tokens (the fewest accepted tokens in the batch + 1): the
+        token at each position is either an accepted proposal or a sample of the residual/p, so it is still exact
+
+        inpt_ids: [batch, seq], the context and the generated tokens must fit the window (seq + max_len <= n_ctx),
+                  the draft model sees the last n_ctx(draft) - max_len tokens of the context
+        attn_mask: [batch, seq], the mask of the left padded inpt_ids
+        return: samples*[batch], the tokens after the [SEP] are [PAD] (same as predict_batch)
+        '''
+        def feed(model, ids, past, attn_mask, length):
+            # ids: [batch, m], the new tokens; length: [batch], the real tokens in the past
+            attn_mask = torch.cat((attn_mask, torch.ones_like(ids)), dim=1)
+            position_ids = length.unsqueeze(1) + torch.arange(ids.shape[1], device=ids.device)
+            outputs = model(input_ids=ids, past=past, attention_mask=attn_mask, position_ids=position_ids)
+            return outputs[0], outputs[1], attn_mask, length + ids.shape[1]
+
+        def prefill(model, ids, attn_mask):
+            # the last token of the context is pending (fed with the first proposals)
+            if ids.shape[1] == 1:
+                attn_mask = expand_samples(attn_mask, samples)
+                return None, attn_mask[:, :0], torch.zeros_like(attn_mask[:, 0]), expand_samples(ids, samples)
+            attn_mask = attn_mask[:, :-1]
+            position_ids = (attn_mask.cumsum(dim=-1) - 1).clamp(min=0)
+            _, past = shared_prefill(
+                    model, ids[:, :-1],
+                    samples=samples,
+                    attn_mask=attn_mask,
+                    position_ids=position_ids)
+            attn_mask = expand_samples(attn_mask, samples)
+            return past, attn_mask, attn_mask.sum(dim=-1), expand_samples(ids[:, -1:], samples)
+
+        def truncate(past, attn_mask, length, n):
+            # drop the last n tokens of the past
+            if n == 0:
+                return past, attn_mask, length
+            return tuple(p[..., :-n, :] for p in past), attn_mask[:, :-n], length - n
+
+        if attn_mask is None:
+            attn_mask = torch.ones_like(inpt_ids)
+        window = draft.config.n_ctx - max_len
+        if window <= 0:
+            raise Exception(f'[!] the window of the draft model ({draft.config.n_ctx}) can not hold {max_len} tokens')
+        past, mask, length, pending = prefill(self.model, inpt_ids, attn_mask)
+        d_past, d_mask, d_length, d_pending = prefill(draft, inpt_ids[:, -window:], attn_mask[:, -window:])
+        batch_size = inpt_ids.shape[0] * samples
+        generated = torch.zeros(batch_size, max_len, dtype=torch.long, device=inpt_ids.device)
+        stop_flag = torch.zeros(batch_size, dtype=torch.bool, device=inpt_ids.device)
+        pipeline, state = self.logits_pipeline(), SamplingState()
+        state.presence = torch.zeros(batch_size, self.model.config.vocab_size, dtype=torch.bool, device=inpt_ids.device)
+        total = 0
+        while total < max_len:
+            k_ = min(k, max_len - total - 1)
+            # ========== draft: propose k_ tokens ==========
+            proposals, q = [], []
+            d_state = SamplingState()
+            d_state.presence = state.presence.clone()
+            for _ in range(k_):
+                logits, d_past, d_mask, d_length = feed(draft, d_pending, d_past, d_mask, d_length)
+                q_ = pipeline.probs(logits[:, -1, :], d_state)    # [batch, vocab]
+                x = torch.multinomial(q_, num_samples=1)    # [batch, 1]
+                d_state.update(x)
+                proposals.append(x)
+                q.append(q_)
+                d_pending = x
+            proposals = torch.cat(proposals, dim=1) if proposals else pending[:, :0]    # [batch, k_]
+            # ========== verify: p of the k_+1 positions in one forward pass ==========
+            logits, past, mask, length = feed(
+                    self.model, torch.cat((pending, proposals), dim=1), past, mask, length)    # [batch, k_+1, vocab]
+            presence = state.presence.unsqueeze(1).repeat(1, k_+1, 1)    # [batch, k_+1, vocab]
+            for j in range(k_):
+                presence[:, j+1:].scatter_(2, proposals[:, j].view(-1, 1, 1).expand(-1, k_-j, 1), True)
+            v_state = SamplingState()
+            v_state.presence = presence.view(batch_size * (k_+1), -1)
+            p = pipeline.probs(logits.reshape(batch_size * (k_+1), -1), v_state).view(batch_size, k_+1, -1)
+            # ========== accept ==========
+            if k_ > 0:
+                q = torch.stack(q, dim=1)    # [batch, k_, vocab]
+                px = p[:, :-1].gather(2, proposals.unsqueeze(2)).squeeze(2)    # [batch, k_]
+                qx = q.gather(2, proposals.unsqueeze(2)).squeeze(2)
+                accept = torch.rand_like(px) * qx < px    # [batch, k_]
+                # number of the leading accepted proposals of each row
+                accepted = accept.long().cumprod(dim=1).sum(dim=1)    # [batch]
+                # the finished rows do not limit the others
+                n = accepted.masked_fill(stop_flag, k_).min().item()
+            else:
+                accepted, n = torch.zeros_like(stop_flag, dtype=torch.long), 0
+            if n < k_:
+                residual = (p[:, n] - q[:, n]).clamp(min=0)
+                residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p[:, n])
+                y = torch.where(
+                        accepted > n,
+                        proposals[:, n],
+                        torch.multinomial(residual, num_samples=1).squeeze(1))
+            else:
+                y = torch.multinomial(p[:, n], num_samples=1).squeeze(1)
+            tokens = torch.cat((proposals[:, :n], y.unsqueeze(1)), dim=1)    # [batch, n+1]
+            if monitor.enabled:
+                active = (~stop_flag).sum().item()
+                monitor.count('speculative_steps')
+                monitor.count('speculative_proposed', k_ * active)
+                monitor.count('speculative_accepted', accepted[~stop_flag].sum().item())
+                monitor.count('speculative_emitted', (n+1) * active)
+            generated[:, total:total+n+1] = tokens
+            state.presence.scatter_(1, tokens, True)
+            total += n + 1
+            stop_flag |= (tokens == self.sep_id).any(dim=1)
+            if stop_flag.all():
+                break
+            # ========== rollback: keep the past of the emitted tokens ==========
+            # the model is fed with pending, x_1..x_k_, only pending, x_1..x_n are kept
+            past, mask, length = truncate(past, mask, length, k_ - n)
+            pending = y.unsqueeze(1)
+            if k_ == 0:
+                d_pending = torch.cat((d_pending, pending), dim=1)
+            elif n < k_:
+                # the draft is fed with its pending tokens, x_1..x_{k_-1}
+                d_past, d_mask, d_length = truncate(d_past, d_mask, d_length, k_ - 1 - n)
+                d_pending = pending
+            else:
+                d_pending = torch.cat((proposals[:, -1:], pending), dim=1)
+        generated = generated[:, :total]
+        # [PAD] after the first [SEP] token
+        after_sep = (generated == self.sep_id).long().cumsum(dim=1) - (generated == self.sep_id).long() > 0
+        return generated.masked_fill(after_sep, 0).tolist()
+
+    @torch.no_grad()
+    def predict_batch(self, inpt_ids, max_len, attn_mask=None, shrink=True, samples=1, cache=None, draft=None, k=4, shortlist=None):
         '''
         inpt_ids: [batch, seq]
+        attn_mask: [batch, seq], the mask of the left padded inpt_ids (contexts have different lengths)
+        shrink: the finished samples (the [SEP] token is generated) are dropped from the active batch
+                together with their past, the tokens after the [SEP] are filled with the [PAD] (0);
+                if False, all the samples are fed until every sample is finished
+        samples: number of the samples of each context, the context is encoded once and its past
+                 is shared by the samples (the samples of one context are adjacent in the results)
+        cache: the PrefixKVCache of the contexts in the previous turns (only the new tokens are prefilled)
+        draft: the draft model of the speculative sampling (predict_speculative, the cache is not used)
+        shortlist: the VocabShortlist, the lm head only computes the logits of the shortlist and the tokens
+                   of the contexts, the sampled positions are mapped back to the vocabulary
         return: samples*[batch]
         '''
-        # change inpt_ids from [seq] to [batch, seq]
-        generated = []
-        prev, past = inpt_ids, None
-        batch_size = inpt_ids.shape[0]
-        stop_flag = np.zeros(batch_size)    # [batch]
-        for _ in range(max_len):
-            outputs = self.model(input_ids=prev, past=past)    # [batch, seq, vocab]
-            output, past = outputs[:2]
-            next_token_logits = output[:, -1, :]    # [batch, vocab]
-            next_token_logits[:, self.unk_id] = -np.inf
-            # repetition penalty
-            for x in range(batch_size):
-                y = [item[x] for item in generated]
-                next_token_logits[x, y] /= self.repetition_penalty
-            filtered_logits = top_k_top_p_filtering_batch(
-                    next_token_logits, 
-                    top_k=self.topk, 
-                    top_p=self.topp)
-            next_token = torch.multinomial(
-                    F.softmax(filtered_logits, dim=-1),
-                    num_samples=1)    # [batch, 1]
+        if draft is not None:
+            return self.predict_speculative(inpt_ids, max_len, draft, k=k, attn_mask=attn_mask, samples=samples)
+        model, ids = self.model, None
+        if shortlist is not None:
+            model, ids = shortlist.head(self.model, inpt_ids, attn_mask)
+        position_ids = None
+        if attn_mask is not None:
+            # the left pad tokens are ignored, position ids start from the first real token
+            position_ids = (attn_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        next_token_logits, past = shared_prefill(
+                model, inpt_ids, 
+                samples=samples, 
+                attn_mask=attn_mask, 
+                position_ids=position_ids,
+                cache=cache)    # [batch*samples, vocab]
+        if attn_mask is not None:
+            attn_mask = expand_samples(attn_mask, samples)
+            position_ids = expand_samples(position_ids[:, -1:], samples)
+        batch_size = inpt_ids.shape[0] * samples
+        # the generated ids stay on the device, and are copied to the host at the end
+        generated = torch.zeros(batch_size, max_len, dtype=torch.long, device=inpt_ids.device)
+        # the rows (in the generated) of the active samples
+        active = torch.arange(batch_size, device=inpt_ids.device)
+        pipeline, state, step = self.logits_pipeline(ban_unk=ids is None), None, -1
+        stop_flag = torch.zeros(batch_size, dtype=torch.bool, device=inpt_ids.device)    # [active]
+        for step in range(max_len):
+            if step > 0:
+                outputs = model(
+                        input_ids=prev, 
+                        past=past,
+                        attention_mask=attn_mask,
+                        position_ids=position_ids)    # [active, 1, vocab]
+                output, past = outputs[:2]
+                next_token_logits = output[:, -1, :]    # [active, vocab]
+            if state is None:
+                state = pipeline.init_state(next_token_logits)
+            # ignore the [UNK] token, repetition penalty, top-k/top-p
+            next_token = pipeline.sample(next_token_logits, state)    # [active, 1]
+            if ids is not None:
+                # the positions in the shortlist -> the ids of the vocabulary
+                next_token = ids[next_token]
+            generated[active, step] = next_token.squeeze(1)
             # set up stop_flag
-            for idx, i in enumerate(next_token.squeeze(1)):
-                if i == self.sep_id:
-                    stop_flag[idx] = 1
-            generated.append([token.item() for token in next_token.squeeze(1)])
+            stop_flag |= next_token.squeeze(1) == self.sep_id
             prev = next_token
-            if sum(stop_flag) == batch_size:
+            if attn_mask is not None:
+                attn_mask = torch.cat((attn_mask, torch.ones_like(next_token)), dim=1)
+                position_ids = position_ids[:, -1:] + 1
+            finished = stop_flag.sum().item()
+            if finished == len(active):
                 break
-        # transpose
-        ng, batch_size = [], len(generated[0])
-        for i in range(batch_size):
-            ng.append([g[i] for g in generated])
-        return ng
+            if shrink and finished > 0:
+                keep = (~stop_flag).nonzero().squeeze(1)    # [active]
+                active, prev = active[keep], prev[keep]
+                state.select(keep)
+                stop_flag = stop_flag[keep]
+                # past: n_layer*[2, active, head, seq, head_dim]
+                past = tuple(p.index_select(1, keep) for p in past)
+                if attn_mask is not None:
+                    attn_mask, position_ids = attn_mask[keep], position_ids[keep]
+        return generated[:, :step+1].tolist()
+
+    @torch.no_grad()
+    def predict_beam(self, inpt_ids, max_len, beam_size=4, groups=1, diversity=0.5, length_penalty=1.0, attn_mask=None, cache=None):
+        '''
+        beam search (groups is 1) and diverse beam search (Vijayakumar et al., 2018): the beams are split into
+        `groups`, the groups are expanded one by one at each step, and the log probs of the tokens that are
+        selected by the previous groups at this step are reduced by `diversity` (hamming diversity); the
+        penalty only affects the selection, the scores of the beams are the sums of the log probs
+        inpt_ids: [batch, seq]
+        attn_mask: [batch, seq], the mask of the left padded inpt_ids
+        cache: the PrefixKVCache of the contexts in the previous turns (only the new tokens are prefilled)
+        the context is encoded once and its past is shared by the beams, the past of the selected beams
+        is gathered by index_select at each step (no recomputation)
+        the score of the hypothesis is length normalized: sum of the log probs / len**length_penalty
+        ([SEP] is counted); the beam of one group stops when it has `beam_size/groups` finished hypotheses
+        that the running beams can not beat
+        return: the hypotheses beam_size*[batch] (the hypotheses of one context are adjacent and sorted by
+        the scores, ended with [SEP] if finished) and their scores
+        '''
+        assert beam_size % groups == 0, f'[!] beam size {beam_size} must be divisible by the groups {groups}'
+        batch_size, group_size = inpt_ids.shape[0], beam_size // groups
+        device = inpt_ids.device
+        position_ids = None
+        if attn_mask is not None:
+            position_ids = (attn_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        logits, past = shared_prefill(
+                self.model, inpt_ids,
+                samples=beam_size,
+                attn_mask=attn_mask,
+                position_ids=position_ids,
+                cache=cache)    # [batch*beam, vocab]
+        if attn_mask is not None:
+            attn_mask = expand_samples(attn_mask, beam_size)
+            position_ids = expand_samples(position_ids[:, -1:], beam_size)
+        vocab = logits.shape[-1]
+        # ignore the [UNK] token, repetition penalty; no top-k/top-p
+        pipeline = LogitsPipeline.build(banned=[self.unk_id], repetition_penalty=self.repetition_penalty)
+        state = pipeline.init_state(logits)
+        # only the first beam of each group is alive at the first step, the other beams are its copies
+        beam_scores = torch.full((batch_size, groups, group_size), -np.inf, device=device)
+        beam_scores[:, :, 0] = 0
+        beam_scores = beam_scores.view(batch_size, beam_size)    # [batch, beam]
+        generated = torch.zeros(batch_size*beam_size, 0, dtype=torch.long, device=device)
+        # the finished hypotheses (score, ids) of each group of each context
+        hyps = [[[] for _ in range(groups)] for _ in range(batch_size)]
+        done = [[False] * groups for _ in range(batch_size)]
+        offset = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size    # [batch, 1]
+        for step in range(max_len):
+            if step > 0:
+                outputs = self.model(
+                        input_ids=prev,
+                        past=past,
+                        attention_mask=attn_mask,
+                        position_ids=position_ids)    # [batch*beam, 1, vocab]
+                output, past = outputs[:2]
+                logits = output[:, -1, :]
+            log_probs = F.log_softmax(pipeline(logits, state), dim=-1).view(batch_size, beam_size, vocab)
+            # the number of the times that the tokens are selected by the previous groups at this step
+            # (the new beams and the new finished hypotheses)
+            selected = torch.zeros(batch_size, vocab, device=device)
+            rows, tokens, scores = [], [], []
+            for g in range(groups):
+                begin = g * group_size
+                scores_ = beam_scores[:, begin:begin+group_size].unsqueeze(-1) + log_probs[:, begin:begin+group_size]    # [batch, group, vocab]
+                penalized = (scores_ - diversity * selected.unsqueeze(1)).view(batch_size, -1)
+                # 2*group candidates, at most group of them are ended with [SEP]
+                _, candidates = penalized.topk(2*group_size, dim=-1)    # [batch, 2*group]
+                candidate_scores = scores_.view(batch_size, -1).gather(1, candidates)
+                beam_ids, token_ids = candidates // vocab, candidates % vocab
+                is_end = token_ids == self.sep_id
+                # the finished candidates in the first group_size ones are the hypotheses
+                for b, r in (is_end[:, :group_size]).nonzero().tolist():
+                    if done[b][g]:
+                        continue
+                    selected[b, self.sep_id] += 1
+                    ids = generated[offset[b, 0] + begin + beam_ids[b, r]].tolist() + [self.sep_id]
+                    hyps[b][g].append((candidate_scores[b, r].item() / (step + 1) ** length_penalty, ids))
+                    hyps[b][g] = sorted(hyps[b][g], key=lambda x: -x[0])[:group_size]
+                # the first group_size candidates that are not finished are the new beams
+                order = (is_end.long() * 2 * group_size + torch.arange(2*group_size, device=device)).argsort(dim=-1)[:, :group_size]
+                beam_ids, token_ids = beam_ids.gather(1, order), token_ids.gather(1, order)
+                scores.append(candidate_scores.gather(1, order))
+                rows.append(offset + begin + beam_ids)
+                tokens.append(token_ids)
+                selected.scatter_add_(1, token_ids, torch.ones_like(token_ids, dtype=selected.dtype))
+                # the running beams can not beat the worst hypothesis
+                best = scores[-1].max(dim=-1)[0] / (step + 1) ** length_penalty
+                for b in range(batch_size):
+                    if not done[b][g] and len(hyps[b][g]) == group_size:
+                        done[b][g] = hyps[b][g][-1][0] >= best[b].item()
+            beam_scores = torch.cat(scores, dim=1)    # [batch, beam]
+            rows, prev = torch.cat(rows, dim=1).view(-1), torch.cat(tokens, dim=1).view(-1, 1)    # [batch*beam], [batch*beam, 1]
+            # reorder the beams: past n_layer*[2, batch*beam, head, seq, head_dim]
+            past = tuple(p.index_select(1, rows) for p in past)
+            generated = torch.cat((generated[rows], prev), dim=1)
+            state.select(rows)
+            state.update(prev)
+            if all(all(i) for i in done):
+                break
+            if attn_mask is not None:
+                # the beams of one context share the same mask
+                attn_mask = torch.cat((attn_mask, torch.ones_like(prev)), dim=1)
+                position_ids = position_ids + 1
+        # the running beams of the groups that are not finished
+        length = generated.shape[1]
+        for b in range(batch_size):
+            for g in range(groups):
+                if done[b][g]:
+                    continue
+                for r in range(g*group_size, (g+1)*group_size):
+                    score = beam_scores[b, r].item()
+                    hyps[b][g].append((score / length ** length_penalty, generated[offset[b, 0] + r].tolist()))
+                hyps[b][g] = sorted(hyps[b][g], key=lambda x: -x[0])[:group_size]
+        rest, rest_scores = [], []
+        for b in range(batch_size):
+            hyps_ = sorted([h for g in hyps[b] for h in g], key=lambda x: -x[0])
+            rest.extend([h[1] for h in hyps_])
+            rest_scores.extend([h[0] for h in hyps_])
+        return rest, rest_scores
 
 class GPT2Agent(BaseAgent):
 
@@ -131,6 +438,19 @@ class GPT2Agent(BaseAgent):
                 'topic_transfer': {'音乐': 'music', '体育': 'sport', '数码产品': 'electric', '美食': 'food', '电影': 'movie'},
                 'balanceddata_parallel_gpu0_size': 2,
                 'repetition_penalty': 1,
+                'prefix_cache_tokens': 8192,
+                # speculative sampling: number of the tokens proposed by the draft model at each step (0 is off)
+                'speculative': 0,
+                'draft_config_path': 'data/config/model_lm_small.json',
+                'draft_path': 'ckpt/LM/gpt2lm/best.pt',
+                # decoding of the candidates: sampling, beam (beam search) or diverse_beam (diverse beam search)
+                'decoding': 'sampling',
+                'beam_size': 8,
+                'beam_groups': 4,
+                'diversity_penalty': 0.5,
+                'length_penalty': 1.0,
+                # the VocabShortlist of the sampling (utils/utils.py --mode shortlist), '' is the full vocabulary
+                'shortlist_path': '',
         }
         # hyperparameters
 
@@ -150,6 +470,29 @@ class GPT2Agent(BaseAgent):
                 config_path=self.args['config_path']
         )
 
+        # the key/value cache of the contexts in the previous turns of the conversations
+        self.prefix_cache = None
+        if run_mode not in ['train', 'train_trs']:
+            self.prefix_cache = PrefixKVCache(self.model.n_ctx, capacity=self.args['prefix_cache_tokens'])
+
+        # the draft model of the speculative sampling, the small LM (model_lm_small) shares the vocab_small
+        self.draft = None
+        if self.args['speculative'] > 0 and run_mode not in ['train', 'train_trs']:
+            draft = GPT2(
+                    self.vocab_size, self.unk, self.sep, 
+                    self.args['topk'], self.args['topp'], self.args['repetition_penalty'],
+                    config_path=self.args['draft_config_path'])
+            draft.load_state_dict(torch.load(self.args['draft_path'], map_location='cpu'))
+            self.draft = draft.model.eval()
+            to_cuda(self.draft, model=True)
+            print(f'[!] load the draft model from {self.args["draft_path"]}, {self.args["speculative"]} tokens are proposed at each step')
+
+        # the lm head of the sampling only projects to the frequent tokens and the tokens of the contexts
+        self.shortlist = None
+        if self.args['shortlist_path'] and run_mode not in ['train', 'train_trs']:
+            self.shortlist = VocabShortlist.load(self.args['shortlist_path'], self.unk)
+            print(f'[!] load the vocabulary shortlist ({len(self.shortlist)} tokens) from {self.args["shortlist_path"]}')
+
         self.criterion = nn.CrossEntropyLoss(ignore_index=self.args['pad'], reduction='sum')
         self.optimizer = transformers.AdamW(
                 self.model.parameters(), 
@@ -194,7 +537,9 @@ class GPT2Agent(BaseAgent):
                     )
             print(f'[!] load multiview model over')
 
-        if run_mode == 'rerank_ir':
+        # rerank_ir: the retrieval candidates are also reranked
+        # rerank: the plain ES answer is the last rung of the degradation ladder
+        if run_mode in ['rerank', 'rerank_ir']:
             self.ir_agent = TestAgent()
 
         self.show_parameters(self.args)
@@ -244,9 +589,32 @@ class GPT2Agent(BaseAgent):
                 raise exception
         return round(total_loss/batch_num, 4)
 
+    def generate(self, ids, maxlen, attn_mask=None, samples=1, cache=None):
+        '''
+        the candidates samples*[batch] of the contexts by the decoding strategy (self.args['decoding']);
+        beam/diverse_beam: the beam width is `samples` and all the hypotheses are returned, or the beam_size
+        if one candidate is needed (the best hypothesis of each context)
+        '''
+        if self.args['decoding'] == 'sampling':
+            return self.model.predict_batch(
+                    ids, maxlen, attn_mask=attn_mask, samples=samples, cache=cache,
+                    draft=self.draft, k=self.args['speculative'], shortlist=self.shortlist)
+        beam_size = samples if samples > 1 else self.args['beam_size']
+        groups = gcd(beam_size, self.args['beam_groups']) if self.args['decoding'] == 'diverse_beam' else 1
+        tgt, _ = self.model.predict_beam(
+                ids, maxlen, 
+                beam_size=beam_size, 
+                groups=groups, 
+                diversity=self.args['diversity_penalty'], 
+                length_penalty=self.args['length_penalty'],
+                attn_mask=attn_mask, 
+                cache=cache)
+        return tgt if samples > 1 else tgt[::beam_size]
+
     def test_model_samples(self, test_iter, path, samples=5):
         '''
         Generate `samples` candidates for one given conversation context
+        the contexts in the batch are left padded (gpt2_test_collate_fn_batch) and generated together
         '''
         def filter(x):
             if '[SEP]' in x:
@@ -257,29 +625,31 @@ class GPT2Agent(BaseAgent):
         max_size = self.args['tgt_len_size']
         with open(path, 'w') as f:
             for batch in pbar:
-                c, r = batch    # c: [seq]
-                c = c.unsqueeze(0)    # [1, seq]
-                c_ = c.expand(samples, c.shape[-1])    # [samples(batch), seq] 
-                tgt = self.model.predict_batch(c_, max_size)
+                c, attn_mask, r = batch    # c/attn_mask: [batch, seq]; r: batch*[seq]
+                # room for the generation in the window
+                c, attn_mask = c[:, -(self.model.n_ctx-max_size):], attn_mask[:, -(self.model.n_ctx-max_size):]
+                tgt = self.generate(c, max_size, attn_mask=attn_mask, samples=samples)
                 tgt = [self.vocab.convert_ids_to_tokens(i) for i in tgt]
                 tgt = [filter(' '.join(i)) for i in tgt]
-                
-                ctx = self.vocab.convert_ids_to_tokens(c[0])
-                ctx = ' '.join(ctx)
+                for idx in range(len(c)):
+                    ctx = self.vocab.convert_ids_to_tokens(c[idx][attn_mask[idx].bool()])
+                    ctx = ' '.join(ctx)
 
-                ref = self.vocab.convert_ids_to_tokens(r)
-                ref = ' '.join(ref)
+                    ref = self.vocab.convert_ids_to_tokens(r[idx])
+                    ref = ' '.join(ref)
 
-                f.write(f'CTX: {ctx}\n')
-                f.write(f'REF: {ref}\n')
-                for idx, i in enumerate(tgt):
-                    f.write(f'TGT{idx}: {i}\n')
-                f.write('\n')
+                    f.write(f'CTX: {ctx}\n')
+                    f.write(f'REF: {ref}\n')
+                    # the samples of one context are adjacent
+                    for i in range(samples):
+                        f.write(f'TGT{i}: {tgt[idx*samples+i]}\n')
+                    f.write('\n')
         print(f'[!] translate test dataset over, write into {path}')
 
     def test_model(self, test_iter, path):
         '''
         Generate the test dataset and measure the performance
+        the contexts in the batch are left padded (gpt2_test_collate_fn_batch) and generated together
         '''
         def filter(x):
             return x.replace('[PAD]', '')
@@ -287,59 +657,74 @@ class GPT2Agent(BaseAgent):
         pbar = tqdm(test_iter)
         with open(path, 'w') as f:
             for batch in pbar:
-                c, r = batch
-                max_size = max(len(r), self.args['tgt_len_size'])
-                tgt = self.model.predict(c, max_size)
-                text = self.vocab.convert_ids_to_tokens(tgt)
-                tgt = ''.join(text)
+                c, attn_mask, r = batch    # c/attn_mask: [batch, seq]; r: batch*[seq]
+                max_size = max(max(len(i) for i in r), self.args['tgt_len_size'])
+                # room for the generation in the window
+                c, attn_mask = c[:, -(self.model.n_ctx-max_size):], attn_mask[:, -(self.model.n_ctx-max_size):]
+                tgt = self.generate(c, max_size, attn_mask=attn_mask)
+                for c_, m_, r_, t_ in zip(c, attn_mask, r, tgt):
+                    # cut from the first [SEP] token
+                    if self.model.sep_id in t_:
+                        t_ = t_[:t_.index(self.model.sep_id)]
+                    text = self.vocab.convert_ids_to_tokens(t_)
+                    tgt_ = ''.join(text)
 
-                ctx = self.vocab.convert_ids_to_tokens(c)
-                ctx = filter(''.join(ctx))
+                    ctx = self.vocab.convert_ids_to_tokens(c_[m_.bool()])
+                    ctx = filter(''.join(ctx))
 
-                ref = self.vocab.convert_ids_to_tokens(r)
-                ref = filter(''.join(ref))
+                    ref = self.vocab.convert_ids_to_tokens(r_)
+                    ref = filter(''.join(ref))
 
-                f.write(f'CTX: {ctx}\n')
-                f.write(f'REF: {ref}\n')
-                f.write(f'TGT: {tgt}\n\n')
+                    f.write(f'CTX: {ctx}\n')
+                    f.write(f'REF: {ref}\n')
+                    f.write(f'TGT: {tgt_}\n\n')
         print(f'[!] translate test dataset over, write into {path}')
         # measure the performance
         (b1, b2, b3, b4), ((r_max_l, r_min_l, r_avg_l), (c_max_l, c_min_l, c_avg_l)), (dist1, dist2, rdist1, rdist2), (average, extrema, greedy) = cal_generative_metric(path, lang=self.args['lang'])
         print(f'[TEST] BLEU: {b1}/{b2}/{b3}/{b4}; Length(max, min, avg): {c_max_l}/{c_min_l}/{c_avg_l}|{r_max_l}/{r_min_l}/{r_avg_l}; Dist: {dist1}/{dist2}|{rdist1}/{rdist2}; Embedding(average/extrema/greedy): {average}/{extrema}/{greedy}')
     
+    def topic_trigger(self, topic, msgs):
+        '''
+        detect the topic of the msgs, if the topic is not consistant with the given topic,
+        append the trigger sentence before the msgs
+        '''
+        if not self.reranker.topic_scores(msgs, topic):
+            trigger_s = random.choice(self.trigger_utterances[topic])
+            msgs = f'{trigger_s} [SEP] {msgs}'
+            print(f'[!] topic trigger mode is set up: {msgs}')
+        return msgs
+
     @torch.no_grad()
-    def talk(self, topic, msgs, maxlen=50, batch_size=16):
+    def talk(self, topic, msgs, maxlen=50, batch_size=16, history=None):
         '''
         topic, msgs: msgs is a string which split with the [SEP] token
+        history: the history of the session
         batch size is 1
 
         n_ctx is 300/512
 
         if the topic of the msgs is very low, append the trigger sentences into the msgs
         '''
+        if self.args['run_mode'] == 'test':
+            with monitor.span('gpt2_sampling'):
+                return ''.join(self.talk_stream(topic, msgs, maxlen=maxlen))
         if topic is None:
             self.reranker.mode['topic'] = False
         else:
-            # detect the topic of the msgs
-            if not self.reranker.topic_scores(msgs, topic):
-                trigger_s = random.choice(self.trigger_utterances[topic])
-                msgs = f'{trigger_s} [SEP] {msgs}'
-                print(f'[!] topic trigger mode is set up: {msgs}')
+            msgs = self.topic_trigger(topic, msgs)
+        history = history or []
         # tokenizer
-        if self.args['run_mode'] == 'test':
-            msgs = torch.LongTensor(self.vocab.encode(msgs)[-(512-maxlen):])
-            msgs = to_cuda(msgs)
-            tgt = self.model.predict(msgs, maxlen)
-            tgt = self.vocab.convert_ids_to_tokens(tgt)
-            tgt = ''.join(tgt)
-            return tgt
-        elif self.args['run_mode'] in ['rerank', 'rerank_ir']:
+        if self.args['run_mode'] in ['rerank', 'rerank_ir']:
             # ========== predict_batch ==========
+            # the hypotheses of the beam search are the candidates
+            if self.args['decoding'] != 'sampling':
+                batch_size = self.args['beam_size']
             msgs_ = self.vocab.encode(msgs)[-(512-maxlen):]
-            msgs_ = [deepcopy(msgs_) for _ in range(batch_size)]
-            msgs_ = torch.LongTensor(msgs_)    # [batch, seq]
+            # the context is encoded once, and its past is shared by the samples
+            msgs_ = torch.LongTensor(msgs_).unsqueeze(0)    # [1, seq]
             msgs_ = to_cuda(msgs_)
-            tgt = self.model.predict_batch(msgs_, maxlen)
+            with monitor.span('gpt2_sampling'):
+                tgt = self.generate(msgs_, maxlen, samples=batch_size, cache=self.prefix_cache)
             tgt = [self.vocab.convert_ids_to_tokens(i) for i in tgt]
             # cut from the first [SEP] token
             n_tgt = []
@@ -352,15 +737,17 @@ class GPT2Agent(BaseAgent):
             if self.args['run_mode'] == 'rerank_ir':
                 retrieval_rest = self.ir_agent.model.search(topic, msgs, samples=batch_size)
                 retrieval_rest = [i['response'] for i in retrieval_rest]
-                # remove the utterances that in the self.history
-                retrieval_rest = list(set(retrieval_rest) - set(self.history))
+                # remove the utterances that in the history of the session
+                retrieval_rest = list(set(retrieval_rest) - set(history))
                 n_tgt.extend(retrieval_rest)
             contexts = [msgs] * len(n_tgt)
-            if topic:
-                topic = [self.args['topic_transfer'][topic]]  * len(n_tgt)
-                scores = self.reranker(contexts, n_tgt, topic=topic, history=self.history)[0]
-            else:
-                scores = self.reranker(contexts, n_tgt, topic=None)[0]
+            monitor.record('candidates', len(n_tgt))
+            with monitor.span('rerank'):
+                if topic:
+                    topic = [self.args['topic_transfer'][topic]]  * len(n_tgt)
+                    scores = self.reranker(contexts, n_tgt, topic=topic, history=history)[0]
+                else:
+                    scores = self.reranker(contexts, n_tgt, topic=None)[0]
             index = np.argmax(scores)
             if index > batch_size:
                 print(f'[!] 从检索式对话系统中选择回复; bs/length/index: {batch_size}/{len(n_tgt)}/{index}')
@@ -370,3 +757,98 @@ class GPT2Agent(BaseAgent):
             return response
         else:
             raise Exception(f'[!] error in gpt2 model `talk` function')
+
+    def talk_stream(self, topic, msgs, maxlen=50, history=None):
+        '''
+        yield the tokens of the response once they are sampled (test mode, batch size is 1),
+        the rerank modes need all the candidates, so the streaming always uses the sampling
+        '''
+        # the topic trigger needs the MultiView reranker (rerank modes)
+        if topic and self.args['run_mode'] in ['rerank', 'rerank_ir']:
+            msgs = self.topic_trigger(topic, msgs)
+        msgs = torch.LongTensor(self.vocab.encode(msgs)[-(512-maxlen):])
+        msgs = to_cuda(msgs)
+        stream = self.model.predict_stream(msgs, maxlen, cache=self.prefix_cache)
+        try:
+            for token in stream:
+                yield self.vocab.convert_ids_to_tokens(token)
+        finally:
+            stream.close()
+
+    @torch.no_grad()
+    def talk_batch(self, topics, msgs, histories=None, deadline=None, maxlen=50, batch_size=16):
+        '''
+        topics, msgs: a batch of the conversations
+        histories: a batch of the history of the sessions
+        rerank mode: the candidates of all the conversations are generated by one predict_batch 
+        call (left padded contexts), and they are scored by one MultiView call
+        deadline: the degradation ladder (half of the samples and maxlen, skip the MMI/fluency scorers,
+        plain ES answer)
+        '''
+        if self.args['run_mode'] not in ['rerank', 'rerank_ir']:
+            return super(GPT2Agent, self).talk_batch(topics, msgs, histories=histories, deadline=deadline)
+        histories = histories if histories else [[] for _ in msgs]
+        # the hypotheses of the beam search are the candidates
+        if self.args['decoding'] != 'sampling':
+            batch_size = self.args['beam_size']
+        rung = obtain_rung(deadline)
+        if rung == 3:
+            record_rung(rung, len(msgs))
+            return [self.ir_agent.model.fallback(topic, msg, history=history) for topic, msg, history in zip(topics, msgs, histories)]
+        if rung >= 1:
+            batch_size, maxlen = max(1, batch_size // 2), max(1, maxlen // 2)
+        msgs = [msg if topic is None else self.topic_trigger(topic, msg) for topic, msg in zip(topics, msgs)]
+        with monitor.span('tokenize'):
+            ids = [torch.LongTensor(self.vocab.encode(msg)[-(512-maxlen):]) for msg in msgs]
+            ids, attn_mask = generate_left_padded_input(ids, pad=self.args['pad'])
+        if torch.cuda.is_available():
+            ids, attn_mask = ids.cuda(), attn_mask.cuda()
+        with monitor.span('gpt2_sampling'):
+            # each context is encoded once, and its past is shared by its batch_size samples
+            tgt = self.generate(ids, maxlen, attn_mask=attn_mask, samples=batch_size, cache=self.prefix_cache)
+        tgt = [self.vocab.convert_ids_to_tokens(i) for i in tgt]
+        # cut from the first [SEP] token
+        n_tgt = []
+        for i in tgt:
+            if '[SEP]' in i:
+                i = i[:i.index('[SEP]')]
+            n_tgt.append(''.join(i))
+        # the sampling may use up the budget, use the first sample of each conversation
+        rung = obtain_rung(deadline, rung)
+        if rung == 3:
+            record_rung(rung, len(msgs))
+            return [n_tgt[idx*batch_size] for idx in range(len(msgs))]
+        # collect the candidates of each conversation
+        contexts, candidates, topics_, histories_ = [], [], [], []
+        for idx, (topic, msg, history) in enumerate(zip(topics, msgs, histories)):
+            candidates_ = n_tgt[idx*batch_size:(idx+1)*batch_size]
+            if self.args['run_mode'] == 'rerank_ir':
+                retrieval_rest = self.ir_agent.model.search(topic, msg, samples=batch_size)
+                retrieval_rest = [i['response'] for i in retrieval_rest]
+                retrieval_rest = list(set(retrieval_rest) - set(history))
+                candidates_.extend(retrieval_rest)
+            candidates.append(candidates_)
+            contexts.extend([msg] * len(candidates_))
+            topic = self.args['topic_transfer'][topic] if topic else None
+            topics_.extend([topic] * len(candidates_))
+            histories_.extend([history] * len(candidates_))
+            monitor.record('candidates', len(candidates_))
+        with monitor.span('rerank'):
+            scores = self.reranker(
+                    contexts, 
+                    [j for i in candidates for j in i], 
+                    topic=topics_, 
+                    history=histories_,
+                    exclude=Deadline.expensive if rung == 2 else None)[0]
+        # split the scores for each conversation
+        rest, begin = [], 0
+        for topic, msg, history, candidates_ in zip(topics, msgs, histories, candidates):
+            if not candidates_:
+                # all the retrieval candidates are used by the session and no sample is generated
+                rest.append(self.ir_agent.model.fallback(topic, msg, history=history))
+                continue
+            scores_ = scores[begin:begin+len(candidates_)]
+            rest.append(candidates_[int(np.argmax(scores_))])
+            begin += len(candidates_)
+        record_rung(rung, len(msgs))
+        return rest
@@ -35,7 +35,8 @@ class GPT2RL_V2(nn.Module):
                  topk, topp,
                  config_path='data/config/model_config_dialogue_small.json',
                  vocab_path='data/vocab/vocab_small',
-                 memory=None):
+                 memory=None,
+                 shortlist_path=None):
         super(GPT2RL_V2, self).__init__()
         # vocab
         self.vocab = BertTokenizer(vocab_file=vocab_path)
@@ -62,6 +63,8 @@ class GPT2RL_V2(nn.Module):
         self.pad_id = self.vocab.convert_tokens_to_ids('[PAD]')
         self.rollout_samples = rollout_samples
         self.min_token_to_keep = min_token
+        # the VocabShortlist of the generation (generative_predict and rollout_batch), None is the full vocabulary
+        self.shortlist = VocabShortlist.load(shortlist_path, self.unk_id) if shortlist_path else None
 
         # load the pretrained model
         self.load_model(self.generator, generative_path)
@@ -105,20 +108,27 @@ class GPT2RL_V2(nn.Module):
         prev, past = inpt_ids.clone().detach(), None
         sep_batch_index = [0] * len(inpt_ids)
         sep_batch_flag = [0] * len(inpt_ids)
+        generator, ids = self.generator, None
+        if self.shortlist is not None:
+            # the lm head only computes the logits of the shortlist and the tokens of the contexts
+            generator, ids = self.shortlist.head(self.generator, inpt_ids)
+        # ignore the [UNK] token (not in the shortlist), top-k/top-p
+        pipeline = LogitsPipeline.build(
+                banned=[self.unk_id] if ids is None else [], 
+                top_k=self.sample_topk, 
+                top_p=self.sample_topp,
+                min_tokens_to_keep=self.min_token_to_keep)
         for i in range(max_len):
-            outputs = self.generator(input_ids=prev, past=past)
+            outputs = generator(input_ids=prev, past=past)
             outputs, past = outputs[:2]
             next_token_logits = outputs[:, -1, :]    # [batch, vocab]
-            # ignore the [UNK] token
-            next_token_logits[:, self.unk_id] = -np.inf
-            filtered_logits = top_k_top_p_filtering_batch(
-                    next_token_logits, 
-                    top_k=self.sample_topk, 
-                    top_p=self.sample_topp,
-                    min_token_to_keep=self.min_token_to_keep)
+            filtered_logits = pipeline(next_token_logits)
             next_token = torch.multinomial(
                     F.softmax(filtered_logits, dim=-1),
                     num_samples=1)    # [batch, 1]
+            if ids is not None:
+                # the positions in the shortlist -> the ids of the vocabulary
+                next_token = ids[next_token]
             for idx, token_ in enumerate(next_token.squeeze(1)):
                 if sep_batch_flag[idx] == 0 and token_ == self.sep_id:
                     sep_batch_index[idx] = i + 1
@@ -170,24 +180,31 @@ class GPT2RL_V2(nn.Module):
         batch_size = len(current_token)
         sep_batch_index = [[0] * batch_size for _ in range(self.rollout_samples)]
         rollout_rest = []
+        generator, ids = self.generator, None
+        if self.shortlist is not None:
+            # the lm head only computes the logits of the shortlist and the current tokens
+            generator, ids = self.shortlist.head(self.generator, current_token)
         for rollout_idx in range(self.rollout_samples):
             response = []
             sep_batch_flag = [0] * batch_size
             past_ = tuple([i.clone().detach() for i in past]) 
             current_token_ = current_token.clone().detach()
+            # ignore the [UNK] token (not in the shortlist), top-k/top-p
+            pipeline = LogitsPipeline.build(
+                    banned=[self.unk_id] if ids is None else [], 
+                    top_k=self.sample_topk, 
+                    top_p=self.sample_topp,
+                    min_tokens_to_keep=self.min_token_to_keep)
             for lid in range(max_len):
-                outputs = self.generator(input_ids=current_token_, past=past_)
+                outputs = generator(input_ids=current_token_, past=past_)
                 outputs, past_ = outputs[:2]
                 next_token_logits = outputs[:, -1, :]    # [batch, vocab]
-                next_token_logits[:, self.unk_id] = -np.inf
-                filtered_logits = top_k_top_p_filtering_batch(
-                        next_token_logits, 
-                        top_k=self.sample_topk, 
-                        top_p=self.sample_topp,
-                        min_token_to_keep=self.min_token_to_keep)
+                filtered_logits = pipeline(next_token_logits)
                 next_token = torch.multinomial(
                         F.softmax(filtered_logits, dim=-1),
                         num_samples=1)    # [batch, 1]
+                if ids is not None:
+                    next_token = ids[next_token]
                 current_token_ = next_token
                 # Action: next_token
                 for idx, token_ in enumerate(next_token.squeeze(1)):
@@ -261,16 +278,17 @@ class GPT2RL_V2(nn.Module):
         sep_batch_index = torch.LongTensor([0] * len(inpt_ids))
         sep_batch_flag = [0] * len(inpt_ids)
         prev, past, history = inpt_ids_, None, inpt_ids_
+        # ignore the [UNK] token, top-k/top-p
+        pipeline = LogitsPipeline.build(
+                banned=[self.unk_id], 
+                top_k=self.rl_topk, 
+                top_p=self.rl_topp,
+                min_tokens_to_keep=self.min_token_to_keep)
         for i in range(1, max_len+1):
             outputs = self.generator(input_ids=prev, past=past)
             outputs, past = outputs[:2]
             next_token_logits = outputs[:, -1, :]    # [batch, vocab]
-            next_token_logits[:, self.unk_id] = -np.inf
-            filtered_logits = top_k_top_p_filtering_batch(
-                    next_token_logits,
-                    top_k=self.rl_topk,
-                    top_p=self.rl_topp,
-                    min_token_to_keep=self.min_token_to_keep)    # [batch, vocab]
+            filtered_logits = pipeline(next_token_logits)    # [batch, vocab]
             filtered_logits = F.softmax(filtered_logits, dim=-1)    # [batch, vocab]
             # Action: next_token
             next_token = torch.multinomial(
@@ -402,6 +420,8 @@ class GPT2RLAgent_V2(BaseAgent):
             'memory_start': 500,
             'memory_batch_size': 32,
             'memory_ckpt_path': 'ckpt/train_generative_rl/gpt2gan/memory.pkl',
+            # the VocabShortlist of the rollout and the generation (utils/utils.py --mode shortlist), '' is off
+            'shortlist_path': '',
         }
         # hyperparameters
         
@@ -425,6 +445,7 @@ class GPT2RLAgent_V2(BaseAgent):
                 config_path=self.args['config_path'],
                 vocab_path=self.args['vocab_path'],
                 memory=self.debug_memory,
+                shortlist_path=self.args['shortlist_path'],
         )
 
         # replay memory iterator
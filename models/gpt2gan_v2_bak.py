@@ -96,17 +96,17 @@ class GPT2RL_V2(nn.Module):
         prev, past = inpt_ids.clone().detach(), None
         sep_batch_index = [0] * len(inpt_ids)
         sep_batch_flag = [0] * len(inpt_ids)
+        # ignore the [UNK] token, top-k/top-p
+        pipeline = LogitsPipeline.build(
+                banned=[self.unk_id], 
+                top_k=self.topk, 
+                top_p=self.topp,
+                min_tokens_to_keep=self.min_token_to_keep)
         for i in range(max_len):
             outputs = self.generator(input_ids=prev, past=past)
             outputs, past = outputs[:2]
             next_token_logits = outputs[:, -1, :]    # [batch, vocab]
-            # ignore the [UNK] token
-            next_token_logits[:, self.unk_id] = -np.inf
-            filtered_logits = top_k_top_p_filtering_batch(
-                    next_token_logits, 
-                    top_k=self.topk, 
-                    top_p=self.topp,
-                    min_token_to_keep=self.min_token_to_keep)
+            filtered_logits = pipeline(next_token_logits)
             next_token = torch.multinomial(
                     F.softmax(filtered_logits, dim=-1),
                     num_samples=1)    # [batch, 1]
@@ -165,16 +165,17 @@ class GPT2RL_V2(nn.Module):
             sep_batch_flag = [0] * batch_size
             past_ = tuple([i.clone().detach() for i in past]) 
             current_token_ = current_token.clone().detach()
+            # ignore the [UNK] token, top-k/top-p
+            pipeline = LogitsPipeline.build(
+                    banned=[self.unk_id], 
+                    top_k=self.topk, 
+                    top_p=self.topp,
+                    min_tokens_to_keep=self.min_token_to_keep)
             for lid in range(max_len):
                 outputs = self.generator(input_ids=current_token_, past=past_)
                 outputs, past_ = outputs[:2]
                 next_token_logits = outputs[:, -1, :]    # [batch, vocab]
-                next_token_logits[:, self.unk_id] = -np.inf
-                filtered_logits = top_k_top_p_filtering_batch(
-                        next_token_logits, 
-                        top_k=self.topk, 
-                        top_p=self.topp,
-                        min_token_to_keep=self.min_token_to_keep)
+                filtered_logits = pipeline(next_token_logits)
                 next_token = torch.multinomial(
                         F.softmax(filtered_logits, dim=-1),
                         num_samples=1)    # [batch, 1]
@@ -255,16 +256,17 @@ class GPT2RL_V2(nn.Module):
         sep_batch_index = torch.LongTensor([0] * len(inpt_ids))
         sep_batch_flag = [0] * len(inpt_ids)
         prev, past, history = inpt_ids_, None, inpt_ids_
+        # ignore the [UNK] token, top-k/top-p
+        pipeline = LogitsPipeline.build(
+                banned=[self.unk_id], 
+                top_k=self.topk, 
+                top_p=self.topp,
+                min_tokens_to_keep=self.min_token_to_keep)
         for i in range(1, max_len+1):
             outputs = self.generator(input_ids=prev, past=past)
             outputs, past = outputs[:2]
             next_token_logits = outputs[:, -1, :]    # [batch, vocab]
-            next_token_logits[:, self.unk_id] = -np.inf
-            filtered_logits = top_k_top_p_filtering_batch(
-                    next_token_logits,
-                    top_k=self.topk,
-                    top_p=self.topp,
-                    min_token_to_keep=self.min_token_to_keep)    # [batch, vocab]
+            filtered_logits = pipeline(next_token_logits)    # [batch, vocab]
             filtered_logits = F.softmax(filtered_logits, dim=-1)    # [batch, vocab]
             # Action: next_token
             next_token = torch.multinomial(
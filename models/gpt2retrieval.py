@@ -91,22 +91,18 @@ class GPT2Retrieval(nn.Module):
             rest = torch.stack(rest).mean(dim=0)    # [hidden]
             '''
             rest = candidates.float()
-            generated, past = [], None
+            # ignore the [UNK] token, top-k/top-p
+            pipeline = LogitsPipeline.build(banned=[self.unk_id], top_k=self.topk, top_p=self.topp)
+            generated, state, past = [], None, None
             for _ in range(max_len):
                 outputs = self.model(input_ids=inpt_ids, past=past)
                 outputs, past = outputs[:2]
                 next_token_logits = outputs[-1, :]    # [hidden]
                 next_token_logits = torch.cat((next_token_logits, rest))    # [hidden+300]
                 next_token_logits = self.lm_head(next_token_logits)    # [vocab_size]
-                # ignore the [UNK] token
-                next_token_logits[self.unk_id] = -np.inf
-                filtered_logits = top_k_top_p_filtering(
-                        next_token_logits, 
-                        top_k=self.topk, 
-                        top_p=self.topp)
-                next_token = torch.multinomial(
-                        F.softmax(filtered_logits, dim=-1),
-                        num_samples=1)
+                if state is None:
+                    state = pipeline.init_state(next_token_logits)
+                next_token = pipeline.sample(next_token_logits, state)    # [1]
                 if next_token == self.sep_id:
                     break
                 generated.append(next_token.item())
@@ -242,9 +238,10 @@ class GPT2RetrievalAgent(BaseAgent):
         (b1, b2, b3, b4), ((r_max_l, r_min_l, r_avg_l), (c_max_l, c_min_l, c_avg_l)), (dist1, dist2, rdist1, rdist2), (average, extrema, greedy) = cal_generative_metric(path, lang=self.args['lang'])
         print(f'[TEST] BLEU: {b1}/{b2}/{b3}/{b4}; Length(max, min, avg): {c_max_l}/{c_min_l}/{c_avg_l}|{r_max_l}/{r_min_l}/{r_avg_l}; Dist: {dist1}/{dist2}|{rdist1}/{rdist2}; Embedding(average/extrema/greedy): {average}/{extrema}/{greedy}')
     
-    def talk(self, topic, msgs, maxlen=30):
+    def talk(self, topic, msgs, maxlen=30, history=None):
         '''
         topic, msgs: msgs is a string which split with the [SEP] token
+        history: the history of the session (not used by the generation)
         batch size is 1
         '''
         # tokenizer
@@ -1,3 +1,5 @@
+# the heavy dependencies are imported when they are used for the first time (lazy.py)
+from lazy import lazy_import, lazy_from
 import torch
 from torch.nn.parallel.data_parallel import DataParallel
 from torch.nn.parallel.parallel_apply import parallel_apply
@@ -5,8 +7,8 @@ from torch.nn.parallel._functions import Scatter
 import numpy as np
 from math import *
 from queue import *
-import jieba.analyse
-import ipdb
+jieba = lazy_import('jieba', submodules=['analyse'])
+ipdb = lazy_import('ipdb')
 import json
 import re
 import pickle
@@ -20,21 +22,30 @@ import torch.nn.init as init
 from torch.nn.utils.rnn import pad_sequence
 import torch.optim as optim
 from torch.optim import lr_scheduler
-from collections import Counter, OrderedDict
+from collections import Counter, OrderedDict, deque
 from torch.nn.utils import clip_grad_norm_
 import random
-from elasticsearch import Elasticsearch, helpers
+import time
+import threading
+Elasticsearch = lazy_from('elasticsearch', 'Elasticsearch')
+helpers = lazy_import('elasticsearch.helpers')
+from .monitor import *
 from .model_utils import *
 from .base import *
-from bert_serving.client import BertClient
-from transformers.modeling_gpt2 import GPT2Model, GPT2Config, GPT2LMHeadModel
-from transformers import BertTokenizer
-from transformers import BertForSequenceClassification, BertModel
-from transformers import AutoModelWithLMHead, AutoTokenizer
-import transformers
-import requests
+BertClient = lazy_from('bert_serving.client', 'BertClient')
+GPT2Model = lazy_from('transformers.modeling_gpt2', 'GPT2Model')
+GPT2Config = lazy_from('transformers.modeling_gpt2', 'GPT2Config')
+GPT2LMHeadModel = lazy_from('transformers.modeling_gpt2', 'GPT2LMHeadModel')
+BertTokenizer = lazy_from('transformers', 'BertTokenizer')
+BertForSequenceClassification = lazy_from('transformers', 'BertForSequenceClassification')
+BertModel = lazy_from('transformers', 'BertModel')
+AutoModelWithLMHead = lazy_from('transformers', 'AutoModelWithLMHead')
+AutoTokenizer = lazy_from('transformers', 'AutoTokenizer')
+transformers = lazy_import('transformers')
+requests = lazy_import('requests')
 # for PONE
-from scipy.stats import pearsonr, spearmanr
+pearsonr = lazy_from('scipy.stats', 'pearsonr')
+spearmanr = lazy_from('scipy.stats', 'spearmanr')
 
 import sys
 sys.path.append('..')
@@ -35,73 +35,101 @@ class KWGPT2(nn.Module):
         output = outputs[0]    # [batch, seq, vocab]
         return output
 
-    def predict(self, inpt_ids, max_len):
+    def logits_pipeline(self):
+        '''
+        ignore the [UNK] token, repetition penalty, top-k/top-p
+        '''
+        return LogitsPipeline.build(
+                banned=[self.unk_id], 
+                repetition_penalty=self.repetition_penalty, 
+                top_k=self.topk, 
+                top_p=self.topp)
+
+    def predict(self, inpt_ids, max_len, cache=None):
         '''
         batch_size is 1
         inpt_ids: [seq]
         return a list of ids (generated)
         no pad, do not need attention_mask
+        cache: the PrefixKVCache of the contexts in the previous turns (only the new tokens are prefilled)
         '''
-        with torch.no_grad():
-            generated = []
-            stp_counter = 0
-            for _ in range(max_len):
-                outputs = self.model(input_ids=inpt_ids)
-                next_token_logits = outputs[0][-1, :]    # [vocab]
-                # ignore the [UNK] token
-                next_token_logits[self.unk_id] = -np.inf
-                # repetition penalty
-                if generated:
-                    next_token_logits[list(set(generated))] /= self.repetition_penalty
-                filtered_logits = top_k_top_p_filtering(
-                        next_token_logits, 
-                        top_k=self.topk, 
-                        top_p=self.topp)
-                next_token = torch.multinomial(
-                        F.softmax(filtered_logits, dim=-1),
-                        num_samples=1)
-                if next_token == self.stp_id:
-                    stp_counter += 1
-                    if stp_counter == 2:
-                        break
-                generated.append(next_token.item())
-                inpt_ids = torch.cat((inpt_ids, next_token), dim=0)
-                # remember to cut off 
-                inpt_ids = inpt_ids[-self.n_ctx:]
-            return generated
+        return list(self.predict_stream(inpt_ids, max_len, cache=cache))
+
+    def predict_stream(self, inpt_ids, max_len, cache=None):
+        '''
+        same as predict, but yield the id once it is sampled (streaming API),
+        stop on the second [STP] token or when the generator is closed by the consumer
+        '''
+        pipeline = self.logits_pipeline()
+        state, past = None, None
+        stp_counter = 0
+        for _ in range(max_len):
+            with torch.no_grad():
+                # only the new token is fed, the tokens before it are cached in the past
+                next_token_logits, past = kv_cache_forward(self.model, inpt_ids, past=past, cache=cache)    # [vocab]
+                if state is None:
+                    state = pipeline.init_state(next_token_logits)
+                # ignore the [UNK] token, repetition penalty, top-k/top-p
+                next_token = pipeline.sample(next_token_logits, state)    # [1]
+            if next_token == self.stp_id:
+                stp_counter += 1
+                if stp_counter == 2:
+                    break
+            yield next_token.item()
+            inpt_ids = torch.cat((inpt_ids, next_token), dim=0)
+            # remember to cut off 
+            inpt_ids = inpt_ids[-self.n_ctx:]
 
     @torch.no_grad()
-    def predict_batch(self, inpt_ids, max_len):
+    def predict_batch(self, inpt_ids, max_len, attn_mask=None, samples=1, cache=None):
         '''
         inpt_ids: [batch, seq]
+        attn_mask: [batch, seq], the mask of the left padded inpt_ids (contexts have different lengths)
+        samples: number of the samples of each context, the context is encoded once and its past
+                 is shared by the samples (the samples of one context are adjacent in the results)
+        cache: the PrefixKVCache of the contexts in the previous turns (only the new tokens are prefilled)
+        stop once every sample generates the second [STP] token (the tokens after it are not used)
         '''
-        # change inpt_ids from [seq] to [batch, seq]
-        generated = []
-        prev, past = inpt_ids, None
-        batch_size = inpt_ids.shape[0]
-        for _ in range(max_len):
-            outputs = self.model(input_ids=prev, past=past)    # [batch, seq, vocab]
-            output, past = outputs[:2]
-            next_token_logits = output[:, -1, :]    # [batch, vocab]
-            next_token_logits[:, self.unk_id] = -np.inf
-            # repetition penalty
-            for x in range(batch_size):
-                y = [itme[x] for item in generated]
-                next_token_logits[x, y] /= self.repetition_penalty
-            filtered_logits = top_k_top_p_filtering_batch(
-                    next_token_logits, 
-                    top_k=self.topk, 
-                    top_p=self.topp)
-            next_token = torch.multinomial(
-                    F.softmax(filtered_logits, dim=-1),
-                    num_samples=1)    # [batch, 1]
-            generated.append([token.item() for token in next_token.squeeze(1)])
+        position_ids = None
+        if attn_mask is not None:
+            # the left pad tokens are ignored, position ids start from the first real token
+            position_ids = (attn_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        next_token_logits, past = shared_prefill(
+                self.model, inpt_ids, 
+                samples=samples, 
+                attn_mask=attn_mask, 
+                position_ids=position_ids,
+                cache=cache)    # [batch*samples, vocab]
+        if attn_mask is not None:
+            attn_mask = expand_samples(attn_mask, samples)
+            position_ids = expand_samples(position_ids[:, -1:], samples)
+        batch_size = inpt_ids.shape[0] * samples
+        # the generated ids stay on the device, and are copied to the host at the end
+        generated = torch.zeros(batch_size, max_len, dtype=torch.long, device=inpt_ids.device)
+        pipeline, state, step = self.logits_pipeline(), None, -1
+        stp_counter = torch.zeros(batch_size, dtype=torch.long, device=inpt_ids.device)
+        for step in range(max_len):
+            if step > 0:
+                outputs = self.model(
+                        input_ids=prev, 
+                        past=past,
+                        attention_mask=attn_mask,
+                        position_ids=position_ids)    # [batch, 1, vocab]
+                output, past = outputs[:2]
+                next_token_logits = output[:, -1, :]    # [batch, vocab]
+            if state is None:
+                state = pipeline.init_state(next_token_logits)
+            # ignore the [UNK] token, repetition penalty, top-k/top-p
+            next_token = pipeline.sample(next_token_logits, state)    # [batch, 1]
+            generated[:, step] = next_token.squeeze(1)
+            stp_counter += (next_token.squeeze(1) == self.stp_id).long()
             prev = next_token
-        # transpose
-        ng, batch_size = [], len(generated[0])
-        for i in range(batch_size):
-            ng.append([g[i] for g in generated])
-        return ng
+            if attn_mask is not None:
+                attn_mask = torch.cat((attn_mask, torch.ones_like(next_token)), dim=1)
+                position_ids = position_ids[:, -1:] + 1
+            if (stp_counter >= 2).all():
+                break
+        return generated[:, :step+1].tolist()
 
 class KWGPT2Agent(BaseAgent):
 
@@ -135,6 +163,7 @@ class KWGPT2Agent(BaseAgent):
                 'topic_transfer': {'音乐': 'music', '体育': 'sport', '数码产品': 'electric', '美食': 'food', '电影': 'movie'},
                 'balanceddata_parallel_gpu0_size': 2,
                 'repetition_penalty': 1.5,
+                'prefix_cache_tokens': 8192,
         }
         # hyperparameters
 
@@ -158,6 +187,11 @@ class KWGPT2Agent(BaseAgent):
                 config_path=self.args['config_path']
         )
 
+        # the key/value cache of the contexts in the previous turns of the conversations
+        self.prefix_cache = None
+        if run_mode not in ['train', 'train_trs']:
+            self.prefix_cache = PrefixKVCache(self.model.n_ctx, capacity=self.args['prefix_cache_tokens'])
+
         self.criterion = nn.CrossEntropyLoss(ignore_index=self.args['pad'], reduction='sum')
         self.optimizer = transformers.AdamW(
                 self.model.parameters(), 
@@ -252,6 +286,7 @@ class KWGPT2Agent(BaseAgent):
     def test_model(self, test_iter, path):
         '''
         Generate the test dataset and measure the performance
+        the contexts in the batch are left padded (gpt2_test_collate_fn_batch) and generated together
         '''
         def filter(x):
             return x.replace('[PAD]', '')
@@ -259,47 +294,64 @@ class KWGPT2Agent(BaseAgent):
         pbar = tqdm(test_iter)
         with open(path, 'w') as f:
             for batch in pbar:
-                c, r = batch
-                max_size = max(len(r), self.args['tgt_len_size'])
-                tgt = self.model.predict(c, max_size)
-                text = self.vocab.convert_ids_to_tokens(tgt)
-                tgt = ''.join(text)
+                c, attn_mask, r = batch    # c/attn_mask: [batch, seq]; r: batch*[seq]
+                max_size = max(max(len(i) for i in r), self.args['tgt_len_size'])
+                # room for the generation in the window
+                c, attn_mask = c[:, -(self.model.n_ctx-max_size):], attn_mask[:, -(self.model.n_ctx-max_size):]
+                tgt = self.model.predict_batch(c, max_size, attn_mask=attn_mask)
+                for c_, m_, r_, t_ in zip(c, attn_mask, r, tgt):
+                    # cut from the second [STP] token
+                    stp = [idx for idx, i in enumerate(t_) if i == self.model.stp_id]
+                    if len(stp) >= 2:
+                        t_ = t_[:stp[1]]
+                    text = self.vocab.convert_ids_to_tokens(t_)
+                    tgt_ = ''.join(text)
 
-                ctx = self.vocab.convert_ids_to_tokens(c)
-                ctx = filter(''.join(ctx))
+                    ctx = self.vocab.convert_ids_to_tokens(c_[m_.bool()])
+                    ctx = filter(''.join(ctx))
 
-                ref = self.vocab.convert_ids_to_tokens(r)
-                ref = filter(''.join(ref))
+                    ref = self.vocab.convert_ids_to_tokens(r_)
+                    ref = filter(''.join(ref))
 
-                f.write(f'CTX: {ctx}\n')
-                f.write(f'REF: {ref}\n')
-                f.write(f'TGT: {tgt}\n\n')
+                    f.write(f'CTX: {ctx}\n')
+                    f.write(f'REF: {ref}\n')
+                    f.write(f'TGT: {tgt_}\n\n')
         print(f'[!] translate test dataset over, write into {path}')
         # measure the performance
         (b1, b2, b3, b4), ((r_max_l, r_min_l, r_avg_l), (c_max_l, c_min_l, c_avg_l)), (dist1, dist2, rdist1, rdist2), (average, extrema, greedy) = cal_generative_metric(path, lang=self.args['lang'])
         print(f'[TEST] BLEU: {b1}/{b2}/{b3}/{b4}; Length(max, min, avg): {c_max_l}/{c_min_l}/{c_avg_l}|{r_max_l}/{r_min_l}/{r_avg_l}; Dist: {dist1}/{dist2}|{rdist1}/{rdist2}; Embedding(average/extrema/greedy): {average}/{extrema}/{greedy}')
     
+    def talk_stream(self, topic, msgs, maxlen=30, history=None):
+        '''
+        yield the tokens (keywords and response) once they are sampled (test mode, batch size is 1)
+        '''
+        msgs = torch.LongTensor(self.vocab.encode(msgs))
+        msgs = to_cuda(msgs)
+        stream = self.model.predict_stream(msgs, maxlen, cache=self.prefix_cache)
+        try:
+            for token in stream:
+                yield self.vocab.convert_ids_to_tokens(token)
+        finally:
+            stream.close()
+
     @torch.no_grad()
-    def talk(self, topic, msgs, maxlen=30, batch_size=16):
+    def talk(self, topic, msgs, maxlen=30, batch_size=16, history=None):
         '''
         topic, msgs: msgs is a string which split with the [SEP] token
+        history: the history of the session
         batch size is 1
         '''
+        history = history or []
         # tokenizer
         if self.args['run_mode'] == 'test':
-            msgs = torch.LongTensor(self.vocab.encode(msgs))
-            msgs = to_cuda(msgs)
-            tgt = self.model.predict(msgs, maxlen)
-            tgt = self.vocab.convert_ids_to_tokens(tgt)
-            tgt = ''.join(tgt)
-            return tgt
+            return ''.join(self.talk_stream(topic, msgs, maxlen=maxlen, history=history))
         elif self.args['run_mode'] in ['rerank', 'rerank_ir']:
             # ========== predict_batch ==========
             msgs_ = self.vocab.encode(msgs)
-            msgs_ = [deepcopy(msgs_) for _ in range(batch_size)]
-            msgs_ = torch.LongTensor(msgs_)    # [batch, seq]
+            # the context is encoded once, and its past is shared by the samples
+            msgs_ = torch.LongTensor(msgs_).unsqueeze(0)    # [1, seq]
             msgs_ = to_cuda(msgs_)
-            tgt = self.model.predict_batch(msgs_, maxlen)
+            tgt = self.model.predict_batch(msgs_, maxlen, samples=batch_size, cache=self.prefix_cache)
             tgt = [self.vocab.convert_ids_to_tokens(i) for i in tgt]
             # cut from the first [SEP] token
             n_tgt = []
@@ -312,10 +364,12 @@ class KWGPT2Agent(BaseAgent):
             if self.args['run_mode'] == 'rerank_ir':
                 retrieval_rest = self.ir_agent.model.search(topic, msgs, samples=batch_size)
                 retrieval_rest = [i['response'] for i in retrieval_rest]
+                # remove the utterances that in the history of the session
+                retrieval_rest = list(set(retrieval_rest) - set(history))
                 n_tgt.extend(retrieval_rest)
             contexts = [msgs] * len(n_tgt)
             topic = [self.args['topic_transfer'][topic]]  * len(n_tgt)
-            scores = self.reranker(contexts, n_tgt, topic=topic)[0]
+            scores = self.reranker(contexts, n_tgt, topic=topic, history=history)[0]
             index = np.argmax(scores)
             if index > batch_size:
                 print(f'[!] 从检索式对话系统中选择回复; bs/length/index: {batch_size}/{len(n_tgt)}/{index}')
@@ -7,6 +7,9 @@ from .header import *
 4. KeyWordParser
 5. ReplayMemory
 6. BalancedDataParallel
+7. SessionStore
+8. Deadline
+9. PrefixKVCache
 '''
 
 class ReplayMemory:
@@ -79,6 +82,275 @@ class ReplayMemory:
     def __len__(self):
         return self.memory.qsize()
 
+class SessionStore:
+
+    '''
+    Conversation history of each session (group_id/user) for the serving agents,
+    which replaces the single global `self.history` list.
+
+    1. each session only keeps the recent `window` utterances talked by the agent
+    2. the sessions that are idle for more than `timeout` seconds are removed
+    3. the least recently used sessions are evicted if the number of the sessions
+       or the memory (bytes of the saved utterances) exceeds the limitation
+    '''
+
+    def __init__(self, window=50, max_sessions=10000, max_memory=64*1024*1024, timeout=3600):
+        self.window = window
+        self.max_sessions = max_sessions
+        self.max_memory = max_memory
+        self.timeout = timeout
+        # session_id -> {'history': deque, 'time': last access time}, LRU order
+        self.sessions = OrderedDict()
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def _size(self, utterance):
+        return len(utterance.encode('utf-8'))
+
+    def _evict(self):
+        '''
+        the first session of the OrderedDict is the least recently used one
+        '''
+        now = time.time()
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) > self.max_sessions or \
+                    self.memory > self.max_memory or \
+                    now - session['time'] > self.timeout:
+                self.sessions.popitem(last=False)
+                self.memory -= sum([self._size(i) for i in session['history']])
+            else:
+                break
+
+    def history(self, session_id):
+        '''
+        return the bounded history (a list of utterances) of the session
+        '''
+        with self.lock:
+            self._evict()
+            session = self.sessions.get(session_id)
+            if session is None:
+                return []
+            session['time'] = time.time()
+            self.sessions.move_to_end(session_id)
+            return list(session['history'])
+
+    def append(self, session_id, utterance):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = {'history': deque(), 'time': None}
+                self.sessions[session_id] = session
+            if len(session['history']) == self.window:
+                self.memory -= self._size(session['history'].popleft())
+            session['history'].append(utterance)
+            session['time'] = time.time()
+            self.memory += self._size(utterance)
+            self.sessions.move_to_end(session_id)
+            self._evict()
+
+    def clear(self, session_id=None):
+        '''
+        clear one session, or all the sessions if session_id is None
+        '''
+        with self.lock:
+            if session_id is None:
+                self.sessions.clear()
+                self.memory = 0
+            elif session_id in self.sessions:
+                session = self.sessions.pop(session_id)
+                self.memory -= sum([self._size(i) for i in session['history']])
+
+    def __len__(self):
+        return len(self.sessions)
+
+class Deadline:
+
+    '''
+    Time budget (seconds) of one request, the agents step through the degradation ladder
+    as the remaining fraction of the budget runs low:
+
+    0. full: all the candidates (samples) and all the scorers
+    1. reduced: fewer candidates, fewer samples and shorter maxlen
+    2. no_expensive: reduced, and the expensive MMI/fluency scorers are skipped
+    3. fallback: the plain ES answer (or the first sample if the responses are already generated)
+
+    ladder: the remaining fractions of the budget where the rungs 1, 2, 3 begin
+    '''
+
+    rungs = ['full', 'reduced', 'no_expensive', 'fallback']
+    expensive = ['mmi', 'fluency']
+
+    def __init__(self, budget=None, ladder=(0.75, 0.5, 0.25)):
+        self.begin = time.time()
+        self.budget, self.ladder = budget, ladder
+
+    def remaining(self):
+        if not self.budget:
+            return inf
+        return self.budget - (time.time() - self.begin)
+
+    def rung(self):
+        if not self.budget:
+            return 0
+        fraction = self.remaining() / self.budget
+        for idx, threshold in enumerate(self.ladder):
+            if fraction > threshold:
+                return idx
+        return len(self.ladder)
+
+    @staticmethod
+    def tightest(deadlines):
+        '''
+        the requests in one batch share the deadline with the least remaining time
+        '''
+        deadlines = [i for i in deadlines if i is not None]
+        if not deadlines:
+            return None
+        return min(deadlines, key=lambda i: i.remaining())
+
+def obtain_rung(deadline, rung=0):
+    '''
+    the rung never goes back during one request
+    '''
+    if deadline is None:
+        return rung
+    return max(rung, deadline.rung())
+
+def record_rung(rung, num=1):
+    monitor.count('degradation', num, stage=Deadline.rungs[rung])
+
+class PrefixNode:
+
+    '''
+    count: number of the cached contexts that pass through this node
+    entry: one of these contexts (its past covers the prefix of this node)
+    end: the cached context that ends at this node
+    '''
+
+    __slots__ = ['children', 'count', 'entry', 'end']
+
+    def __init__(self):
+        self.children, self.count, self.entry, self.end = {}, 0, None, None
+
+class PrefixKVCache:
+
+    '''
+    Key/value cache (past) of the contexts prefilled in the previous turns, indexed by a token-prefix tree,
+    the new turn of the conversation only prefills the newly appended utterances
+
+    1. the past of the tokens [0, j) only depends on these tokens (causal attention), so the past of one
+       cached context is reused (sliced) by any context that shares its first j tokens
+    2. the positions of the cached past start from 0, the context that is truncated at n_ctx (the oldest
+       tokens are dropped) never matches the prefixes before the truncation, and the context that fills
+       the whole window (no room for the generation) is not cached
+    3. the cached context that is the prefix of the new one (the last turn of the session) is replaced by it
+    4. LRU eviction when the total number of the cached tokens exceeds `capacity`
+    '''
+
+    def __init__(self, n_ctx, capacity=8192):
+        self.n_ctx, self.capacity = n_ctx, capacity
+        self.root = PrefixNode()
+        # tokens (tuple) -> past n_layer*[2, 1, head, seq, head_dim], in the LRU order
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.lookups, self.hits, self.saved_tokens, self.total_tokens = 0, 0, 0, 0
+
+    def _match(self, tokens):
+        '''
+        return the length of the longest cached prefix of the tokens and the context that covers it
+        '''
+        node, depth, entry = self.root, 0, None
+        for token in tokens:
+            node = node.children.get(token)
+            if node is None:
+                break
+            depth, entry = depth + 1, node.entry
+        return depth, entry
+
+    def _insert(self, tokens, past):
+        self.entries[tokens] = past
+        self.size += len(tokens)
+        node = self.root
+        for token in tokens:
+            node = node.children.setdefault(token, PrefixNode())
+            node.count += 1
+            node.entry = tokens
+        node.end = tokens
+        while self.size > self.capacity and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, tokens):
+        self.entries.pop(tokens)
+        self.size -= len(tokens)
+        path, node = [], self.root
+        for token in tokens:
+            child = node.children[token]
+            child.count -= 1
+            if child.count == 0:
+                # no other cached context passes through this node
+                del node.children[token]
+                break
+            path.append(child)
+            node = child
+        else:
+            node.end = None
+        # the nodes that are still used by the other contexts
+        for node in path:
+            if node.entry is tokens:
+                node.entry = self._any_entry(node)
+
+    def _any_entry(self, node):
+        while node.end is None:
+            node = next(iter(node.children.values()))
+        return node.end
+
+    def prefill(self, model, inpt_ids):
+        '''
+        inpt_ids: [seq], one context
+        return the logits of the tokens that are not cached [seq-reused, vocab] and the past of the whole context
+        '''
+        tokens = tuple(inpt_ids.tolist())
+        with self.lock:
+            depth, entry = self._match(tokens)
+            # at least one token is fed to obtain the logits of the next token
+            reused = min(depth, len(tokens) - 1)
+            past = None
+            if reused > 0:
+                self.entries.move_to_end(entry)
+                past = tuple(p[..., :reused, :] for p in self.entries[entry])
+            self.lookups += 1
+            self.hits += int(reused > 0)
+            self.saved_tokens += reused
+            self.total_tokens += len(tokens)
+        monitor.count('prefix_cache_lookups')
+        monitor.count('prefix_cache_hits', int(reused > 0))
+        monitor.count('prefix_cache_saved_tokens', reused)
+        monitor.count('prefix_cache_prefill_tokens', len(tokens))
+        outputs = model(input_ids=inpt_ids[reused:], past=past)
+        logits, past = outputs[:2]
+        # the context that is covered by a cached context (depth == len(tokens)) is not cached again
+        if depth < len(tokens) < self.n_ctx:
+            with self.lock:
+                if tokens not in self.entries:
+                    if entry is not None and entry in self.entries and depth == len(entry):
+                        # the last turn of this conversation, which is covered by the new context
+                        self._remove(entry)
+                    self._insert(tokens, past)
+        return logits, past
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'tokens': self.size,
+                'lookups': self.lookups,
+                'hit_ratio': round(self.hits / self.lookups, 4) if self.lookups else 0,
+                'saved_tokens': self.saved_tokens,
+                'saved_ratio': round(self.saved_tokens / self.total_tokens, 4) if self.total_tokens else 0,
+            }
+
 class KWParser:
 
     '''
@@ -258,7 +530,11 @@ class ESChat:
         }
         begin_samples, rest = samples, []
         while len(rest) == 0:
-            hits = self.es.search(index=self.index, body=dsl, size=begin_samples)['hits']['hits']
+            if begin_samples > samples:
+                # all the hits are filtered, search again with more samples
+                monitor.count('es_search_retries')
+            with monitor.span('es_search'):
+                hits = self.es.search(index=self.index, body=dsl, size=begin_samples)['hits']['hits']
             for h in hits:
                 item = {
                     'score': h['_score'], 
@@ -285,6 +561,18 @@ class ESChat:
         rest = self.es.msearch(body=request)
         return rest
 
+    def fallback(self, topic, msgs, history=None, samples=10):
+        '''
+        the plain ES answer (the last rung of the degradation ladder),
+        the top response that is not used by the session
+        '''
+        rest = [i['response'] for i in self.search(topic, msgs, samples=samples)]
+        history = set(history or [])
+        for i in rest:
+            if i not in history:
+                return i
+        return rest[0]
+
     def talk(self, topic, msgs):
         rest = self.search(topic, msgs, samples=1)[0]['response']
         # for debug
@@ -355,51 +643,338 @@ class IRHead(nn.Module):
         score = torch.sigmoid(self.opt_layer(inpt).squeeze(1))    # [batch]
         return score
 
-def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-np.inf):
-    assert logits.dim() == 1
-    top_k = min(top_k, logits.size(-1))
-    if top_k > 0:
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-    if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-        sorted_indices_to_remove = cumulative_probs > top_p
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
-    return logits
-
-def top_k_top_p_filtering_batch(logits, top_k=0, top_p=0.0, filter_value=-np.inf, 
-                                min_token_to_keep=1):
-    '''
-    :logits: [batch, vocab]
-    :return logits: [batch, vocab]
-    refer to https://zhuanlan.zhihu.com/p/115076102
-    '''
-    if top_k > 0:
-        top_k = min(max(top_k, min_token_to_keep), logits.size(-1))
-        # indices_to_remove: [batch, 1]
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-    if top_p < 1.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-        sorted_indices_to_remove = cumulative_probs > top_p    # [batch, vocab]
-        if min_token_to_keep > 1:
-            # make sure the min_token_to_keep token must not to be filtered
-            sorted_indices_to_remove[..., :min_token_to_keep] = 0
-        # shift the indices to the right to keep also the first token above the threshold
-        # avoid the probability of the first token is below the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        indices_to_remove = sorted_indices_to_remove.scatter(
-                1, sorted_indices, sorted_indices_to_remove)
-        logits[indices_to_remove] = filter_value
-    return logits
+class SamplingState:
+
+    '''
+    the state of the decoding shared by the logits processors
+    presence: [batch, vocab], presence[x, y] is True if the token y is generated by the row x
+    step: number of the generated tokens
+    '''
+
+    def __init__(self):
+        self.presence, self.step = None, 0
+
+    def update(self, next_token):
+        '''
+        next_token: [batch, 1]
+        '''
+        self.presence.scatter_(1, next_token, True)
+        self.step += 1
+
+    def select(self, keep):
+        '''
+        keep the rows of the active samples (the finished ones are dropped from the batch)
+        '''
+        self.presence = self.presence[keep]
+
+class BanTokens:
+
+    '''
+    the tokens (e.g. [UNK]) are never sampled
+    '''
+
+    def __init__(self, ids):
+        self.ids = list(ids)
+
+    def __call__(self, logits, state):
+        logits[:, self.ids] = -np.inf
+        return logits
+
+class RepetitionPenalty:
+
+    '''
+    the logits of the tokens that are already generated are divided by the penalty
+    '''
+
+    def __init__(self, penalty):
+        self.penalty = penalty
+
+    def __call__(self, logits, state):
+        return torch.where(state.presence, logits / self.penalty, logits)
+
+class Temperature:
+
+    def __init__(self, temperature):
+        self.temperature = temperature
+
+    def __call__(self, logits, state):
+        return logits / self.temperature
+
+class MinLength:
+
+    '''
+    the end tokens (e.g. [SEP]) are not sampled before `min_length` tokens are generated
+    '''
+
+    def __init__(self, min_length, ids):
+        self.min_length, self.ids = min_length, list(ids)
+
+    def __call__(self, logits, state):
+        if state.step < self.min_length:
+            logits[:, self.ids] = -np.inf
+        return logits
+
+class TopKTopP:
+
+    '''
+    keep the top_k tokens, and the smallest set of them whose cumulative probability exceeds top_p;
+    the nucleus is found inside the top_k set (torch.topk is sorted), the full vocabulary is only
+    sorted if top_k is 0. top_k = 0 or top_p >= 1 means no filtering.
+    min_tokens_to_keep: the tokens that are never removed by the top_p
+    '''
+
+    def __init__(self, top_k=0, top_p=1.0, min_tokens_to_keep=1):
+        self.top_k, self.top_p, self.min_tokens_to_keep = top_k, top_p, min_tokens_to_keep
+
+    def __call__(self, logits, state):
+        values, indices = self.compact(logits)
+        if indices is None:
+            return logits
+        return torch.full_like(logits, -np.inf).scatter_(1, indices, values)
+
+    def compact(self, logits):
+        '''
+        return the logits of the kept tokens [batch, k] (-inf for the ones removed by the top_p)
+        and their ids [batch, k]; the ids are None if nothing is filtered
+        '''
+        top_k = min(max(self.top_k, self.min_tokens_to_keep), logits.size(-1)) if self.top_k > 0 else 0
+        if top_k == 0 and not 0 < self.top_p < 1:
+            return logits, None
+        if top_k > 0:
+            values, indices = torch.topk(logits, top_k)    # [batch, k], sorted
+        else:
+            values, indices = torch.sort(logits, descending=True)
+        if 0 < self.top_p < 1:
+            cumulative_probs = torch.cumsum(F.softmax(values, dim=-1), dim=-1)
+            # shift to the right to keep the first token above the threshold
+            remove = cumulative_probs > self.top_p
+            remove[..., 1:] = remove[..., :-1].clone()
+            remove[..., :self.min_tokens_to_keep] = False
+            values = values.masked_fill(remove, -np.inf)
+        return values, indices
+
+class LogitsPipeline:
+
+    '''
+    Composable batched logits processors of the decoding, the processor is called with the logits [batch, vocab]
+    and the SamplingState, and returns the processed logits. The order of the default pipeline (build):
+    banned tokens, min length, repetition penalty, temperature, top-k/top-p
+
+    pipeline = LogitsPipeline.build(banned=[unk_id], repetition_penalty=1.2, top_k=20, top_p=0.9)
+    state = pipeline.init_state(logits)
+    next_token = pipeline.sample(logits, state)    # [batch, 1]
+    '''
+
+    def __init__(self, processors):
+        self.processors = [p for p in processors if p is not None]
+
+    @classmethod
+    def build(cls, banned=(), repetition_penalty=1.0, temperature=1.0, 
+              top_k=0, top_p=1.0, min_length=0, end_ids=(), min_tokens_to_keep=1):
+        return cls([
+            BanTokens(banned) if banned else None,
+            MinLength(min_length, end_ids) if min_length > 0 and end_ids else None,
+            RepetitionPenalty(repetition_penalty) if repetition_penalty != 1 else None,
+            Temperature(temperature) if temperature != 1 else None,
+            TopKTopP(top_k, top_p, min_tokens_to_keep=min_tokens_to_keep),
+        ])
+
+    def init_state(self, logits):
+        state = SamplingState()
+        state.presence = torch.zeros(
+                logits.shape[0] if logits.dim() == 2 else 1, logits.shape[-1], 
+                dtype=torch.bool, device=logits.device)
+        return state
+
+    def __call__(self, logits, state=None):
+        '''
+        logits: [batch, vocab] or [vocab] (one sample)
+        state: the SamplingState, which is only needed by the repetition penalty and the min length
+        '''
+        if logits.dim() == 1:
+            return self(logits.unsqueeze(0), state).squeeze(0)
+        for processor in self.processors:
+            logits = processor(logits, state)
+        return logits
+
+    def probs(self, logits, state=None):
+        '''
+        the sampling distribution [batch, vocab] of the processed logits (speculative sampling)
+        '''
+        return F.softmax(self(logits, state), dim=-1)
+
+    def sample(self, logits, state):
+        '''
+        return the sampled tokens [batch, 1] ([1] for the logits [vocab]), the state is updated;
+        the tokens are sampled from the compact top-k set instead of the full vocabulary
+        '''
+        if logits.dim() == 1:
+            return self.sample(logits.unsqueeze(0), state).squeeze(0)
+        processors, indices = self.processors, None
+        if processors and isinstance(processors[-1], TopKTopP):
+            for processor in processors[:-1]:
+                logits = processor(logits, state)
+            logits, indices = processors[-1].compact(logits)
+        else:
+            logits = self(logits, state)
+        next_token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)    # [batch, 1]
+        if indices is not None:
+            next_token = indices.gather(1, next_token)
+        state.update(next_token)
+        return next_token
+
+def kv_cache_forward(model, inpt_ids, past=None, cache=None):
+    '''
+    incremental decoding of one sample with the key/value cache (past) of the GPT2LMHeadModel
+    inpt_ids: [seq], the tokens in the window (context and the generated tokens, at most n_ctx)
+    past: the cache of inpt_ids[:-1] returned by the last call, None for the first step (prefill)
+    cache: the PrefixKVCache of the contexts in the previous turns, used by the prefill
+    return the logits of the next token [vocab] and the new past
+
+    only the last token is fed if the past covers the other tokens in the window;
+    once the window is full (inpt_ids = inpt_ids[-n_ctx:]), the oldest token is dropped and the
+    positions of all the tokens change, so the whole window is fed again without the past,
+    which is exactly the same as the full re-feed of the truncated inpt_ids
+    '''
+    if past is not None and past[0].shape[-2] == len(inpt_ids) - 1:
+        outputs = model(input_ids=inpt_ids[-1:], past=past)
+    elif past is None and cache is not None:
+        outputs = cache.prefill(model, inpt_ids)
+    else:
+        outputs = model(input_ids=inpt_ids)
+    return outputs[0][-1, :], outputs[1]
+
+def expand_samples(x, samples, dim=0):
+    '''
+    [..., batch, ...] -> [..., batch*samples, ...], the rows of one context are adjacent;
+    no copy if batch is 1 (stride 0 along the samples)
+    '''
+    if samples == 1:
+        return x
+    shape = list(x.shape)
+    x = x.unsqueeze(dim+1).expand(*shape[:dim+1], samples, *shape[dim+1:])
+    shape[dim] *= samples
+    return x.reshape(shape)
+
+def shared_prefill(model, inpt_ids, samples=1, attn_mask=None, position_ids=None, cache=None):
+    '''
+    encode the contexts once and share the past among the samples of each context,
+    so the prefill cost is independent of the number of the samples
+    inpt_ids: [batch, seq]
+    cache: the PrefixKVCache, the contexts are prefilled one by one (only the tokens that are not cached),
+           and their past is left padded (the pad positions are masked by the attn_mask)
+    return the logits of the next token [batch*samples, vocab] and the past n_layer*[2, batch*samples, head, seq, head_dim]
+
+    NOTE: the past is expanded without copying, the first decoding step materializes it (torch.cat in the attention)
+    '''
+    if cache is None:
+        outputs = model(
+                input_ids=inpt_ids,
+                attention_mask=attn_mask,
+                position_ids=position_ids)
+        logits, past = outputs[0][:, -1, :], outputs[1]
+    else:
+        logits, pasts = [], []
+        for idx, ids in enumerate(inpt_ids):
+            if attn_mask is not None:
+                ids = ids[attn_mask[idx].bool()]
+            logits_, past_ = cache.prefill(model, ids)
+            logits.append(logits_[-1])
+            # past_: n_layer*[2, 1, head, seq, head_dim]
+            pasts.append([F.pad(p, (0, 0, inpt_ids.shape[1] - len(ids), 0)) for p in past_])
+        logits = torch.stack(logits)
+        past = tuple(torch.cat(p, dim=1) for p in zip(*pasts))
+    # the logits are changed in place by the sampling, so they must be copied
+    logits = expand_samples(logits, samples).clone()
+    past = tuple(expand_samples(p, samples, dim=1) for p in past)
+    return logits, past
+
+class ShortlistLMHead(nn.Module):
+
+    '''
+    the GPT2LMHeadModel whose lm head only projects the hidden states to the shortlist ids,
+    same interface as the GPT2LMHeadModel: the logits [..., n] over the shortlist and the past
+    '''
+
+    def __init__(self, model, ids):
+        super(ShortlistLMHead, self).__init__()
+        self.transformer, self.config = model.transformer, model.config
+        weight = model.lm_head.weight
+        self.weight = weight.index_select(0, ids.to(weight.device))    # [n, hidden]
+
+    def forward(self, input_ids, past=None, attention_mask=None, position_ids=None):
+        outputs = self.transformer(
+                input_ids=input_ids,
+                past=past,
+                attention_mask=attention_mask,
+                position_ids=position_ids)
+        return (F.linear(outputs[0], self.weight),) + outputs[1:]
+
+class VocabShortlist:
+
+    '''
+    The candidate vocabulary of the decoding: the most frequent tokens in the training corpus (and the special
+    tokens), extended with the tokens of the contexts of each call (all the contexts in the batch share one
+    shortlist, so the projection is still one dense matmul). The lm head only computes the logits of the
+    shortlist ([batch, n] instead of [batch, vocab]), the sampled positions are mapped back to the vocabulary.
+    The [UNK] token is never in the shortlist.
+
+    NOTE: the distribution is renormalized over the shortlist, the tokens out of it are never generated
+
+    python utils/utils.py --mode shortlist --dataset zh50w --size 4000
+    shortlist = VocabShortlist.load('data/vocab/shortlist.npy', unk_id)
+    model, ids = shortlist.head(gpt2lmheadmodel, inpt_ids, attn_mask)    # logits [..., n]; ids: [n]
+    '''
+
+    def __init__(self, ids, unk_id=None):
+        self.unk_id = unk_id
+        self.ids = self._clean(torch.as_tensor(ids, dtype=torch.long))
+
+    def _clean(self, ids):
+        ids = ids.unique()    # sorted
+        return ids if self.unk_id is None else ids[ids != self.unk_id]
+
+    @classmethod
+    def from_corpus(cls, path, vocab, size, special=('[SEP]', '[CLS]', '[PAD]')):
+        '''
+        the `size` most frequent tokens of the utterances in the corpus (read_text_data format)
+        '''
+        counter = Counter()
+        with open(path) as f:
+            for line in tqdm(f):
+                line = line.strip()
+                if line:
+                    counter.update(vocab.convert_tokens_to_ids(vocab.tokenize(line)))
+        ids = [i for i, _ in counter.most_common(size)] + vocab.convert_tokens_to_ids(list(special))
+        return cls(ids, unk_id=vocab.convert_tokens_to_ids('[UNK]'))
+
+    @classmethod
+    def load(cls, path, unk_id=None):
+        return cls(np.load(path), unk_id=unk_id)
+
+    def save(self, path):
+        np.save(path, self.ids.numpy())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def extend(self, inpt_ids=None, attn_mask=None):
+        '''
+        the shortlist with the tokens of the contexts
+        inpt_ids: [batch, seq] or [seq]; attn_mask: [batch, seq], the pad tokens are ignored
+        return the sorted ids [n]
+        '''
+        if inpt_ids is None:
+            return self.ids
+        tokens = inpt_ids[attn_mask.bool()] if attn_mask is not None else inpt_ids.reshape(-1)
+        return self._clean(torch.cat((self.ids.to(tokens.device), tokens)))
+
+    def head(self, model, inpt_ids=None, attn_mask=None):
+        '''
+        return the ShortlistLMHead of the GPT2LMHeadModel and its ids [n]
+        '''
+        ids = self.extend(inpt_ids, attn_mask)
+        return ShortlistLMHead(model, ids), ids.to(model.lm_head.weight.device)
 
 def generate_attention_mask(inpt_ids):
     '''
@@ -415,6 +990,22 @@ def generate_attention_mask(inpt_ids):
     # do not need the .cuda
     return attn_mask
 
+def generate_left_padded_input(ids, pad=0):
+    '''
+    left pad the contexts (different lengths) for the batched generation, so that the 
+    last tokens of all the contexts are aligned and the new tokens can be appended
+    :ids: a list of LongTensor [seq]
+
+    return :inpt_ids: [batch, seq]; :attn_mask: [batch, seq]; 1 for not masked and 0 for masked tokens
+    '''
+    max_len = max([len(i) for i in ids])
+    inpt_ids = torch.full((len(ids), max_len), pad, dtype=torch.long)
+    attn_mask = torch.zeros(len(ids), max_len, dtype=torch.long)
+    for idx, i in enumerate(ids):
+        inpt_ids[idx, max_len-len(i):] = i
+        attn_mask[idx, max_len-len(i):] = 1
+    return inpt_ids, attn_mask
+
 def filter_gpt2rl(x):
     x = [''.join(ii) for ii in x]
     return [ii.replace('[CLS]', '').replace('[PAD]', '').replace('[SEP]', '') for ii in x]
@@ -458,6 +1049,7 @@ def to_cuda(x, model=False):
         else:
             x = x.cuda()
             return x
+    return x
 
 # ========= BalancedDataParallel ========= #
 def scatter(inputs, target_gpus, chunk_sizes, dim=0):
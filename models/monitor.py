@@ -0,0 +1,177 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+'''
+Latency spans and counters of the serving path, exported in the Prometheus text format (/metrics)
+
+1. `with monitor.span('es_search'):` records the latency of the stage into the histogram,
+   the exception raised in the span is counted in the error counter of the stage
+2. `with monitor.label('gpt2'):` sets the agent label of the spans in the current thread
+3. monitor.record('candidates', n): sum and count of the values (e.g. the number of the candidates)
+4. the monitor is disabled by default, the span is a no-op object in this case
+5. the worker processes send the metrics collected by them (drain) to the main process (merge)
+'''
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+null_span = NullSpan()
+
+class Span:
+
+    def __init__(self, monitor, stage):
+        self.monitor, self.stage = monitor, stage
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.monitor.observe(self.stage, time.perf_counter() - self.begin)
+        if exc_type is not None:
+            self.monitor.count('errors', stage=self.stage)
+        return False
+
+class Label:
+
+    def __init__(self, local, name):
+        self.local, self.name = local, name
+
+    def __enter__(self):
+        self.prev = getattr(self.local, 'agent', '')
+        self.local.agent = self.name
+        return self
+
+    def __exit__(self, *args):
+        self.local.agent = self.prev
+        return False
+
+class Monitor:
+
+    '''
+    buckets: upper bounds (seconds) of the latency histograms
+    '''
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        # (stage, agent) -> [count of each bucket (the last one is +Inf), sum]
+        self.histograms = {}
+        # (name, stage, agent) -> value
+        self.counters = Counter()
+        # (name, agent) -> [sum, count]
+        self.values = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    @property
+    def agent(self):
+        return getattr(self.local, 'agent', '')
+
+    def span(self, stage):
+        if not self.enabled:
+            return null_span
+        return Span(self, stage)
+
+    def label(self, name):
+        if not self.enabled:
+            return null_span
+        return Label(self.local, name)
+
+    def observe(self, stage, seconds):
+        key = (stage, self.agent)
+        with self.lock:
+            item = self.histograms.get(key)
+            if item is None:
+                item = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            item[bisect_left(self.buckets, seconds)] += 1
+            item[-1] += seconds
+
+    def count(self, name, value=1, stage=''):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, stage, self.agent)] += value
+
+    def record(self, name, value):
+        if not self.enabled:
+            return
+        key = (name, self.agent)
+        with self.lock:
+            item = self.values.setdefault(key, [0, 0])
+            item[0] += value
+            item[1] += 1
+
+    def drain(self):
+        '''
+        return the metrics collected since the last drain (worker process)
+        '''
+        if not self.enabled:
+            return None
+        with self.lock:
+            rest = (self.histograms, self.counters, self.values)
+            self.reset()
+        return rest
+
+    def merge(self, data):
+        '''
+        add the metrics collected by the worker process
+        '''
+        if not data:
+            return
+        histograms, counters, values = data
+        with self.lock:
+            for key, item in histograms.items():
+                old = self.histograms.setdefault(key, [0] * len(item))
+                for idx, v in enumerate(item):
+                    old[idx] += v
+            self.counters.update(counters)
+            for key, (s, c) in values.items():
+                old = self.values.setdefault(key, [0, 0])
+                old[0] += s
+                old[1] += c
+
+    def export(self, prefix='opendialog'):
+        '''
+        Prometheus text format
+        '''
+        lines = []
+        with self.lock:
+            lines.append(f'# TYPE {prefix}_stage_seconds histogram')
+            for (stage, agent), item in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",agent="{agent}"'
+                cumulative = 0
+                for bound, c in zip(list(self.buckets) + ['+Inf'], item[:-1]):
+                    cumulative += c
+                    lines.append(f'{prefix}_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{{labels}}} {round(item[-1], 6)}')
+                lines.append(f'{prefix}_stage_seconds_count{{{labels}}} {cumulative}')
+            for name in sorted(set(i[0] for i in self.counters)):
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                for (name_, stage, agent), value in sorted(self.counters.items()):
+                    if name_ == name:
+                        lines.append(f'{prefix}_{name}_total{{stage="{stage}",agent="{agent}"}} {value}')
+            for name in sorted(set(i[0] for i in self.values)):
+                lines.append(f'# TYPE {prefix}_{name} summary')
+                for (name_, agent), (s, c) in sorted(self.values.items()):
+                    if name_ == name:
+                        lines.append(f'{prefix}_{name}_sum{{agent="{agent}"}} {s}')
+                        lines.append(f'{prefix}_{name}_count{{agent="{agent}"}} {c}')
+        return '\n'.join(lines) + '\n'
+
+# the monitor of the process, enabled by the api (--metrics)
+monitor = Monitor()
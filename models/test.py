@@ -10,7 +10,10 @@ class TestAgent(BaseAgent):
         super(TestAgent, self).__init__()
         self.model = ESChat('retrieval_database', kb=kb)
 
-    def talk(self, topic, msgs):
+    def talk(self, topic, msgs, history=None):
+        if history:
+            # the top response that is not used by the session
+            return self.model.fallback(topic, msgs, history=history)
         return self.model.talk(topic, msgs) 
 
     def obtain_qa_pair(self, msgs, samples=2):
@@ -45,7 +48,7 @@ class MultiViewTestAgent(RetrievalBaseAgent):
 
     def __init__(self, kb=True):
         super(MultiViewTestAgent, self).__init__(kb=kb)
-        self.args = {'talk_samples': 128, 'topic_threshold': 0.5}
+        self.args = {'talk_samples': 128, 'talk_samples_reduced': 32, 'topic_threshold': 0.5}
         from multiview import MultiView
         print(f'[!] MultiView reranker model will be initized')
         self.reranker = MultiView(
@@ -65,27 +68,82 @@ class MultiViewTestAgent(RetrievalBaseAgent):
         print(f'[!] load multiview model over')
 
     @torch.no_grad()
-    def talk(self, topic, msgs):
+    def talk(self, topic, msgs, history=None):
         '''
         If the topic of the context is not consistant with the given topic.
         Try to use the trgigger sentence as the context.
+        history: the history of the session
         '''
         # detect the topic of the msgs, if the msgs's topic is noised
         # use the trigger sentences
-
+        history = history or []
         utterances_ = self.searcher.search(topic, msgs, samples=self.args['talk_samples'])
         utterances_ = [i['response'] for i in utterances_]
-        utterances_ = list(set(utterances_) - set(self.history))
+        utterances_ = list(set(utterances_) - set(history))
 
         msgs_ = len(utterances_) * [msgs]
         topic = len(utterances_) * [topic]
-        scores = self.reranker(msgs_, utterances_, topic=topic, history=self.history)
+        monitor.record('candidates', len(utterances_))
+        with monitor.span('rerank'):
+            scores = self.reranker(msgs_, utterances_, topic=topic, history=history)
         scores = scores[0]
 
         index = np.argmax(scores)
         response = utterances_[index]
         return response
 
+    @torch.no_grad()
+    def talk_batch(self, topics, msgs, histories=None, deadline=None):
+        '''
+        the candidates of all the conversations are scored by one MultiView call,
+        each candidate is scored with the history of its own session
+        deadline: the degradation ladder (fewer candidates, skip the MMI/fluency scorers, plain ES answer)
+        '''
+        histories = histories if histories else [[] for _ in msgs]
+        rung = obtain_rung(deadline)
+        if rung == 3:
+            record_rung(rung, len(msgs))
+            return [self.searcher.fallback(topic, msg, history=history) for topic, msg, history in zip(topics, msgs, histories)]
+        samples = self.args['talk_samples'] if rung == 0 else self.args['talk_samples_reduced']
+        contexts, candidates, topics_, histories_ = [], [], [], []
+        for topic, msg, history in zip(topics, msgs, histories):
+            utterances_ = self.searcher.search(topic, msg, samples=samples)
+            utterances_ = [i['response'] for i in utterances_]
+            # keep the order of ES for the fallback
+            history_ = set(history)
+            utterances_ = [i for i in OrderedDict.fromkeys(utterances_) if i not in history_]
+            candidates.append(utterances_)
+            contexts.extend([msg] * len(utterances_))
+            topics_.extend([topic] * len(utterances_))
+            histories_.extend([history] * len(utterances_))
+            monitor.record('candidates', len(utterances_))
+        # the searching may use up the budget
+        rung = obtain_rung(deadline, rung)
+        if rung == 3:
+            record_rung(rung, len(msgs))
+            return [i[0] if i else self.searcher.fallback(topic, msg, history=history) for topic, msg, history, i in zip(topics, msgs, histories, candidates)]
+        scores = []
+        if contexts:
+            with monitor.span('rerank'):
+                scores = self.reranker(
+                        contexts, 
+                        [j for i in candidates for j in i], 
+                        topic=topics_, 
+                        history=histories_,
+                        exclude=Deadline.expensive if rung == 2 else None)[0]
+        # split the scores for each conversation
+        rest, begin = [], 0
+        for topic, msg, history, utterances_ in zip(topics, msgs, histories, candidates):
+            if not utterances_:
+                # all the hits are used by the session
+                rest.append(self.searcher.fallback(topic, msg, history=history))
+                continue
+            scores_ = scores[begin:begin+len(utterances_)]
+            rest.append(utterances_[int(np.argmax(scores_))])
+            begin += len(utterances_)
+        record_rung(rung, len(msgs))
+        return rest
+
 if __name__ == "__main__":
     agent = TestAgent()
     ipdb.set_trace()
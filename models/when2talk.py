@@ -30,35 +30,84 @@ class When2Talk(nn.Module):
         output = outputs[0]    # [batch, seq, vocab]
         return output
 
+    def logits_pipeline(self):
+        return LogitsPipeline.build(
+                banned=[self.unk_id], 
+                repetition_penalty=self.repetition_penalty, 
+                top_k=self.topk, 
+                top_p=self.topp)
+
     def predict(self, inpt_ids, max_len):
         '''
         batch_size is 1; inpt_ids: [seq]
         the user token is [USER2]
         '''
-        with torch.no_grad():
-            generated = []
-            for _ in range(max_len):
-                outputs = self.model(input_ids=inpt_ids)[0]
-                # outputs = self.model(input_ids=inpt_ids)
-                next_token_logits = outputs[-1, :]    # [vocab]
-                # penalty on the deplicated tokens
-                if generated:
-                    next_token_logits[list(set(generated))] /= self.repetition_penalty
-                # ignore the [UNK] token
-                next_token_logits[self.unk_id] = -np.inf
-                filtered_logits = top_k_top_p_filtering(
-                        next_token_logits, 
-                        top_k=self.topk, 
-                        top_p=self.topp)
-                next_token = torch.multinomial(
-                        F.softmax(filtered_logits, dim=-1),
-                        num_samples=1)
-                generated.append(next_token.item())
-                if next_token.item() == self.stp_id:
-                    break
-                inpt_ids = torch.cat((inpt_ids, next_token), dim=0)
-                inpt_ids = inpt_ids[-self.n_ctx:]
-            return generated
+        return list(self.predict_stream(inpt_ids, max_len))
+
+    def predict_stream(self, inpt_ids, max_len):
+        '''
+        same as predict, but yield the id once it is sampled (streaming API),
+        stop after the [STP] token or when the generator is closed by the consumer
+        '''
+        pipeline = self.logits_pipeline()
+        state, past = None, None
+        for _ in range(max_len):
+            with torch.no_grad():
+                # only the new token is fed, the tokens before it are cached in the past
+                next_token_logits, past = kv_cache_forward(self.model, inpt_ids, past=past)    # [vocab]
+                if state is None:
+                    state = pipeline.init_state(next_token_logits)
+                # ignore the [UNK] token, penalty on the deplicated tokens, top-k/top-p
+                next_token = pipeline.sample(next_token_logits, state)    # [1]
+            yield next_token.item()
+            if next_token.item() == self.stp_id:
+                break
+            inpt_ids = torch.cat((inpt_ids, next_token), dim=0)
+            inpt_ids = inpt_ids[-self.n_ctx:]
+
+    @torch.no_grad()
+    def predict_batch(self, inpt_ids, max_len, attn_mask=None):
+        '''
+        inpt_ids: [batch, seq]
+        attn_mask: [batch, seq], the mask of the left padded inpt_ids (contexts have different lengths)
+        stop once every sample generates the [STP] token (the tokens after it are not used)
+        '''
+        position_ids = None
+        if attn_mask is not None:
+            # the left pad tokens are ignored, position ids start from the first real token
+            position_ids = (attn_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        next_token_logits, past = shared_prefill(
+                self.model, inpt_ids, 
+                attn_mask=attn_mask, 
+                position_ids=position_ids)    # [batch, vocab]
+        if attn_mask is not None:
+            position_ids = position_ids[:, -1:]
+        batch_size = inpt_ids.shape[0]
+        generated = torch.zeros(batch_size, max_len, dtype=torch.long, device=inpt_ids.device)
+        pipeline, state, step = self.logits_pipeline(), None, -1
+        stop_flag = torch.zeros(batch_size, dtype=torch.bool, device=inpt_ids.device)
+        for step in range(max_len):
+            if step > 0:
+                outputs = self.model(
+                        input_ids=prev, 
+                        past=past,
+                        attention_mask=attn_mask,
+                        position_ids=position_ids)    # [batch, 1, vocab]
+                output, past = outputs[:2]
+                next_token_logits = output[:, -1, :]    # [batch, vocab]
+            if state is None:
+                state = pipeline.init_state(next_token_logits)
+            # ignore the [UNK] token, penalty on the deplicated tokens, top-k/top-p
+            next_token = pipeline.sample(next_token_logits, state)    # [batch, 1]
+            generated[:, step] = next_token.squeeze(1)
+            stop_flag |= next_token.squeeze(1) == self.stp_id
+            prev = next_token
+            if attn_mask is not None:
+                attn_mask = torch.cat((attn_mask, torch.ones_like(next_token)), dim=1)
+                position_ids = position_ids + 1
+            if stop_flag.all():
+                break
+        return generated[:, :step+1].tolist()
 
 class When2TalkAgent(BaseAgent):
 
@@ -170,6 +219,7 @@ class When2TalkAgent(BaseAgent):
     def test_model(self, test_iter, path):
         '''
         Generate the test dataset and measure the performance
+        the contexts in the batch are left padded (gpt2_test_collate_fn_batch) and generated together
         '''
         def filter(x):
             return x.replace('[PAD]', '')
@@ -177,47 +227,63 @@ class When2TalkAgent(BaseAgent):
         pbar = tqdm(test_iter)
         with open(path, 'w') as f:
             for batch in pbar:
-                c, r = batch
-                max_size = max(len(r), self.args['tgt_len_size'])
-                tgt = self.model.predict(c, max_size)
-                text = self.vocab.convert_ids_to_tokens(tgt)
-                tgt = ''.join(text)
+                c, attn_mask, r = batch    # c/attn_mask: [batch, seq]; r: batch*[seq]
+                max_size = max(max(len(i) for i in r), self.args['tgt_len_size'])
+                # room for the generation in the window
+                c, attn_mask = c[:, -(self.model.n_ctx-max_size):], attn_mask[:, -(self.model.n_ctx-max_size):]
+                tgt = self.model.predict_batch(c, max_size, attn_mask=attn_mask)
+                for c_, m_, r_, t_ in zip(c, attn_mask, r, tgt):
+                    # keep the tokens until the first [STP] token (included)
+                    if self.model.stp_id in t_:
+                        t_ = t_[:t_.index(self.model.stp_id)+1]
+                    text = self.vocab.convert_ids_to_tokens(t_)
+                    tgt_ = ''.join(text)
 
-                ctx = self.vocab.convert_ids_to_tokens(c)
-                ctx = filter(''.join(ctx))
+                    ctx = self.vocab.convert_ids_to_tokens(c_[m_.bool()])
+                    ctx = filter(''.join(ctx))
 
-                ref = self.vocab.convert_ids_to_tokens(r)
-                ref = filter(''.join(ref))
+                    ref = self.vocab.convert_ids_to_tokens(r_)
+                    ref = filter(''.join(ref))
 
-                f.write(f'CTX: {ctx}\n')
-                f.write(f'REF: {ref}\n')
-                f.write(f'TGT: {tgt}\n\n')
+                    f.write(f'CTX: {ctx}\n')
+                    f.write(f'REF: {ref}\n')
+                    f.write(f'TGT: {tgt_}\n\n')
         print(f'[!] translate test dataset over, write into {path}')
         # measure the performance
         # (b1, b2, b3, b4), ((r_max_l, r_min_l, r_avg_l), (c_max_l, c_min_l, c_avg_l)), (dist1, dist2, rdist1, rdist2), (average, extrema, greedy) = cal_generative_metric(path, lang=self.args['lang'])
         # print(f'[TEST] BLEU: {b1}/{b2}/{b3}/{b4}; Length(max, min, avg): {c_max_l}/{c_min_l}/{c_avg_l}|{r_max_l}/{r_min_l}/{r_avg_l}; Dist: {dist1}/{dist2}|{rdist1}/{rdist2}; Embedding(average/extrema/greedy): {average}/{extrema}/{greedy}')
     
-    def talk(self, topic, msgs, maxlen=50):
+    def talk(self, topic, msgs, maxlen=50, history=None):
         '''
         topic, msgs: msgs is a string which split with the [SEP] token
+        history: the history of the session (not used by the generation)
         batch size is 1
 
         format:
         [USER1] ... [SEP] [USER1] ... [STP] [USER2]
         '''
+        with monitor.span('gpt2_sampling'):
+            return ''.join(self.talk_stream(topic, msgs, maxlen=maxlen, history=history))
+
+    def talk_stream(self, topic, msgs, maxlen=50, history=None):
+        '''
+        yield the tokens of the response once they are sampled,
+        the [SEP] token (end of one sentence) is converted into the new line
+        '''
         # tokenizer
-        with torch.no_grad():
-            if '[SEP]' not in msgs:
-                msgs = f'{msgs} [STP]'
-            else:
-                msgs = msgs.replace('[SEP]', '[SEP] [USER1]')
-                msgs = f'{msgs} [STP]'
-            msgs = f'[USER1] {msgs} [USER2]'
-            msgs = torch.LongTensor(self.vocab.encode(msgs)[1:-1])
-            if torch.cuda.is_available():
-                msgs = msgs.cuda()
-            tgt = self.model.predict(msgs, maxlen)
-            tgt = self.vocab.convert_ids_to_tokens(tgt)
-        tgt = ''.join(tgt)
-        tgt = tgt.replace('[USER2]', '').replace('[SEP]', '\n\n').replace('[STP]', '')
-        return tgt
+        if '[SEP]' not in msgs:
+            msgs = f'{msgs} [STP]'
+        else:
+            msgs = msgs.replace('[SEP]', '[SEP] [USER1]')
+            msgs = f'{msgs} [STP]'
+        msgs = f'[USER1] {msgs} [USER2]'
+        msgs = torch.LongTensor(self.vocab.encode(msgs)[1:-1])
+        if torch.cuda.is_available():
+            msgs = msgs.cuda()
+        stream = self.model.predict_stream(msgs, maxlen)
+        try:
+            for token in stream:
+                token = self.vocab.convert_ids_to_tokens(token)
+                yield token.replace('[USER2]', '').replace('[SEP]', '\n\n').replace('[STP]', '')
+        finally:
+            stream.close()
@@ -27,12 +27,17 @@ class COHERENCE(RetrievalBaseAgent):
         print(f'[!] reload the coherence model parameters')
 
     @torch.no_grad()
-    def scores(self, msgs, resps):
+    def scores(self, msgs, resps, features=None):
         '''
         msgs: {context}[SEP]{response}, a batch of the pair of context and response
+        features: the TextFeatures of the MultiView call, encode(f'{m} [SEP] {r}') is the concatenation
+                  of the BERT ids of the context and the response (without its [CLS])
         '''
-        msgs = [f'{m} [SEP] {r}' for m, r in zip(msgs, resps)]
-        ids = [torch.LongTensor(self.vocab.encode(i)[-300:]) for i in msgs]
+        if features is None:
+            msgs = [f'{m} [SEP] {r}' for m, r in zip(msgs, resps)]
+            ids = [torch.LongTensor(self.vocab.encode(i)[-300:]) for i in msgs]
+        else:
+            ids = [torch.LongTensor((features.bert(m) + features.bert(r)[1:])[-300:]) for m, r in zip(msgs, resps)]
         ids = pad_sequence(ids, batch_first=True, padding_value=self.pad)
         if torch.cuda.is_available():
             ids = ids.cuda()    # [batch, seq]
@@ -11,8 +11,10 @@ class Distinct:
     def __init__(self):
         pass
 
-    def filter(self, msg):
+    def filter(self, msg, features=None):
         msg = msg.replace('[SEP]', '')
+        if features is not None:
+            return features.jieba(msg)
         msg = list(jieba.cut(msg))
         return msg
 
@@ -29,21 +31,29 @@ class Distinct:
         h = self.make_corpus(h)
         return cal_distinct(h)
 
-    def scores(self, responses, history):
+    def scores(self, responses, history, features=None):
         '''
         :response: a batch of response string
-        :history: a batch of history string
+        :history: a list of history string (shared by all the responses), or a batch of 
+                  the history (one list for each response, from the different sessions)
+        :features: the TextFeatures of the MultiView call (the jieba tokens)
         '''
-        r = [self.filter(i) for i in responses]
+        r = [self.filter(i, features=features) for i in responses]
         micro_s = [self._micro(r_) for r_ in r]
 
         if history:
-            h_ = [self.filter(i) for i in history]
-            h = []
-            for r_ in r:
-                h.append(h_ + r_)
-            macro_s = [self._macro(h_) for h_ in h]
-            s = [(mi + ma) / 2 for mi, ma in zip(micro_s, macro_s)]
+            if isinstance(history[0], str):
+                history = [history] * len(r)
+            # the responses of the same session share the same history list
+            cache, s = {}, []
+            for r_, history_, mi in zip(r, history, micro_s):
+                if not history_:
+                    s.append(mi)
+                    continue
+                if id(history_) not in cache:
+                    cache[id(history_)] = [self.filter(i, features=features) for i in history_]
+                ma = self._macro(cache[id(history_)] + r_)
+                s.append((mi + ma) / 2)
         else:
             s = micro_s
         return s
@@ -59,11 +69,14 @@ class RepetitionPenalty:
         self.ic = inner_count
         self.cc = context_count
 
-    def _repetition_context(self, contexts, responses):
+    def _cut(self, text, features=None):
+        return features.jieba(text) if features is not None else list(jieba.cut(text))
+
+    def _repetition_context(self, contexts, responses, features=None):
         s = []
         for c, r in zip(contexts, responses):
-            c_terms = list(jieba.cut(c))
-            r_terms = list(jieba.cut(r))
+            c_terms = self._cut(c, features)
+            r_terms = self._cut(r, features)
             if len(r_terms) == 1:
                 s.append(0)
                 continue
@@ -78,14 +91,14 @@ class RepetitionPenalty:
             s.append(1-ratio)
         return s
 
-    def _repetition_inner(self, responses):
+    def _repetition_inner(self, responses, features=None):
         '''
         avoid the cases like: '我喜欢吃面条，喜欢吃面条，吃面条'
         y = 1 - x (x is the ratio of the repetition tokens, bigger x lower score)
         '''
         s = []
         for response in responses:
-            terms = list(jieba.cut(response))
+            terms = self._cut(response, features)
             terms = Counter(terms)
             values = list(terms.values())
             if len(values) == 1:
@@ -99,9 +112,13 @@ class RepetitionPenalty:
             s.append(1-ratio)
         return s
 
-    def scores(self, contexts, responses): 
-        s1 = self._repetition_context(contexts, responses)
-        s2 = self._repetition_inner(responses)
+    def scores(self, contexts, responses, features=None): 
+        '''
+        features: the TextFeatures of the MultiView call, the jieba tokens of the context and each response
+                  are shared by the two passes
+        '''
+        s1 = self._repetition_context(contexts, responses, features=features)
+        s2 = self._repetition_inner(responses, features=features)
         # mean strategy is not good as the min
         # s = [(s1_+s2_)/2 for s1_, s2_ in zip(s1, s2)]
         s = [min(s1_, s2_) for s1_, s2_ in zip(s1, s2)]
@@ -152,20 +169,26 @@ class NIDF_TF():
 
     Refer to the paper (AAAI 2020):
     Learning from Easy to Complex: Adaptive Multi-curricula Learning for Neural Dialogue Generation
+
+    The statistic is saved in the `rest_path` directory: words.npy (the sorted utf-8 words, the index of
+    the word is its position), nidf.npy and ntf.npy (the normalized idf and the tf of each word); all of
+    them are memory mapped when they are loaded. The old data.pkl in the directory is converted on the first load.
     '''
 
     def __init__(self):
         self.args = {
                 'corpus_path': 'data/zh50w/train_.txt',
-                'rest_path': 'ckpt/NIDF_TF/data.pkl',
+                'rest_path': 'ckpt/NIDF_TF',
                 'stopwords_path': 'data/stopwords.txt',
                 'stopwords': True,
                 'factor_tf': 0.5,
                 'factor_idf': 0.5,
                 }
-        self.cutter = thulac.thulac(seg_only=True)
-        if os.path.exists(self.args['rest_path']):
+        self._cutter = None
+        if os.path.exists(f'{self.args["rest_path"]}/nidf.npy'):
             self._load()
+        elif os.path.exists(f'{self.args["rest_path"]}/data.pkl'):
+            self._convert()
         else:
             # generate the IDF matrix
             if self.args['stopwords']:
@@ -174,58 +197,96 @@ class NIDF_TF():
                 self.stopwords = None
             self._train()
 
+    @property
+    def cutter(self):
+        # the thulac model is loaded when the first response is scored
+        if self._cutter is None:
+            self._cutter = thulac.thulac(seg_only=True)
+        return self._cutter
+
+    def _build(self, words, whole_doc, idf_count, tf_count):
+        idf_count = np.asarray(idf_count, dtype=np.float64)
+        words = np.array([w.encode('utf-8') for w in words], dtype=np.bytes_)
+        order = np.argsort(words, kind='stable')
+        # whole_doc is only used to compute the idf, it is not saved
+        self.words = words[order]
+        # float32 is enough for the rerank weights, and halves the arrays
+        self.nidf = ((idf_count - idf_count.min()) / (idf_count.max() - idf_count.min()))[order].astype(np.float32)
+        self.ntf = np.asarray(tf_count, dtype=np.float64)[order].astype(np.float32)
+
     def _train(self):
         # read the file and tokenized
         data = load_corpus(self.args['corpus_path'])
-        self.whole_doc = len(data)
-        self.words, self.idf_count, self.tf_count = obtain_word_idf(data)
-        self.idf_count = np.log(self.whole_doc / self.idf_count)
-        self.idf_max, self.idf_min = max(self.idf_count), min(self.idf_count)
-        print(f'[!] save the words({len(self.words)}) and TF-IDF')
-        with open(self.args['rest_path'], 'wb') as f:
-            pickle.dump((self.words, self.whole_doc, self.idf_count, self.tf_count), f)
+        words, idf_count, tf_count = obtain_word_idf(data)
+        self._build(words, len(data), np.log(len(data) / idf_count), tf_count)
+        self._save()
+
+    def _convert(self):
+        with open(f'{self.args["rest_path"]}/data.pkl', 'rb') as f:
+            self._build(*pickle.load(f))
+        self._save()
+        print(f'[!] convert {self.args["rest_path"]}/data.pkl to the memory mapped arrays')
+
+    def _save(self):
+        path = self.args['rest_path']
+        np.save(f'{path}/words.npy', self.words)
+        np.save(f'{path}/nidf.npy', self.nidf)
+        np.save(f'{path}/ntf.npy', self.ntf)
+        print(f'[!] save the words({len(self.words)}) and TF-IDF into {path}')
 
     def _load(self):
-        with open(self.args['rest_path'], 'rb') as f:
-            self.words, self.whole_doc, self.idf_count, self.tf_count = pickle.load(f)
-        self.idf_max, self.idf_min = max(self.idf_count), min(self.idf_count)
-        print(f'[!] load IDF data and words from {self.args["rest_path"]}')
-
-    def scores(self, responses, topk=3):
-        responses_ = []
-        for i in responses:
-            i = [j[0] for j in self.cutter.cut(i)]
-            i = [j for j in i if j in self.words]
-            # i = list(set(i))    # filter the duplicated terms
-            responses_.append(i)
-        scores = []
-        for response in responses_:
-            # tf
-            p_tf = []
-            for w in response:
-                index = self.words.index(w)
-                ntf = self.tf_count[index]
-                p_tf.append(ntf)
-            if len(p_tf) == 0:
-                p_tf = 0
-            else:
-                p_tf = np.mean(p_tf)
-            # idf
-            response = list(set(response))    # duplicated words influence the NIDF performance
-            p_idf = []
-            for w in response:
-                index = self.words.index(w)
-                nidf = (self.idf_count[index] - self.idf_min) / (self.idf_max - self.idf_min)
-                p_idf.append(nidf)
-            if len(p_idf) == 0:
-                # scores.append(np.mean(self.idf_count))
-                p_idf = 0
-            else:
-                # average is not appriproate, the long responses will obtain the low scores
-                # should average the topk idf(s)
-                p_idf = np.mean(sorted(p_idf, reverse=True)[:topk])
-            scores.append(self.args['factor_tf'] * p_tf + self.args['factor_idf'] * p_idf)
-        return scores
+        path = self.args['rest_path']
+        self.words = np.load(f'{path}/words.npy', mmap_mode='r')
+        self.nidf = np.load(f'{path}/nidf.npy', mmap_mode='r')
+        self.ntf = np.load(f'{path}/ntf.npy', mmap_mode='r')
+        print(f'[!] load IDF data and words from {path}')
+
+    def lookup(self, tokens):
+        '''
+        tokens: a list of the words
+        return the index of each word [num], -1 for the words out of the vocabulary
+        '''
+        ids = np.full(len(tokens), -1, dtype=np.int64)
+        # the words longer than the vocabulary items are not in it (and are not truncated by the cast)
+        tokens = [t.encode('utf-8') for t in tokens]
+        candidate = np.array([len(t) <= self.words.itemsize for t in tokens], dtype=bool)
+        if not candidate.any():
+            return ids
+        keys = np.array([t for t, c in zip(tokens, candidate) if c], dtype=self.words.dtype)
+        pos = np.searchsorted(self.words, keys).clip(max=len(self.words) - 1)
+        ids[candidate] = np.where(self.words[pos] == keys, pos, -1)
+        return ids
+
+    def scores(self, responses, topk=3, features=None):
+        '''
+        features: the TextFeatures of the MultiView call (the thulac tokens)
+
+        the words of all the responses are looked up together (the words out of the vocabulary are
+        ignored); the tf is the mean of the words and the idf is the mean of the topk distinct words
+        (the padded ids [batch, seq]), the responses without the known words obtain 0
+        '''
+        if not responses:
+            return []
+        tokens = [features.thulac(i) if features is not None else [j[0] for j in self.cutter.cut(i)] for i in responses]
+        rows = np.repeat(np.arange(len(tokens)), [len(i) for i in tokens])    # [num]
+        ids = self.lookup([w for i in tokens for w in i])    # [num]
+        rows, ids = rows[ids >= 0], ids[ids >= 0]
+        # tf
+        lengths = np.bincount(rows, minlength=len(tokens))    # [batch]
+        p_tf = np.bincount(rows, weights=self.ntf[ids].astype(np.float64), minlength=len(tokens)) / np.maximum(lengths, 1)
+        # idf: the distinct words of each response, duplicated words influence the NIDF performance
+        pairs = np.unique(np.stack((rows, ids), axis=1), axis=0)    # sorted by the row
+        rows, ids = pairs[:, 0], pairs[:, 1]
+        lengths = np.bincount(rows, minlength=len(tokens))
+        starts = np.cumsum(lengths) - lengths
+        p_idf = np.full((len(tokens), max(1, lengths.max())), -np.inf)    # [batch, seq]
+        p_idf[rows, np.arange(len(rows)) - starts[rows]] = self.nidf[ids].astype(np.float64)
+        # average is not appriproate, the long responses will obtain the low scores
+        # should average the topk idf(s)
+        p_idf = -np.sort(-p_idf, axis=1)[:, :topk]
+        p_idf = np.where(np.isinf(p_idf), 0, p_idf).sum(axis=1) / np.maximum(np.minimum(lengths, topk), 1)
+        scores = self.args['factor_tf'] * p_tf + self.args['factor_idf'] * p_idf
+        return scores.tolist()
 
 if __name__ == "__main__":
     model = NIDF_TF()
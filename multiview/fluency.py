@@ -28,15 +28,64 @@ class SAFETY_FLUENCY(BaseAgent):
         if torch.cuda.is_available():
             self.model.cuda()
 
-    def scores(self, msgs, resps):
-        fluency_scores, safety_scores = [], []
-        for m, r in zip(msgs, resps):
-            probs = self.score(m, r)
-            # probs, mmi_probs = np.mean(probs), np.mean(mmi_probs)
-            probs = np.mean(probs)
-            # mmi_probs = np.mean(self.weight[:len(mmi_probs)] * mmi_probs)
-            fluency_scores.append(probs)
-            # safety_scores.append(mmi_probs)
+    @torch.no_grad()
+    def scores(self, msgs, resps, max_tokens=2048, features=None):
+        '''
+        batched version of the `score`, the candidates of one context share its prefix:
+        the context is encoded once to obtain its past, then the responses are right padded and fed in
+        chunks of at most `max_tokens` response tokens (pads included) on top of the broadcast past;
+        only the hidden states that predict the response tokens are projected by the lm head;
+        the pairs with at least 300 tokens are not fed (0.2)
+        features: the TextFeatures of the MultiView call (the BERT ids)
+        return the mean probability of the response tokens of each pair [batch]
+        '''
+        encode = features.bert if features is not None else self.vocab.encode
+        fluency_scores = [0.2] * len(msgs)
+        # context -> the indexes of its candidates
+        groups = {}
+        for idx, m in enumerate(msgs):
+            groups.setdefault(m, []).append(idx)
+        transformer, lm_head = self.model.model.transformer, self.model.model.lm_head
+        for m, indexes in groups.items():
+            c_ids = encode(m)
+            items = [(idx, encode(resps[idx])[1:]) for idx in indexes]    # ignore the [CLS]
+            items = sorted([i for i in items if len(c_ids) + len(i[1]) < 300], key=lambda x: len(x[1]))
+            if not items:
+                continue
+            c_ids = torch.LongTensor(c_ids).unsqueeze(0)    # [1, seq]
+            if torch.cuda.is_available():
+                c_ids = c_ids.cuda()
+            hidden, past = transformer(input_ids=c_ids)[:2]
+            # the last token of the context predicts the first token of the responses
+            first = F.softmax(lm_head(hidden[0, -1]), dim=-1)    # [vocab]
+            chunks = []
+            for item in items:
+                if chunks and (len(chunks[-1]) + 1) * len(item[1]) <= max_tokens:
+                    chunks[-1].append(item)
+                else:
+                    chunks.append([item])
+            for chunk in chunks:
+                ids = pad_sequence(
+                        [torch.LongTensor(r) for _, r in chunk], 
+                        batch_first=True, padding_value=0)    # [chunk, seq]
+                length = torch.LongTensor([len(r) for _, r in chunk]).unsqueeze(1)    # [chunk, 1]
+                mask = torch.arange(ids.shape[1]).unsqueeze(0) < length    # [chunk, seq]
+                if torch.cuda.is_available():
+                    ids, mask, length = ids.cuda(), mask.cuda(), length.cuda()
+                attn_mask = torch.cat((torch.ones(len(chunk), c_ids.shape[1], dtype=torch.long, device=ids.device), mask.long()), dim=1)
+                hidden = transformer(
+                        input_ids=ids, 
+                        past=tuple(expand_samples(p, len(chunk), dim=1) for p in past), 
+                        attention_mask=attn_mask)[0]    # [chunk, seq, hidden]
+                # the hidden state at position j predicts the token j+1
+                index = mask[:, 1:]    # [chunk, seq-1]
+                probs = F.softmax(lm_head(hidden[:, :-1][index]), dim=-1).gather(1, ids[:, 1:][index].unsqueeze(1)).squeeze(1)
+                probs = torch.cat((
+                    first[ids[:, :1]],
+                    torch.zeros_like(index, dtype=probs.dtype).masked_scatter(index, probs)), dim=1)    # [chunk, seq]
+                probs = (probs.sum(dim=-1) / length.squeeze(1)).tolist()
+                for (idx, _), p in zip(chunk, probs):
+                    fluency_scores[idx] = p
         return fluency_scores
 
     @torch.no_grad()
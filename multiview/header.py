@@ -1,22 +1,27 @@
+# the heavy dependencies are imported when they are used for the first time (lazy.py)
+from lazy import lazy_import, lazy_from
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
-from transformers import BertTokenizer
+BertTokenizer = lazy_from('transformers', 'BertTokenizer')
 from models.bert_retrieval import BERTRetrieval
 from models.bert_nli import BERTNLI
 from models.gpt2 import GPT2
+from models.model_utils import expand_samples
 from models.base import RetrievalBaseAgent, BaseAgent
-import fasttext.FastText as ff
+from models.monitor import monitor
+ff = lazy_import('fasttext.FastText')
 import argparse
 import numpy as np
-import ipdb
+ipdb = lazy_import('ipdb')
 import pprint
 from tqdm import tqdm
 from math import *
 import pickle
 import os
-import jieba
-import thulac
-from sklearn.feature_extraction.text import CountVectorizer
+import time
+jieba = lazy_import('jieba')
+thulac = lazy_import('thulac')
+CountVectorizer = lazy_from('sklearn.feature_extraction.text', 'CountVectorizer')
 from collections import Counter
@@ -27,12 +27,52 @@ class MMI(BaseAgent):
         if torch.cuda.is_available():
             self.model.cuda()
 
-    def scores(self, sources, targets):
-        s_ = []
-        for s, t in zip(sources, targets):
-            probs = self.score(s, t)
-            probs = np.mean(probs)
-            s_.append(probs)
+    @torch.no_grad()
+    def scores(self, sources, targets, max_tokens=2048, features=None):
+        '''
+        batched version of the `score`: the `response + context` sequences are sorted by the length and
+        right padded, one forward for each chunk of at most `max_tokens` tokens (pads included); only
+        the hidden states that predict the context tokens are projected by the lm head;
+        the pairs with at least 300 tokens are not fed (0.2)
+        features: the TextFeatures of the MultiView call (the BERT ids)
+        return the mean probability of the context tokens of each pair [batch]
+        '''
+        encode = features.bert if features is not None else self.vocab.encode
+        s_ = [0.2] * len(sources)
+        items = []
+        for idx, (s, t) in enumerate(zip(sources, targets)):
+            c_ids = encode(s)[1:]
+            r_ids = encode(t)
+            if len(r_ids) + len(c_ids) < 300:
+                items.append((idx, r_ids, c_ids))
+        items = sorted(items, key=lambda x: len(x[1]) + len(x[2]))
+        chunks = []
+        for item in items:
+            # the item is the longest one in the chunk (sorted)
+            if chunks and (len(chunks[-1]) + 1) * (len(item[1]) + len(item[2])) <= max_tokens:
+                chunks[-1].append(item)
+            else:
+                chunks.append([item])
+        for chunk in chunks:
+            ids = pad_sequence(
+                    [torch.LongTensor(r + c) for _, r, c in chunk], 
+                    batch_first=True, padding_value=0)    # [chunk, seq]
+            r_len = torch.LongTensor([len(r) for _, r, _ in chunk]).unsqueeze(1)    # [chunk, 1]
+            length = torch.LongTensor([len(r) + len(c) for _, r, c in chunk]).unsqueeze(1)
+            position = torch.arange(ids.shape[1]).unsqueeze(0)    # [1, seq]
+            attn_mask = (position < length).long()
+            # the hidden state at position j predicts the token j+1, the context tokens are [r_len, length)
+            index = (position[:, :-1] >= r_len - 1) & (position[:, :-1] < length - 1)    # [chunk, seq-1]
+            if torch.cuda.is_available():
+                ids, attn_mask, index = ids.cuda(), attn_mask.cuda(), index.cuda()
+            hidden = self.model.model.transformer(input_ids=ids, attention_mask=attn_mask)[0]    # [chunk, seq, hidden]
+            logits = self.model.model.lm_head(hidden[:, :-1][index])    # [tokens, vocab]
+            probs = F.softmax(logits, dim=-1).gather(1, ids[:, 1:][index].unsqueeze(1)).squeeze(1)    # [tokens]
+            # masked mean of each pair
+            probs = torch.zeros_like(index, dtype=probs.dtype).masked_scatter(index, probs)
+            probs = (probs.sum(dim=-1) / index.sum(dim=-1)).tolist()
+            for (idx, _, _), p in zip(chunk, probs):
+                s_[idx] = p
         return s_
 
     def score(self, source, target):
@@ -6,6 +6,7 @@ from .topic import *
 from .nli import *
 from .diversity import *
 from .mmi import *
+from .utils import *
 
 class MultiView(nn.Module):
     
@@ -54,6 +55,8 @@ class MultiView(nn.Module):
                 'distinct': 0.6,
                 'repetition_penalty': 0.2}
         self.topic_map = {'电影': 'movie', '美食': 'food', '数码产品': 'electric', '音乐': 'music', '体育': 'sport'}
+        # the BERT ids of the feature bundle (the same vocab as the coherence, mmi and fluency sub-models)
+        self.vocab = BertTokenizer(vocab_file='data/vocab/vocab_small')
         # load sub-models
         self.model = {}
         # check the essential path whether exists
@@ -118,13 +121,27 @@ class MultiView(nn.Module):
             else:
                 return False
 
+    def features(self):
+        '''
+        the feature bundle of one forward call, the tokenizations are computed once on the first use
+        and shared by all the sub-models
+        '''
+        tokenizers = {
+                'bert': self.vocab.encode,
+                'jieba': lambda s: list(jieba.cut(s))}
+        if 'nidf_tf' in self.model:
+            tokenizers['thulac'] = lambda s: [i[0] for i in self.model['nidf_tf'].cutter.cut(s)]
+        return TextFeatures(tokenizers)
+
     @torch.no_grad()
-    def forward(self, context, response, topic=None, history=None):
+    def forward(self, context, response, topic=None, history=None, exclude=None):
         '''
         context: the string of the conversation context
         response: the string of the responses
-        topic: a list of the topic of the conversation context
-        history: a list of the utterances that are talked by the agent
+        topic: a list of the topic of the conversation context (None for the unknown topic)
+        history: a list of the utterances that are talked by the agent, or a list of such lists
+                 (one for each response) if the responses come from the different sessions
+        exclude: a list of the sub-models that are skipped (e.g. ['mmi', 'fluency'] when the deadline is close)
 
         run one time, process one batch
 
@@ -133,28 +150,43 @@ class MultiView(nn.Module):
         :average_scores: [batch]
         :sub_model_score[i]: [batch]
         '''
-        scores = {k: [] for k, v in self.mode.items() if v}
+        exclude = exclude or []
+        scores = {k: [] for k, v in self.mode.items() if v and k not in exclude}
+        features = self.features()
         for k in scores.keys():
-            # fasttext short text classification model predict
-            # besides, the string should be tokenized by jieba
-            if k == 'topic':
-                response_ = [' '.join(jieba.cut(i)) for i in response]
-                label, value = self.model[k].predict(response_)
-                label = [i[0].replace('__label__', '') for i in label]
-                value = [i[0] for i in value]
-                rest = []
-                for l, t, v in zip(label, topic, value):
-                    if l == t:
-                        rest.append(v)
-                    else:
-                        rest.append(1-v)
-                scores[k] = rest
-            elif k in ['length', 'nidf_tf']:
-                scores[k] = self.model[k].scores(response)
-            elif k in ['distinct']:
-                scores[k] = self.model[k].scores(response, history)
-            else:
-                scores[k] = self.model[k].scores(context, response)    # [list]
+            # latency of each sub-model
+            with monitor.span(f'multiview.{k}'):
+                # fasttext short text classification model predict
+                # besides, the string should be tokenized by jieba
+                if k == 'topic':
+                    response_ = [' '.join(features.jieba(i)) for i in response]
+                    label, value = self.model[k].predict(response_)
+                    label = [i[0].replace('__label__', '') for i in label]
+                    value = [i[0] for i in value]
+                    rest = []
+                    topic = topic if topic else [None] * len(response)
+                    for l, t, v in zip(label, topic, value):
+                        if t is None:
+                            # the topic of this conversation is unknown
+                            rest.append(0)
+                        elif l == t:
+                            rest.append(v)
+                        else:
+                            rest.append(1-v)
+                    scores[k] = rest
+                elif k in ['length']:
+                    scores[k] = self.model[k].scores(response)
+                elif k in ['nidf_tf']:
+                    scores[k] = self.model[k].scores(response, features=features)
+                elif k in ['distinct']:
+                    scores[k] = self.model[k].scores(response, history, features=features)
+                elif k in ['coherence', 'mmi', 'fluency', 'repetition_penalty']:
+                    scores[k] = self.model[k].scores(context, response, features=features)    # [list]
+                else:
+                    scores[k] = self.model[k].scores(context, response)    # [list]
+        # the tokenization time is counted in the span of the sub-model that uses the string first
+        if monitor.enabled:
+            monitor.observe('multiview.tokenize', sum(features.times.values()))
         average_scores = []    # [batch]
         batch_size = len(context)
         # for idx in range(batch_size):
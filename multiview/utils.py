@@ -1,6 +1,6 @@
 from .header import *
-from nltk.collocations import BigramCollocationFinder
-from nltk.probability import FreqDist
+BigramCollocationFinder = lazy_from('nltk.collocations', 'BigramCollocationFinder')
+FreqDist = lazy_from('nltk.probability', 'FreqDist')
 
 def load_corpus(path):
     cutter = thulac.thulac(seg_only=True)
@@ -47,5 +47,42 @@ def cal_distinct(corpus):
     except:
         return 0.0
 
+class TextFeatures:
+
+    '''
+    The tokenizations of the strings in one MultiView.forward call (the contexts and the candidates), shared by
+    the sub-scorers: BERT ids (vocab.encode), jieba tokens and thulac tokens. Each tokenizer runs once for each
+    distinct string (the candidates of one context share it), and only the tokenizations that are used by the
+    enabled sub-scorers are computed. The returned lists are shared, do not change them.
+
+    features = TextFeatures({'bert': vocab.encode, 'jieba': lambda s: list(jieba.cut(s))})
+    ids = features.bert(context)
+    '''
+
+    def __init__(self, tokenizers):
+        # name -> the function that tokenizes one string
+        self.tokenizers = tokenizers
+        self.cache = {name: {} for name in tokenizers}
+        # name -> the seconds and the number of the tokenizer calls
+        self.times, self.calls = Counter(), Counter()
+
+    def get(self, name, text):
+        cache = self.cache[name]
+        if text not in cache:
+            begin = time.perf_counter()
+            cache[text] = self.tokenizers[name](text)
+            self.times[name] += time.perf_counter() - begin
+            self.calls[name] += 1
+        return cache[text]
+
+    def bert(self, text):
+        return self.get('bert', text)
+
+    def jieba(self, text):
+        return self.get('jieba', text)
+
+    def thulac(self, text):
+        return self.get('thulac', text)
+
 if __name__ == "__main__":
     data = load_corpus('data/zh50w/train_.txt')
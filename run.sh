@@ -76,8 +76,9 @@ elif [ $mode = 'train' ]; then
         --multi_gpu $cuda \
         --lang $lang
 elif [ $mode = 'test' ]; then
-    one_batch_model=(kwgpt2 pfgpt2 gpt2gan gpt2 multigpt2 when2talk)
-    if [[ ${one_batch_model[@]} =~ $model ]]; then
+    # the gpt2 models (gpt2, kwgpt2, pfgpt2, when2talk) generate the left padded test contexts in batch
+    one_batch_model=(gpt2gan multigpt2)
+    if [[ " ${one_batch_model[@]} " =~ " $model " ]]; then
         batch_size=1
     else
         batch_size=32
@@ -101,10 +102,17 @@ elif [ $mode = 'test' ]; then
         --seed 30 \
         --multi_gpu $cuda \
         --lang $lang
+elif [ $mode = 'benchmark' ]; then
+    # ./run.sh benchmark kv_cache
+    CUDA_VISIBLE_DEVICES=$cuda python benchmark.py \
+        --mode $dataset \
+        --context_len 250 \
+        --max_len 50 \
+        --runs 3
 elif [ $mode = 'eval' ]; then
     python evalp.py \
         --dataset $dataset \
         --model $model
 else
-    echo "[!] mode needs to be train/test/eval, but got $mode"
+    echo "[!] mode needs to be train/test/eval/benchmark, but got $mode"
 fi
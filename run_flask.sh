@@ -3,5 +3,5 @@
 # export FLASK_ENV=development
 # CUDA_VISIBLE_DEVICES=$1 flask run --host=0.0.0.0 --port 8080
 
-# python api.py <model_name> <cuda_id>
-CUDA_VISIBLE_DEVICES=$2 python api.py $1 $2
+# python api.py <model_name> <cuda_id> [--batch_wait 5 --max_batch 16]
+CUDA_VISIBLE_DEVICES=$2 python api.py $1 $2 ${@:3}
@@ -1,4 +1,8 @@
 from .utils import *
 from .embedding import *
 from .collate_fn import *
+from .scheduler import *
+from .conversation import *
+from .cache import *
+from .router import *
 # from .hash_positive_generate import *
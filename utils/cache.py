@@ -0,0 +1,111 @@
+from header import *
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+'''
+Response cache with request coalescing for the serving API
+
+1. the key is the topic and the normalized recent `window` utterances of the context
+2. the responses expire after `ttl` seconds, and the least recently used ones are evicted
+   if the cache is full
+3. the cached response that is already used by the session is ignored (the agent is called)
+4. N concurrent identical requests only trigger one model call, the others wait for its result
+'''
+
+class ResponseCache:
+
+    def __init__(self, capacity=10000, ttl=600, window=3):
+        self.capacity, self.ttl, self.window = capacity, ttl, window
+        # key -> (response, latency of the model call, create time)
+        self.cache = OrderedDict()
+        # key -> Future of the running model call
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits, self.coalesced, self.misses = 0, 0, 0
+        self.saved_latency = 0
+
+    def make_key(self, topic, msgs):
+        '''
+        msgs: a list of the utterances of the conversation context
+        '''
+        msgs = [' '.join(i.strip().lower().split()) for i in msgs[-self.window:]]
+        return (topic, tuple(msgs))
+
+    def _get(self, key):
+        item = self.cache.get(key)
+        if item is None:
+            return None
+        if time.time() - item[2] > self.ttl:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return item
+
+    def _put(self, key, response, latency):
+        self.cache[key] = (response, latency, time.time())
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def obtain(self, key, fn, history=None):
+        '''
+        fn: the model call without arguments, which is called on the cache miss
+        history: the utterances already used by the session
+        return the response and whether it is obtained without calling the model
+        '''
+        history = set(history or [])
+        with self.lock:
+            item = self._get(key)
+            if item and item[0] not in history:
+                self.hits += 1
+                self.saved_latency += item[1]
+                return item[0], True
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.inflight[key] = future
+        if not leader:
+            # wait for the identical request that is running
+            try:
+                response, latency = future.result()
+            except Exception:
+                response = None
+            if response is not None and response not in history:
+                with self.lock:
+                    self.coalesced += 1
+                    self.saved_latency += latency
+                return response, True
+            # the response is already used by this session, call the model by itself
+            response = fn()
+            with self.lock:
+                self.misses += 1
+            return response, False
+        begin = time.time()
+        try:
+            response = fn()
+        except Exception as error:
+            with self.lock:
+                self.inflight.pop(key, None)
+            future.set_exception(error)
+            raise
+        latency = time.time() - begin
+        with self.lock:
+            self._put(key, response, latency)
+            self.inflight.pop(key, None)
+            self.misses += 1
+        future.set_result((response, latency))
+        return response, False
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.coalesced + self.misses
+            return {
+                'size': len(self.cache),
+                'hits': self.hits,
+                'coalesced': self.coalesced,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.coalesced) / total, 4) if total else 0,
+                'saved_latency': round(self.saved_latency, 4),
+            }
@@ -112,17 +112,22 @@ def gpt2_test_collate_fn(batch):
     return ctx, res
 
 def gpt2_test_collate_fn_batch(batch):
+    '''
+    batched test-time generation: the contexts are left padded, so that the last tokens of the
+    contexts are aligned and the next tokens of all the contexts are generated together
+    return ctx: [batch, seq]; attn_mask: [batch, seq], 0 for the pad tokens; res: batch*[seq]
+    '''
     pad = 0
     ctx, res = [], []
     for i in batch:
         ctx.append(i['context_id'])
         res.append(i['reply_id'])
-    ctx = pad_sequence(ctx, batch_first=True, padding_value=pad)
-    res = pad_sequence(res, batch_first=True, padding_value=pad)
+    max_len = max(len(i) for i in ctx)
+    attn_mask = torch.LongTensor([[0] * (max_len - len(i)) + [1] * len(i) for i in ctx])
+    ctx = torch.stack([F.pad(i, (max_len - len(i), 0), value=pad) for i in ctx])
     if torch.cuda.is_available():
-        ctx = ctx.cuda()
-        res = res.cuda()
-    return ctx, res
+        ctx, attn_mask = ctx.cuda(), attn_mask.cuda()
+    return ctx, attn_mask, res
 
 def multigpt2_train_collate_fn(batch):
     '''
@@ -0,0 +1,179 @@
+from header import *
+import sqlite3
+import threading
+from queue import Queue, Empty, Full
+
+'''
+Write-behind conversation logging for the wechat api
+
+1. the backend client is created once and shared during the lifetime of the process
+2. the id of the utterance is allocated by a monotonic counter (no full scan of the table)
+3. the utterances are pushed into a bounded queue and flushed in bulk by a background writer
+4. backends: mongodb (default), sqlite and memory (load test without mongodb)
+'''
+
+class MongoDBBackend:
+
+    def __init__(self, dbname='dialog', table_name='test'):
+        self.table = init_mongodb(dbname, table_name)
+        self.table.create_index('id')
+
+    def max_id(self):
+        item = self.table.find_one(sort=[('id', pymongo.DESCENDING)])
+        return -1 if item is None else item['id']
+
+    def insert_many(self, items):
+        self.table.insert_many(items, ordered=False)
+
+    def clear(self):
+        self.table.delete_many({})
+
+class SQLiteBackend:
+
+    def __init__(self, path='cache/conversation.db'):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS conversation (id INTEGER PRIMARY KEY, response TEXT)')
+            self.conn.commit()
+
+    def max_id(self):
+        with self.lock:
+            item = self.conn.execute('SELECT MAX(id) FROM conversation').fetchone()[0]
+        return -1 if item is None else item
+
+    def insert_many(self, items):
+        with self.lock:
+            self.conn.executemany(
+                    'INSERT INTO conversation (id, response) VALUES (?, ?)',
+                    [(i['id'], i['response']) for i in items])
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM conversation')
+            self.conn.commit()
+
+class MemoryBackend:
+
+    def __init__(self):
+        self.table = []
+
+    def max_id(self):
+        return self.table[-1]['id'] if self.table else -1
+
+    def insert_many(self, items):
+        self.table.extend(items)
+
+    def clear(self):
+        self.table = []
+
+def init_conversation_backend(name, path=None):
+    if name == 'mongodb':
+        return MongoDBBackend('dialog', 'test')
+    elif name == 'sqlite':
+        return SQLiteBackend(path if path else 'cache/conversation.db')
+    elif name == 'memory':
+        return MemoryBackend()
+    else:
+        raise Exception(f'[!] backend must be mongodb/sqlite/memory, but got {name}')
+
+class ConversationWriter:
+
+    '''
+    capacity: size of the bounded queue, the utterances are dropped (and counted) if the queue is full,
+              so that the reply path is never blocked by the database
+    batch_size: max size of one bulk insert
+    flush_interval: max waiting time (seconds) of the utterances in the queue
+    '''
+
+    def __init__(self, backend, capacity=10000, batch_size=256, flush_interval=1.0):
+        self.backend = backend
+        self.batch_size, self.flush_interval = batch_size, flush_interval
+        self.queue = Queue(capacity)
+        # flush and clear can not run at the same time
+        self.lock = threading.Lock()
+        # the id and the epoch are taken together, clear resets both of them
+        self.id_lock = threading.Lock()
+        self.counter = self.backend.max_id() + 1
+        # the utterances pushed before the last clear are ignored
+        self.epoch = 0
+        # the dropped utterances are counted by the callers of write and the worker
+        self.stat_lock = threading.Lock()
+        self.dropped, self.written = 0, 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+        print(f'[!] init the conversation writer ({backend.__class__.__name__}), next id: {self.counter}')
+
+    def _allocate_id(self):
+        '''
+        return the epoch and the id of the new utterance
+        '''
+        with self.id_lock:
+            idx = self.counter
+            self.counter += 1
+            return self.epoch, idx
+
+    def _drop(self, num):
+        with self.stat_lock:
+            self.dropped += num
+
+    def write(self, response):
+        '''
+        non-blocking, return the id of the utterance
+        '''
+        epoch, idx = self._allocate_id()
+        item = {'response': response, 'id': idx}
+        try:
+            self.queue.put_nowait((epoch, item))
+        except Full:
+            self._drop(1)
+        return item['id']
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        end_time = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remain = end_time - time.time()
+            if remain <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remain))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            with self.lock:
+                batch = [item for epoch, item in batch if epoch == self.epoch]
+                if not batch:
+                    continue
+                try:
+                    self.backend.insert_many(batch)
+                    with self.stat_lock:
+                        self.written += len(batch)
+                except Exception as error:
+                    self._drop(len(batch))
+                    print(f'[!] write {len(batch)} utterances into the database failed: {error}')
+
+    def clear(self):
+        '''
+        remove all the conversations in the database, the pending utterances of the old epoch
+        are skipped by the worker
+        '''
+        with self.lock:
+            with self.id_lock:
+                self.epoch += 1
+                self.counter = 0
+            self.backend.clear()
+
+    def stats(self):
+        with self.stat_lock:
+            return {
+                'pending': self.queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'next_id': self.counter,
+            }
@@ -1,6 +1,7 @@
 import os
-import jieba
-import ipdb
+from lazy import lazy_import
+jieba = lazy_import('jieba')
+ipdb = lazy_import('ipdb')
 import pickle
 from tqdm import tqdm
 import numpy as np
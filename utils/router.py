@@ -0,0 +1,219 @@
+from header import *
+import threading
+import itertools
+import multiprocessing as mp
+from concurrent.futures import Future
+from models.monitor import monitor
+from models.model_utils import Deadline
+
+'''
+Multi-agent router for the serving API
+
+1. several agents are hosted in one service, the agent is selected by the path (/get_res/<model>)
+   or the `model` field of the request
+2. the weights are loaded once in the parent process and moved into the shared memory, then the
+   worker processes are forked, so the extra workers read the same weights without copying them
+3. the requests are sent to the least-loaded worker (the number of the unfinished requests)
+4. the session histories are kept in the parent process and sent to the workers with the requests
+5. the metrics collected by the worker process are sent back with the results and merged into the
+   monitor of the main process
+
+NOTE: CUDA can not be re-initialized in the forked processes, so the worker processes are only used
+      for the CPU inference, the agents run in the main process if CUDA is available (workers=0)
+NOTE: the router must be created before the other threads (scheduler, writer) of the service start
+'''
+
+def share_agent_memory(obj, visited=None):
+    '''
+    move the parameters of all the nn.Module held by the agent into the shared memory,
+    including the modules that are not registered as the submodules (e.g. the sub-models
+    of the MultiView reranker, which are saved in a dict)
+    '''
+    visited = set() if visited is None else visited
+    if id(obj) in visited:
+        return
+    visited.add(id(obj))
+    if isinstance(obj, nn.Module):
+        obj.share_memory()
+        obj.eval()
+        children = vars(obj).values()
+    elif isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        children = obj
+    elif hasattr(obj, '__dict__') and obj.__class__.__module__.split('.')[0] in ['models', 'multiview']:
+        children = vars(obj).values()
+    else:
+        return
+    for child in list(children):
+        share_agent_memory(child, visited)
+
+def process_memory(pid):
+    '''
+    memory (MB) of the process, the pages of the weights shared with the other processes are counted in
+    `shared`, `private` is the memory that is only used by this process, `pss` splits the shared pages
+    among the processes that use them
+    '''
+    rest = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if ':' not in line:
+                    continue
+                key, value = line.split(':', 1)
+                if key in ['Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty']:
+                    rest[key] = int(value.split()[0]) / 1024
+    except (FileNotFoundError, ValueError):
+        return None
+    return {
+        'rss': round(rest.get('Rss', 0), 2),
+        'pss': round(rest.get('Pss', 0), 2),
+        'private': round(rest.get('Private_Clean', 0) + rest.get('Private_Dirty', 0), 2),
+        'shared': round(rest.get('Shared_Clean', 0) + rest.get('Shared_Dirty', 0), 2),
+    }
+
+def agent_worker_loop(agents, conn, threads):
+    '''
+    the main loop of the worker process, the requests are processed one by one
+    '''
+    torch.set_num_threads(threads)
+    torch.set_grad_enabled(False)
+    while True:
+        try:
+            idx, name, (topics, msgs, histories, deadline) = conn.recv()
+        except EOFError:
+            break
+        try:
+            with monitor.label(name), monitor.span('talk'):
+                rest = agents[name].talk_batch(topics, msgs, histories=histories, deadline=deadline)
+            conn.send((idx, True, rest, monitor.drain()))
+        except Exception as error:
+            conn.send((idx, False, f'{error.__class__.__name__}: {error}', monitor.drain()))
+
+class AgentWorker:
+
+    def __init__(self, ctx, agents, threads=1):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+                target=agent_worker_loop,
+                args=(agents, child_conn, threads),
+                daemon=True)
+        self.process.start()
+        child_conn.close()
+        # idx -> Future of the unfinished request
+        self.futures = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.receiver = threading.Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+
+    @property
+    def load(self):
+        return len(self.futures)
+
+    def submit(self, name, topics, msgs, histories, deadline=None):
+        future = Future()
+        with self.lock:
+            idx = next(self.counter)
+            self.futures[idx] = future
+            self.conn.send((idx, name, (topics, msgs, histories, deadline)))
+        return future
+
+    def _receive(self):
+        while True:
+            try:
+                idx, ok, rest, metrics = self.conn.recv()
+            except EOFError:
+                break
+            monitor.merge(metrics)
+            with self.lock:
+                future = self.futures.pop(idx)
+            if ok:
+                future.set_result(rest)
+            else:
+                future.set_exception(Exception(f'[!] worker {self.process.pid} failed: {rest}'))
+        # the worker process exits, the waiting requests fail
+        with self.lock:
+            futures, self.futures = list(self.futures.values()), {}
+        for future in futures:
+            future.set_exception(Exception(f'[!] worker {self.process.pid} exits'))
+
+class AgentRouter:
+
+    '''
+    agents: an OrderedDict of the agents (name -> agent), the first one is the default agent
+    workers: number of the worker processes, 0 means that the agents run in the main process
+    threads: number of the torch threads of each worker process
+    '''
+
+    def __init__(self, agents, workers=0, threads=1):
+        self.agents = agents
+        self.default = list(agents.keys())[0]
+        if workers > 0 and torch.cuda.is_available():
+            print(f'[!] CUDA can not be used in the forked worker processes, the agents run in the main process')
+            workers = 0
+        self.workers = []
+        if workers > 0:
+            for agent in agents.values():
+                share_agent_memory(agent)
+            ctx = mp.get_context('fork')
+            self.workers = [AgentWorker(ctx, agents, threads=threads) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        print(f'[!] init the agent router, agents: {list(agents.keys())}, workers: {len(self.workers)}')
+
+    def __contains__(self, name):
+        return name in self.agents
+
+    def __getitem__(self, name):
+        return self.agents[name]
+
+    def select(self, name=None):
+        '''
+        return the name of the agent, the default agent is used if the name is not given
+        '''
+        name = name if name else self.default
+        if name not in self.agents:
+            raise Exception(f'[!] unknown agent {name}, available agents: {list(self.agents.keys())}')
+        return name
+
+    def talk_batch(self, name, topics, msgs, histories=None, deadline=None):
+        if not self.workers:
+            with monitor.span('talk'):
+                return self.agents[name].talk_batch(topics, msgs, histories=histories, deadline=deadline)
+        with self.lock:
+            worker = min(self.workers, key=lambda w: w.load)
+            future = worker.submit(name, topics, msgs, histories, deadline=deadline)
+        return future.result()
+
+    def get_res_batch(self, name, data):
+        '''
+        same as the agent.get_res_batch, but the model is called by the worker process,
+        and the session histories are maintained by the main process
+        '''
+        agent = self.agents[name]
+        with monitor.label(name), monitor.span('get_res'):
+            topics = [i['topic'] for i in data]
+            msgs = ['[SEP]'.join([j['msg'] for j in i['msgs']]) for i in data]
+            histories = [agent.sessions.history(i.get('group_id')) for i in data]
+            deadline = Deadline.tightest([i.get('deadline') for i in data])
+            res = self.talk_batch(name, topics, msgs, histories=histories, deadline=deadline)
+            for i, r in zip(data, res):
+                agent.sessions.append(i.get('group_id'), r)
+        with self.lock:
+            self.requests[name] += len(data)
+        return res
+
+    def stats(self):
+        return {
+            'requests': dict(self.requests),
+            'main': process_memory(os.getpid()),
+            'workers': [
+                {
+                    'pid': w.process.pid,
+                    'alive': w.process.is_alive(),
+                    'load': w.load,
+                    'memory': process_memory(w.process.pid),
+                } for w in self.workers
+            ],
+        }
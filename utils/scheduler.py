@@ -0,0 +1,143 @@
+from header import *
+import threading
+from queue import Queue, Empty, Full
+from concurrent.futures import Future
+from models.monitor import monitor
+
+'''
+Micro-batching scheduler for the serving API
+
+The requests of the different conversations (group_id) are gathered for a few milliseconds
+or until the max batch size is reached, and then the whole batch is fed into the agent with
+one call (agent.get_res_batch), the results are sent back to the waiting requests.
+
+Admission control: the queue is bounded (max_queue), the request is rejected immediately (Overloaded)
+if the queue is full, so that the tail latency of the accepted requests is protected.
+The waiting time of each request in the queue is recorded (queue_wait).
+'''
+
+class Overloaded(Exception):
+
+    '''
+    raised by BatchScheduler.submit if the queue is full
+    '''
+
+    pass
+
+class BatchScheduler:
+
+    '''
+    fn: the batch function, receives a list of the requests and returns a list of the results
+    max_wait: the max waiting time (seconds) after the first request of the batch arrives
+    max_batch: the max size of one batch
+    concurrency: number of the batches that are processed at the same time (e.g. by the worker processes)
+    max_queue: max number of the waiting requests, 0 means that the queue is unbounded
+    name: the agent label of the queue_wait metric
+    '''
+
+    def __init__(self, fn, max_wait=0.005, max_batch=16, concurrency=1, max_queue=0, name=''):
+        self.fn = fn
+        self.max_wait, self.max_batch = max_wait, max_batch
+        self.name = name
+        self.queue = Queue(max_queue)
+        # statistic information
+        self.lock = threading.Lock()
+        self.collect_lock = threading.Lock()
+        self.batch_size_counter = Counter()
+        self.queue_depth_counter = Counter()
+        self.max_queue_depth = 0
+        self.rejected = 0
+        # waiting time (seconds) in the queue: sum, count and max
+        self.queue_wait = [0, 0, 0]
+        self.workers = [threading.Thread(target=self._run, daemon=True) for _ in range(concurrency)]
+        for worker in self.workers:
+            worker.start()
+        print(f'[!] init the batch scheduler, max wait: {max_wait}s, max batch: {max_batch}, concurrency: {concurrency}, max queue: {max_queue}')
+
+    def submit(self, item):
+        '''
+        non-blocking, return the future of the result,
+        raise Overloaded if the queue is full
+        '''
+        future = Future()
+        try:
+            self.queue.put_nowait((item, future, time.time()))
+        except Full:
+            with self.lock:
+                self.rejected += 1
+            with monitor.label(self.name):
+                monitor.count('rejected')
+            raise Overloaded(f'[!] the queue of {self.name} is full ({self.queue.maxsize} requests)')
+        return future
+
+    def __call__(self, item):
+        '''
+        blocking, wait until the batch which contains this item is processed
+        '''
+        return self.submit(item).result()
+
+    def _collect(self):
+        # only one thread collects the batch at the same time
+        with self.collect_lock:
+            return self._collect_batch()
+
+    def _collect_batch(self):
+        batch = [self.queue.get()]
+        end_time = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remain = end_time - time.time()
+            if remain <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remain))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # requests that are still waiting in the queue
+            depth = self.queue.qsize()
+            now = time.time()
+            waits = [now - i[2] for i in batch]
+            with self.lock:
+                self.batch_size_counter[len(batch)] += 1
+                self.queue_depth_counter[depth] += 1
+                self.max_queue_depth = max(self.max_queue_depth, depth)
+                self.queue_wait[0] += sum(waits)
+                self.queue_wait[1] += len(waits)
+                self.queue_wait[2] = max(self.queue_wait[2], max(waits))
+            if monitor.enabled:
+                with monitor.label(self.name):
+                    for wait in waits:
+                        monitor.observe('queue_wait', wait)
+            items, futures = [i[0] for i in batch], [i[1] for i in batch]
+            try:
+                rest = list(self.fn(items))
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            for future, r in zip(futures, rest):
+                future.set_result(r)
+            if len(rest) != len(futures):
+                # the requests without the replies must not wait forever
+                error = Exception(f'[!] {self.name}: {len(futures)} requests in the batch, but got {len(rest)} replies')
+                print(error)
+                for future in futures[len(rest):]:
+                    future.set_exception(error)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'rejected': self.rejected,
+                'avg_queue_wait': round(self.queue_wait[0] / self.queue_wait[1], 6) if self.queue_wait[1] else 0,
+                'max_queue_wait': round(self.queue_wait[2], 6),
+                'batches': sum(self.batch_size_counter.values()),
+                'requests': sum(k * v for k, v in self.batch_size_counter.items()),
+                'batch_size_histogram': dict(sorted(self.batch_size_counter.items())),
+                'queue_depth_histogram': dict(sorted(self.queue_depth_counter.items())),
+            }
@@ -199,9 +199,16 @@ def reply_text(to_user, from_user, content):
     response.content_type = 'application/xml'
     return response
 
-def init_mongodb(dbname, table_name):
-    client = pymongo.MongoClient('mongodb://localhost:27017/')
-    table = client[dbname][table_name]
+mongodb_clients = {}
+
+def init_mongodb(dbname, table_name, uri='mongodb://localhost:27017/'):
+    '''
+    MongoClient is thread-safe and has its own connection pool,
+    only create it once during the lifetime of the process
+    '''
+    if uri not in mongodb_clients:
+        mongodb_clients[uri] = pymongo.MongoClient(uri)
+    table = mongodb_clients[uri][dbname][table_name]
     return table 
 
 def db_table_counter(table):
@@ -234,6 +241,7 @@ if __name__ == "__main__":
     parser.add_argument('--dataset', default='zh50w', type=str)
     parser.add_argument('--mode', default='irdata')
     parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--size', default=4000, type=int)
     
     args = parser.parse_args()
     if args.mode == 'irdata':
@@ -246,6 +254,13 @@ if __name__ == "__main__":
         data_path = f'data/{args.dataset}/dev.csv'
         save_path = f'data/{args.dataset}/dev.pkl'
         bert_as_service_processing4ir(data_path, save_path, args.batch_size)
+    elif args.mode == 'shortlist':
+        # the vocabulary shortlist of the GPT2 decoding (VocabShortlist)
+        from models.model_utils import VocabShortlist
+        vocab = BertTokenizer(vocab_file='data/vocab/vocab_small')
+        shortlist = VocabShortlist.from_corpus(f'data/{args.dataset}/train.txt', vocab, args.size)
+        shortlist.save('data/vocab/shortlist.npy')
+        print(f'[!] save the shortlist ({len(shortlist)} tokens) into data/vocab/shortlist.npy')
     else:
         pass
 